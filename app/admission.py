@@ -0,0 +1,169 @@
+"""Admission control: per-client rate limits and a cap on concurrent requests.
+
+Every request spends tokens from its client's bucket. The bucket holds up
+to ``burst`` tokens and refills at ``rate`` tokens per second. Clients are
+identified by the ``sub`` of a valid access token, or by their IP address
+when the request has none. Routes that are expensive for the server, such
+as the bcrypt endpoints, search and import, cost more than one token. A
+client whose bucket runs dry gets 429 Too Many Requests with Retry-After.
+Other clients are not affected.
+
+Independently, at most ``max_concurrency`` requests are handled at once.
+Requests beyond that get 503 Service Unavailable right away instead of
+queueing, so a worker's latency stays bounded under overload.
+
+Buckets and the concurrency count are per worker process. Health checks,
+readiness and /metrics are never limited, and the long-lived event stream
+does not count against the concurrency cap.
+"""
+
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+import orjson
+
+from metrics import ADMISSION_REJECTED
+
+# Tokens per second refilled into each client's bucket; 0 turns the
+# per-client limit off
+ADMISSION_RATE = float(os.getenv("ADMISSION_RATE", "20"))
+ADMISSION_BURST = float(os.getenv("ADMISSION_BURST", "60"))
+# Requests handled at once by a worker; 0 turns the cap off
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "200"))
+# Buckets kept per worker; the least recently used are dropped beyond this
+ADMISSION_MAX_CLIENTS = int(os.getenv("ADMISSION_MAX_CLIENTS", "100000"))
+
+# Tokens a request costs by method and path; anything else costs 1
+ROUTE_COSTS: Dict[Tuple[str, str], float] = {
+    ("POST", "/api/register"): 10,
+    ("POST", "/api/token"): 10,
+    ("POST", "/api/forgot-password"): 10,
+    ("GET", "/api/todos/search"): 5,
+    ("GET", "/api/todos/export"): 5,
+    ("POST", "/api/todos/import"): 10,
+    ("POST", "/api/todos/batch"): 5,
+    ("PATCH", "/api/todos/batch"): 5,
+    ("DELETE", "/api/todos/batch"): 5,
+}
+UNLIMITED_PATHS = frozenset({"/healthz", "/readyz", "/metrics"})
+# Streams stay open for as long as the client listens
+UNCAPPED_PATHS = frozenset({"/api/todos/events"})
+
+
+class TokenBuckets:
+    """Token bucket per client key"""
+
+    def __init__(self, rate: float, burst: float, max_clients: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        # key -> (tokens, time they were counted)
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def take(self, key: str, cost: float, now: Optional[float] = None) -> float:
+        """Spend ``cost`` tokens; 0 if they were spent, else seconds to wait"""
+        now = time.monotonic() if now is None else now
+        # A request costing more than the burst could never be admitted
+        cost = min(cost, self.burst)
+        tokens, counted_at = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - counted_at) * self.rate)
+        if tokens >= cost:
+            tokens -= cost
+            wait = 0.0
+        else:
+            wait = (cost - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        # A dropped bucket starts full again, which only favours its client
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+def _bearer_token(scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer" and token:
+                return token
+    return None
+
+
+async def _reject(send, status: int, detail: str, retry_after: float) -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": orjson.dumps({"detail": detail})})
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying the rate limits and the concurrency cap
+
+    ``token_subject`` maps an access token to its ``sub``, or None when the
+    token is not valid; those requests are limited by IP address.
+    """
+
+    def __init__(
+        self,
+        app,
+        token_subject: Callable[[str], Optional[str]],
+        rate: float = ADMISSION_RATE,
+        burst: float = ADMISSION_BURST,
+        max_concurrency: int = ADMISSION_MAX_CONCURRENCY,
+        max_clients: int = ADMISSION_MAX_CLIENTS,
+    ):
+        self.app = app
+        self.token_subject = token_subject
+        self.buckets = TokenBuckets(rate, burst, max_clients) if rate > 0 else None
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+
+    def _client_key(self, scope) -> str:
+        token = _bearer_token(scope)
+        subject = self.token_subject(token) if token else None
+        if subject is not None:
+            return "user:" + subject
+        client = scope.get("client")
+        return "ip:" + (client[0] if client else "unknown")
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or path in UNLIMITED_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        capped = self.max_concurrency > 0 and path not in UNCAPPED_PATHS
+        if capped and self.in_flight >= self.max_concurrency:
+            ADMISSION_REJECTED.labels("concurrency").inc()
+            await _reject(send, 503, "Server is busy, please try again", 1)
+            return
+
+        if self.buckets is not None:
+            cost = ROUTE_COSTS.get((scope["method"], path), 1)
+            wait = self.buckets.take(self._client_key(scope), cost)
+            if wait:
+                ADMISSION_REJECTED.labels("rate").inc()
+                await _reject(send, 429, "Too many requests", wait)
+                return
+
+        if not capped:
+            await self.app(scope, receive, send)
+            return
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
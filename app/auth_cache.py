@@ -0,0 +1,124 @@
+"""In-process cache of verified access tokens and the users they belong to.
+
+get_current_user runs on every authenticated request. With this cache a
+repeat request skips both the JWT signature check and the users lookup:
+the token maps to a username and the username to the user document.
+
+Entries expire after ``ttl`` seconds or when the token itself expires,
+whichever comes first, and the least recently used entries are evicted
+beyond ``maxsize``. Changes to a user must call ``invalidate_user``; with
+several worker processes the TTL bounds how long other workers may serve
+the old document.
+
+Access tokens name the login session they belong to. Logging out calls
+``revoke_session``, after which this process refuses the session's access
+tokens, cached or not, until they would have expired anyway.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries expire"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+
+class PrincipalCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        # token -> (username, session)
+        self.tokens = TTLCache(maxsize, ttl)
+        self.users = TTLCache(maxsize, ttl)
+        # Kept for as long as the session's access tokens are valid
+        self.revoked_sessions = TTLCache(maxsize, float("inf"))
+
+    def get_username(self, token: str) -> Optional[str]:
+        """Username of an already verified, unexpired token"""
+        entry = self.tokens.get(token)
+        if entry is None:
+            return None
+        username, session = entry
+        if self.session_revoked(session):
+            self.tokens.pop(token)
+            return None
+        return username
+
+    def put_token(
+        self,
+        token: str,
+        username: str,
+        expires_at: float,
+        session: Optional[str] = None,
+    ) -> None:
+        """Remember a verified token until ``expires_at`` (a Unix timestamp)"""
+        self.tokens.set(token, (username, session), ttl=expires_at - time.time())
+
+    def revoke_session(self, session: str, until: float) -> None:
+        """Refuse the session's access tokens until ``until`` (a Unix timestamp)"""
+        self.revoked_sessions.set(session, True, ttl=until - time.time())
+
+    def session_revoked(self, session: Optional[str]) -> bool:
+        return session is not None and self.revoked_sessions.get(session) is not None
+
+    def get_user(self, username: str) -> Optional[dict]:
+        return self.users.get(username)
+
+    def put_user(self, user: dict) -> None:
+        self.users.set(user["username"], user)
+
+    def invalidate_user(self, username: str) -> None:
+        self.users.pop(username)
+
+    def clear(self) -> None:
+        self.tokens.clear()
+        self.users.clear()
+        self.revoked_sessions.clear()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"tokens": self.tokens.stats(), "users": self.users.stats()}
+
+
+principal_cache = PrincipalCache(
+    maxsize=int(os.getenv("AUTH_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("AUTH_CACHE_TTL_SECONDS", "60")),
+)
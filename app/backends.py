@@ -0,0 +1,518 @@
+"""Storage backends for users and todos.
+
+main.py talks to one StorageBackend, chosen with STORAGE_BACKEND:
+
+- ``mongo`` (default): MongoDB through Motor, implemented in database.py
+- ``sqlite``: an embedded SQLite database in WAL mode at SQLITE_PATH, for
+  small single-node deployments
+- ``memory``: plain dicts in the worker process, for tests and local
+  development; nothing survives a restart and workers do not share data
+
+Every backend takes and returns todos under their Todo field names, with
+the deadline as a midnight datetime. LocalBackend implements the todo
+operations of the two embedded engines in Python on top of a handful of
+storage primitives, following the semantics of the Mongo queries: todos
+without a priority or deadline sort last, a missing field equals None,
+and the same keyset cursors page through the results.
+"""
+
+import itertools
+import os
+from datetime import date, datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from pymongo import DESCENDING
+
+import events
+import search
+import stats
+from auth_cache import principal_cache
+from pagination import InvalidCursor, check_position
+from query_cache import result_cache
+from serializers import TODO_FIELDS
+from todo_query import TodoQuery
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")
+# How long deletions are remembered for delta sync clients
+TOMBSTONE_RETENTION_DAYS = int(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))
+
+BatchStatuses = List[Tuple[str, Optional[str]]]
+
+
+def convert_date_to_datetime(data: dict) -> dict:
+    """Convert date objects to datetime objects for storage"""
+    converted = data.copy()
+    if "deadline" in converted and isinstance(converted["deadline"], date):
+        converted["deadline"] = datetime.combine(
+            converted["deadline"], datetime.min.time()
+        )
+    return converted
+
+
+def todo_sequence_name(user_id: int) -> str:
+    """Name of the counter that issues todo ids for a user"""
+    return f"todos:{user_id}"
+
+
+def prepare_todo_document(todo_data: dict) -> dict:
+    """Storage form of a new todo"""
+    # Convert date to datetime before storing
+    converted_data = convert_date_to_datetime(todo_data)
+    # Ensure completed is a boolean
+    if "completed" in converted_data:
+        converted_data["completed"] = bool(converted_data["completed"])
+    converted_data.update(search.search_fields(converted_data))
+    return converted_data
+
+
+def prepare_todo_update(update_data: dict) -> dict:
+    """Storage form of the fields changed by an update"""
+    # Convert date to datetime before updating
+    converted_data = convert_date_to_datetime(update_data)
+    converted_data.update(search.search_fields(converted_data))
+    return converted_data
+
+
+def updated_todo(before: dict, fields: dict) -> dict:
+    """A todo as stored after an update, without its search terms"""
+    return {
+        **before,
+        **{field: value for field, value in fields.items() if field in TODO_FIELDS},
+    }
+
+
+def day_start(day: date) -> datetime:
+    return datetime.combine(day, datetime.min.time())
+
+
+class DuplicateTodo(Exception):
+    pass
+
+
+class StorageBackend:
+    async def start(self) -> None:
+        """Open connections; runs in each worker once its event loop is up"""
+        raise NotImplementedError
+
+    async def stop(self) -> None:
+        raise NotImplementedError
+
+    async def ping(self) -> None:
+        """Raises if the storage cannot be reached"""
+        raise NotImplementedError
+
+    async def get_user(self, username: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def create_user(self, user_data: dict) -> dict:
+        raise NotImplementedError
+
+    async def next_user_id(self) -> int:
+        raise NotImplementedError
+
+    async def create_refresh_token(self, record: dict) -> None:
+        raise NotImplementedError
+
+    async def use_refresh_token(
+        self, token_hash: str, used_at: datetime
+    ) -> Optional[dict]:
+        """Mark a refresh token used and return its record as it was before"""
+        raise NotImplementedError
+
+    async def revoke_refresh_tokens(self, family: str) -> None:
+        raise NotImplementedError
+
+    async def next_todo_id(self, user_id: int) -> int:
+        raise NotImplementedError
+
+    async def reserve_todo_ids(self, user_id: int, count: int) -> range:
+        raise NotImplementedError
+
+    async def get_todo(self, todo_id: int, user_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def get_user_todos(
+        self, user_id: int, query: Optional[Dict[str, Any]] = None
+    ) -> List[dict]:
+        raise NotImplementedError
+
+    def iter_user_todos(self, user_id: int) -> AsyncIterator[dict]:
+        raise NotImplementedError
+
+    async def get_todos_page(
+        self,
+        user_id: int,
+        query: TodoQuery,
+        limit: Optional[int] = None,
+        after: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[List[dict], Optional[Dict[str, Any]]]:
+        raise NotImplementedError
+
+    async def create_todo(self, todo_data: dict) -> dict:
+        raise NotImplementedError
+
+    async def update_todo(
+        self, todo_id: int, user_id: int, update_data: dict
+    ) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def delete_todo(self, todo_id: int, user_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def create_todos(
+        self, todos: List[dict], ordered: bool = False
+    ) -> Tuple[List[dict], BatchStatuses]:
+        raise NotImplementedError
+
+    async def update_todos(
+        self, user_id: int, updates: List[Tuple[int, dict]], ordered: bool = False
+    ) -> BatchStatuses:
+        raise NotImplementedError
+
+    async def delete_todos(
+        self, user_id: int, todo_ids: List[int], ordered: bool = False
+    ) -> BatchStatuses:
+        raise NotImplementedError
+
+    async def get_todo_changes(
+        self, user_id: int, since: datetime
+    ) -> Tuple[List[dict], List[int]]:
+        raise NotImplementedError
+
+    async def get_todo_stats(self, user_id: int) -> dict:
+        raise NotImplementedError
+
+    async def rebuild_todo_stats(self, user_id: int) -> dict:
+        raise NotImplementedError
+
+    async def get_todos_by_deadline(self, deadline: str, user_id: int) -> list:
+        raise NotImplementedError
+
+    async def get_todos_by_area(self, area: str, user_id: int) -> list:
+        raise NotImplementedError
+
+    async def get_todo_calendar(
+        self, user_id: int, start: date, end: date, counts_only: bool = False
+    ) -> List[dict]:
+        raise NotImplementedError
+
+    async def get_due_todos(self, user_id: int, until: date) -> List[dict]:
+        raise NotImplementedError
+
+    async def search_todos(
+        self, query: str, user_id: int, limit: int = 50
+    ) -> List[dict]:
+        raise NotImplementedError
+
+
+class LocalBackend(StorageBackend):
+    """Todo operations of the embedded engines
+
+    Subclasses provide the storage primitives below. ``_find`` understands
+    the subset of Mongo filters the application builds: equality (None also
+    matches a missing field) and ``$gt``, ``$gte``, ``$lt``, ``$lte``,
+    ``$ne`` and ``$in`` on Todo fields.
+    """
+
+    async def _insert_user(self, user: dict) -> None:
+        raise NotImplementedError
+
+    async def _find(self, query: Dict[str, Any]) -> List[dict]:
+        raise NotImplementedError
+
+    async def _insert(self, todo: dict) -> None:
+        """Store a prepared todo; raises DuplicateTodo if its id is taken"""
+        raise NotImplementedError
+
+    async def _update(
+        self, user_id: int, todo_id: int, fields: Dict[str, Any]
+    ) -> Optional[dict]:
+        """Set fields of a todo and return its previous version"""
+        raise NotImplementedError
+
+    async def _delete(self, user_id: int, todo_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def _search(self, user_id: int, terms: List[str], limit: int) -> List[dict]:
+        """Todos having every term in their title or description terms
+
+        At most ``limit`` of them, the most recently updated first.
+        """
+        raise NotImplementedError
+
+    async def _add_tombstones(
+        self, user_id: int, todo_ids: List[int], deleted_at: datetime
+    ) -> None:
+        raise NotImplementedError
+
+    async def _deleted_since(self, user_id: int, since: datetime) -> List[int]:
+        raise NotImplementedError
+
+    async def _reserve(self, name: str, count: int) -> range:
+        raise NotImplementedError
+
+    async def create_user(self, user_data: dict) -> dict:
+        await self._insert_user(user_data)
+        principal_cache.invalidate_user(user_data["username"])
+        return user_data
+
+    async def next_user_id(self) -> int:
+        return (await self._reserve("users", 1))[0]
+
+    async def next_todo_id(self, user_id: int) -> int:
+        return (await self._reserve(todo_sequence_name(user_id), 1))[0]
+
+    async def reserve_todo_ids(self, user_id: int, count: int) -> range:
+        return await self._reserve(todo_sequence_name(user_id), count)
+
+    async def get_todo(self, todo_id: int, user_id: int) -> Optional[dict]:
+        todos = await self._find({"user_id": user_id, "id": todo_id})
+        return todos[0] if todos else None
+
+    async def get_user_todos(
+        self, user_id: int, query: Optional[Dict[str, Any]] = None
+    ) -> List[dict]:
+        return await self._find({**(query or {}), "user_id": user_id})
+
+    async def iter_user_todos(self, user_id: int) -> AsyncIterator[dict]:
+        todos = await self._find({"user_id": user_id})
+        for todo in sorted(todos, key=lambda todo: todo["id"]):
+            yield todo
+
+    async def get_todos_page(
+        self,
+        user_id: int,
+        query: TodoQuery,
+        limit: Optional[int] = None,
+        after: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[List[dict], Optional[Dict[str, Any]]]:
+        todos = await self._find(query.filter)
+        field, direction = query.sort[0]
+        reverse = direction == DESCENDING
+
+        def position(todo: dict) -> tuple:
+            return (todo.get(field), todo["id"])
+
+        def beyond(key, mark) -> bool:
+            return key < mark if reverse else key > mark
+
+        # Todos without a value for the sort field go last either way
+        valued = [todo for todo in todos if todo.get(field) is not None]
+        valued.sort(key=position, reverse=reverse)
+        missing = [todo for todo in todos if todo.get(field) is None]
+        missing.sort(key=lambda todo: todo["id"], reverse=reverse)
+
+        if after is not None:
+            check_position(query.sort, after)
+            try:
+                if after[field] is None:
+                    valued = []
+                    missing = [t for t in missing if beyond(t["id"], after["id"])]
+                else:
+                    mark = (after[field], after["id"])
+                    valued = [t for t in valued if beyond(position(t), mark)]
+            except TypeError as e:
+                raise InvalidCursor(f"Cursor does not match this listing: {e}")
+        todos = valued + missing
+
+        if limit is None or len(todos) <= limit:
+            return todos, None
+        todos = todos[:limit]
+        return todos, {field: todos[-1].get(field) for field, _ in query.sort}
+
+    async def create_todo(self, todo_data: dict) -> dict:
+        todo = prepare_todo_document(todo_data)
+        await self._insert(todo)
+        await self._todos_changed(todo["user_id"], [events.todo_event("created", todo)])
+        return todo
+
+    async def update_todo(
+        self, todo_id: int, user_id: int, update_data: dict
+    ) -> Optional[dict]:
+        fields = prepare_todo_update(update_data)
+        before = await self._update(user_id, todo_id, fields)
+        if before is None:
+            return None
+        after = updated_todo(before, fields)
+        await self._todos_changed(user_id, [events.todo_event("updated", after)])
+        return after
+
+    async def delete_todo(self, todo_id: int, user_id: int) -> Optional[dict]:
+        deleted = await self._delete(user_id, todo_id)
+        if deleted:
+            await self._add_tombstones(user_id, [todo_id], datetime.now())
+            await self._todos_changed(user_id, [events.deleted_event(todo_id)])
+        return deleted
+
+    async def create_todos(
+        self, todos: List[dict], ordered: bool = False
+    ) -> Tuple[List[dict], BatchStatuses]:
+        documents = [prepare_todo_document(todo) for todo in todos]
+        statuses: BatchStatuses = []
+        created = []
+        failed = False
+        for document in documents:
+            if failed:
+                statuses.append(("skipped", None))
+                continue
+            try:
+                await self._insert(document)
+            except DuplicateTodo as e:
+                statuses.append(("error", str(e)))
+                failed = ordered
+            else:
+                statuses.append(("created", None))
+                created.append(events.todo_event("created", document))
+        if documents:
+            await self._todos_changed(documents[0]["user_id"], created)
+        return documents, statuses
+
+    async def update_todos(
+        self, user_id: int, updates: List[Tuple[int, dict]], ordered: bool = False
+    ) -> BatchStatuses:
+        # Updates of existing todos cannot fail here; an ordered batch stops
+        # at the first todo that is not found
+        statuses: BatchStatuses = []
+        updated = []
+        failed = False
+        for todo_id, update_data in updates:
+            if failed:
+                statuses.append(("skipped", None))
+                continue
+            fields = prepare_todo_update(update_data)
+            before = await self._update(user_id, todo_id, fields)
+            if before is None:
+                statuses.append(("not_found", None))
+                failed = ordered
+            else:
+                statuses.append(("updated", None))
+                updated.append(
+                    events.todo_event("updated", updated_todo(before, fields))
+                )
+        await self._todos_changed(user_id, updated)
+        return statuses
+
+    async def delete_todos(
+        self, user_id: int, todo_ids: List[int], ordered: bool = False
+    ) -> BatchStatuses:
+        statuses: BatchStatuses = []
+        deleted = []
+        failed = False
+        for todo_id in todo_ids:
+            if failed:
+                statuses.append(("skipped", None))
+            elif await self._delete(user_id, todo_id) is None:
+                statuses.append(("not_found", None))
+                failed = ordered
+            else:
+                statuses.append(("deleted", None))
+                deleted.append(todo_id)
+        if deleted:
+            await self._add_tombstones(user_id, deleted, datetime.now())
+            await self._todos_changed(
+                user_id, [events.deleted_event(todo_id) for todo_id in deleted]
+            )
+        return statuses
+
+    async def _todos_changed(self, user_id: int, todo_events: List[dict]) -> None:
+        await result_cache.invalidate_user(user_id)
+        if todo_events:
+            events.publish(user_id, todo_events)
+
+    async def get_todo_changes(
+        self, user_id: int, since: datetime
+    ) -> Tuple[List[dict], List[int]]:
+        todos = await self._find({"user_id": user_id, "updated_at": {"$gte": since}})
+        todos.sort(key=lambda todo: todo["updated_at"])
+        return todos, sorted(set(await self._deleted_since(user_id, since)))
+
+    async def get_todo_stats(self, user_id: int) -> dict:
+        # Counted on every read; the embedded engines answer this without a
+        # network hop, so no summary document is kept
+        return await self.rebuild_todo_stats(user_id)
+
+    async def rebuild_todo_stats(self, user_id: int) -> dict:
+        return stats.from_todos(user_id, await self._find({"user_id": user_id}))
+
+    async def get_todos_by_deadline(self, deadline: str, user_id: int) -> list:
+        day = datetime.strptime(deadline, "%Y-%m-%d")
+        return await self._find(
+            {
+                "user_id": user_id,
+                "deadline": {"$gte": day, "$lt": day + timedelta(days=1)},
+            }
+        )
+
+    async def get_todos_by_area(self, area: str, user_id: int) -> list:
+        return await self._find({"user_id": user_id, "area": area})
+
+    async def get_todo_calendar(
+        self, user_id: int, start: date, end: date, counts_only: bool = False
+    ) -> List[dict]:
+        todos = await self._find(
+            {
+                "user_id": user_id,
+                "deadline": {
+                    "$gte": day_start(start),
+                    "$lt": day_start(end + timedelta(days=1)),
+                },
+            }
+        )
+        todos.sort(key=lambda todo: (todo["deadline"], todo["id"]))
+        days = []
+        for day, group in itertools.groupby(
+            todos, key=lambda todo: todo["deadline"].strftime("%Y-%m-%d")
+        ):
+            group = list(group)
+            bucket: Dict[str, Any] = {
+                "_id": day,
+                "count": len(group),
+                "completed": sum(1 for todo in group if todo.get("completed")),
+            }
+            if not counts_only:
+                bucket["todos"] = group
+            days.append(bucket)
+        return days
+
+    async def get_due_todos(self, user_id: int, until: date) -> List[dict]:
+        todos = await self._find(
+            {
+                "user_id": user_id,
+                "deadline": {"$lt": day_start(until)},
+                "completed": {"$ne": True},
+            }
+        )
+        todos.sort(
+            key=lambda todo: (
+                todo["deadline"],
+                99 if todo.get("priority") is None else todo["priority"],
+                todo["id"],
+            )
+        )
+        return todos
+
+    async def search_todos(
+        self, query: str, user_id: int, limit: int = 50
+    ) -> List[dict]:
+        terms = search.query_terms(query)
+        if not terms:
+            return []
+        candidates = await self._search(user_id, terms, search.CANDIDATE_LIMIT)
+        return search.rank(query, candidates, limit)
+
+
+def create_backend(name: str = STORAGE_BACKEND) -> StorageBackend:
+    """The backend called ``name``; engines are imported only when chosen"""
+    if name == "mongo":
+        from database import MongoBackend
+
+        return MongoBackend()
+    if name == "sqlite":
+        from sqlite_backend import SQLITE_PATH, SQLiteBackend
+
+        return SQLiteBackend(SQLITE_PATH)
+    if name == "memory":
+        from memory_backend import MemoryBackend
+
+        return MemoryBackend()
+    raise ValueError(f"Unknown STORAGE_BACKEND {name!r}")
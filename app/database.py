@@ -1,68 +1,193 @@
-from pymongo import MongoClient
-from pymongo.collection import Collection
-from pymongo.database import Database
-from typing import Optional, List, Dict, Any
+from motor.motor_asyncio import (
+    AsyncIOMotorClient,
+    AsyncIOMotorCollection,
+    AsyncIOMotorDatabase,
+)
+from typing import Optional, List, Dict, Any, AsyncIterator, Tuple
 import os
 from dotenv import load_dotenv
-from datetime import datetime, date
-import re
+import logging
+import uuid
+from datetime import datetime, date, timedelta
+import asyncio
+from collections import Counter
+from pymongo import (
+    ASCENDING,
+    DeleteOne,
+    InsertOne,
+    ReturnDocument,
+    UpdateOne,
+)
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from sequences import SequenceAllocator
+from pagination import check_position, keyset_filter
+import search
+import stats
+import todo_query
+from todo_query import TodoQuery
+from auth_cache import principal_cache
+import storage
+from serializers import TODO_FIELDS
+from query_cache import result_cache
+from metrics import MongoCommandMetrics
+import events
+from backends import (
+    StorageBackend,
+    prepare_todo_document,
+    prepare_todo_update,
+    todo_sequence_name,
+)
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # MongoDB connection string
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017/")
-DB_NAME = "taskdo"
+DB_NAME = os.getenv("MONGODB_DB", "taskdo")
+# Number of ids reserved per counter round trip (1 = no block reservation)
+ID_BLOCK_SIZE = int(os.getenv("ID_BLOCK_SIZE", "1"))
+# Documents fetched per cursor round trip when streaming an export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+# Age after which a delete's claim on a todo (its tombstone) may be taken
+# over, because the request holding it failed before deleting the todo
+DELETE_CLAIM_TIMEOUT = timedelta(seconds=60)
+# Tries at replacing a summary document that increments keep changing
+STATS_REBUILD_ATTEMPTS = 3
+
+# Pool and timeout options passed to the client, read from the environment.
+# Unset variables keep the driver defaults (or the values in MONGODB_URL).
+POOL_SETTINGS = {
+    "maxPoolSize": "MONGODB_MAX_POOL_SIZE",
+    "minPoolSize": "MONGODB_MIN_POOL_SIZE",
+    "maxIdleTimeMS": "MONGODB_MAX_IDLE_TIME_MS",
+    "connectTimeoutMS": "MONGODB_CONNECT_TIMEOUT_MS",
+    "socketTimeoutMS": "MONGODB_SOCKET_TIMEOUT_MS",
+    "serverSelectionTimeoutMS": "MONGODB_SERVER_SELECTION_TIMEOUT_MS",
+    "waitQueueTimeoutMS": "MONGODB_WAIT_QUEUE_TIMEOUT_MS",
+}
+
+# Set by connect(), which runs in each worker process once its event loop is
+# up, so a client is never shared across a fork.
+client: Optional[AsyncIOMotorClient] = None
+db: Optional[AsyncIOMotorDatabase] = None
 
-print(f"Attempting to connect to MongoDB at: {MONGODB_URL}")  # Debug print
+# Collections
+users_collection: Optional[AsyncIOMotorCollection] = None
+todos_collection: Optional[AsyncIOMotorCollection] = None
+counters_collection: Optional[AsyncIOMotorCollection] = None
+tombstones_collection: Optional[AsyncIOMotorCollection] = None
+refresh_tokens_collection: Optional[AsyncIOMotorCollection] = None
+todo_stats_collection: Optional[AsyncIOMotorCollection] = None
 
-# Create MongoDB client
-try:
-    client = MongoClient(MONGODB_URL)
-    # Test the connection
-    client.server_info()
-    print("Successfully connected to MongoDB!")  # Debug print
-except Exception as e:
-    print(f"Failed to connect to MongoDB: {str(e)}")  # Debug print
-    raise
+id_allocator: Optional[SequenceAllocator] = None
 
-db: Database = client[DB_NAME]
 
-# Collections
-users_collection: Collection = db["users"]
-todos_collection: Collection = db["todos"]
+def client_options() -> Dict[str, Any]:
+    """Keyword arguments for AsyncIOMotorClient"""
+    options: Dict[str, Any] = {"event_listeners": [MongoCommandMetrics()]}
+    for option, variable in POOL_SETTINGS.items():
+        value = os.getenv(variable)
+        if value:
+            options[option] = int(value)
+    return options
 
-print(f"Using database: {DB_NAME}")  # Debug print
-print(f"Collections: {db.list_collection_names()}")  # Debug print
 
+def connect() -> AsyncIOMotorDatabase:
+    """Create this process's client and collections; no I/O happens here"""
+    global client, db, users_collection, todos_collection, counters_collection
+    global tombstones_collection, todo_stats_collection, id_allocator
+    global refresh_tokens_collection
+    if client is not None:
+        return db
+    client = AsyncIOMotorClient(MONGODB_URL, **client_options())
+    db = client[DB_NAME]
+    users_collection = db["users"]
+    todos_collection = db["todos"]
+    counters_collection = db["counters"]
+    tombstones_collection = db["tombstones"]
+    todo_stats_collection = db["todo_stats"]
+    refresh_tokens_collection = db["refresh_tokens"]
+    id_allocator = SequenceAllocator(counters_collection, block_size=ID_BLOCK_SIZE)
+    logger.info("MongoDB client created for database %s", DB_NAME)
+    return db
 
-def convert_date_to_datetime(data: dict) -> dict:
-    """Convert date objects to datetime objects for MongoDB storage"""
-    converted = data.copy()
-    if "deadline" in converted and isinstance(converted["deadline"], date):
-        converted["deadline"] = datetime.combine(
-            converted["deadline"], datetime.min.time()
-        )
-    return converted
+
+def close() -> None:
+    """Close the client's connection pool"""
+    global client
+    if client is not None:
+        client.close()
+        client = None
+
+
+async def ping() -> None:
+    """Round trip to MongoDB; raises if it cannot be reached"""
+    if client is None:
+        raise RuntimeError("Database client is not connected")
+    await client.admin.command("ping")
 
 
-def get_user(username: str) -> Optional[dict]:
+async def next_user_id() -> int:
+    """Allocate a new user id"""
+    return await id_allocator.next_id("users")
+
+
+async def next_todo_id(user_id: int) -> int:
+    """Allocate a new todo id for a user"""
+    return await id_allocator.next_id(todo_sequence_name(user_id))
+
+
+async def reserve_todo_ids(user_id: int, count: int) -> range:
+    """Allocate ``count`` consecutive todo ids for a user in one round trip"""
+    return await id_allocator.reserve(todo_sequence_name(user_id), count)
+
+
+async def get_user(username: str) -> Optional[dict]:
     """Get user by username"""
-    return users_collection.find_one({"username": username})
+    return await users_collection.find_one({"username": username})
 
 
-def create_user(user_data: dict) -> dict:
+async def create_user(user_data: dict) -> dict:
     """Create a new user"""
-    result = users_collection.insert_one(user_data)
+    result = await users_collection.insert_one(user_data)
     user_data["_id"] = str(result.inserted_id)
+    principal_cache.invalidate_user(user_data["username"])
     return user_data
 
 
-def get_todo(todo_id: int, user_id: int) -> Optional[dict]:
+async def create_refresh_token(record: dict) -> None:
+    """Store a refresh token record; a TTL index removes it once expired"""
+    await refresh_tokens_collection.insert_one(dict(record))
+
+
+async def use_refresh_token(token_hash: str, used_at: datetime) -> Optional[dict]:
+    """Mark a refresh token used and return its record as it was before"""
+    return await refresh_tokens_collection.find_one_and_update(
+        {"token_hash": token_hash},
+        {"$set": {"used_at": used_at}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE,
+    )
+
+
+async def revoke_refresh_tokens(family: str) -> None:
+    """Delete every refresh token issued from one login"""
+    await refresh_tokens_collection.delete_many({"family": family})
+
+
+async def get_todo(todo_id: int, user_id: int) -> Optional[dict]:
     """Get todo by id and user_id"""
-    return todos_collection.find_one({"id": todo_id, "user_id": user_id})
+    return storage.decode(
+        await todos_collection.find_one(
+            storage.query({"id": todo_id, "user_id": user_id}), storage.PROJECTION
+        )
+    )
 
 
-def get_user_todos(user_id: int, query: Optional[Dict[str, Any]] = None) -> List[dict]:
+async def get_user_todos(
+    user_id: int, query: Optional[Dict[str, Any]] = None
+) -> List[dict]:
     """Get all todos for a user with optional filtering"""
     base_query = {"user_id": user_id}
     if query:
@@ -83,114 +208,799 @@ def get_user_todos(user_id: int, query: Optional[Dict[str, Any]] = None) -> List
                 base_query["deadline"]["$lt"]
             )
 
-    print(f"Executing query: {base_query}")  # Debug print
-    todos = list(todos_collection.find(base_query))
-    print(f"Found {len(todos)} todos")  # Debug print
-    return todos
+    return await _find_todos(base_query)
+
 
+async def iter_user_todos(
+    user_id: int, batch_size: int = EXPORT_BATCH_SIZE
+) -> AsyncIterator[dict]:
+    """Every todo of a user in id order, fetched batch_size at a time"""
+    cursor = (
+        todos_collection.find(storage.query({"user_id": user_id}), storage.PROJECTION)
+        .sort(storage.key("id"), ASCENDING)
+        .batch_size(batch_size)
+    )
+    async for document in cursor:
+        yield storage.decode(document)
+
+
+async def get_todos_page(
+    user_id: int,
+    query: TodoQuery,
+    limit: Optional[int] = None,
+    after: Optional[Dict[str, Any]] = None,
+) -> Tuple[List[dict], Optional[Dict[str, Any]]]:
+    """Get one page of a user's todos sorted on the server
+
+    ``query`` is a sorted TodoQuery for the user. ``after`` is the sort
+    position returned for the previous page; the position of the last todo
+    on this page is returned when more todos follow.
+    """
+    if after is not None:
+        check_position(query.sort, after)
+    fetch = None if limit is None else limit + 1
+    hint = storage.sort(query.index) if query.index else None
+    todos: List[dict] = []
+    for run, (condition, sort) in enumerate(todo_query.split(query, after)):
+        if fetch is not None and len(todos) >= fetch:
+            break
+        clauses = [query.filter, condition]
+        if after is not None and run == 0:
+            # The first run is the one holding the previous page's last todo
+            clauses.append(keyset_filter(sort, after))
+        todos += await _find_todos(
+            {"$and": clauses},
+            sort,
+            None if fetch is None else fetch - len(todos),
+            hint,
+        )
 
-def create_todo(todo_data: dict) -> dict:
+    if limit is None or len(todos) <= limit:
+        return todos, None
+    todos = todos[:limit]
+    return todos, {field: todos[-1].get(field) for field, _ in query.sort}
+
+
+async def _find_todos(
+    query: Dict[str, Any],
+    sort: Optional[List[Tuple[str, int]]] = None,
+    limit: Optional[int] = None,
+    hint: Optional[List[Tuple[str, int]]] = None,
+) -> List[dict]:
+    """Todos matching a filter on Todo fields, optionally sorted and limited"""
+    cursor = todos_collection.find(storage.query(query), storage.PROJECTION)
+    if hint:
+        cursor = cursor.hint(hint)
+    if sort:
+        cursor = cursor.sort(storage.sort(sort))
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    return [storage.decode(document) for document in await cursor.to_list(length=None)]
+
+
+async def create_todo(todo_data: dict) -> dict:
     """Create a new todo"""
-    # Convert date to datetime before storing
-    converted_data = convert_date_to_datetime(todo_data)
-    # Ensure completed is a boolean
-    if "completed" in converted_data:
-        converted_data["completed"] = bool(converted_data["completed"])
-    result = todos_collection.insert_one(converted_data)
-    converted_data["_id"] = str(result.inserted_id)
+    converted_data = prepare_todo_document(todo_data)
+    await todos_collection.insert_one(storage.encode(converted_data))
+    await _todos_changed(
+        converted_data["user_id"],
+        stats.increments(converted_data),
+        [events.todo_event("created", converted_data)],
+    )
     return converted_data
 
 
-def update_todo(todo_id: int, user_id: int, update_data: dict) -> Optional[dict]:
-    """Update a todo"""
-    # Convert date to datetime before updating
-    converted_data = convert_date_to_datetime(update_data)
-
-    # First verify the todo exists and belongs to the user
-    existing_todo = todos_collection.find_one({"id": todo_id, "user_id": user_id})
-    if not existing_todo:
+async def update_todo(todo_id: int, user_id: int, update_data: dict) -> Optional[dict]:
+    """Update a todo and return it, or None if the user has no such todo"""
+    update_fields = prepare_todo_update(update_data)
+    # The previous version is returned so the stats can be adjusted; the
+    # updated todo is the previous one with the new fields applied, as
+    # stored, which find_one_and_update makes the version it replaced
+    before = await todos_collection.find_one_and_update(
+        storage.query({"id": todo_id, "user_id": user_id}),
+        storage.update(update_fields),
+        projection=storage.PROJECTION,
+        return_document=ReturnDocument.BEFORE,
+    )
+    if before is None:
         return None
+    before = storage.decode(before)
+    after = _updated(before, update_fields)
+    await _todos_changed(
+        user_id,
+        stats.update_increments(before, after),
+        [events.todo_event("updated", after)],
+    )
+    return after
+
+
+async def delete_todo(todo_id: int, user_id: int) -> Optional[dict]:
+    """Delete a todo and return it, or None if the user has no such todo"""
+    deleted = storage.decode(
+        await todos_collection.find_one_and_delete(
+            storage.query({"id": todo_id, "user_id": user_id}),
+            projection=storage.PROJECTION,
+        )
+    )
+    if deleted:
+        # Stored once the todo is gone, so a failure in between cannot
+        # leave the tombstone of a todo that still exists
+        await _store_tombstone(user_id, todo_id, _stored_time(datetime.now()))
+        await _todos_changed(
+            user_id, stats.increments(deleted, -1), [events.deleted_event(todo_id)]
+        )
+    return deleted
+
+
+async def _store_tombstone(user_id: int, todo_id: int, now: datetime) -> None:
+    tombstone = {"user_id": user_id, "id": todo_id}
+    # Any batch's claim on the todo is cleared, as the todo is gone
+    deleted = {"$set": {"deleted_at": now}, "$unset": {"claim": ""}}
+    try:
+        await tombstones_collection.update_one(tombstone, deleted, upsert=True)
+    except DuplicateKeyError:
+        # A batch delete claimed the todo at the same moment
+        await tombstones_collection.update_one(tombstone, deleted)
+
+
+async def _claim_deletes(
+    user_id: int, todo_ids: List[int], now: datetime, claim: str
+) -> set:
+    """Store the tombstones of todos a batch is about to delete
+
+    Tombstones are unique per todo, so of several batches deleting a todo
+    only the one that stored its tombstone deletes it. A claim older than
+    DELETE_CLAIM_TIMEOUT was left by a request that failed in between and
+    is taken over. The tombstones hold ``claim`` for as long as the batch
+    owns them. Returns the ids claimed.
+    """
+    if not todo_ids:
+        return set()
+    claimed = set(todo_ids)
+    try:
+        await tombstones_collection.insert_many(
+            [
+                {"user_id": user_id, "id": todo_id, "deleted_at": now, "claim": claim}
+                for todo_id in todo_ids
+            ],
+            ordered=False,
+        )
+    except BulkWriteError as e:
+        for error in e.details.get("writeErrors", []):
+            claimed.discard(todo_ids[error["index"]])
+    for todo_id in todo_ids:
+        if todo_id in claimed:
+            continue
+        result = await tombstones_collection.update_one(
+            {
+                "user_id": user_id,
+                "id": todo_id,
+                "deleted_at": {"$lt": now - DELETE_CLAIM_TIMEOUT},
+            },
+            {"$set": {"deleted_at": now, "claim": claim}},
+        )
+        if result.modified_count:
+            claimed.add(todo_id)
+    return claimed
+
+
+async def _release_claims(user_id: int, todo_ids: List[int], claim: str) -> None:
+    """Drop a batch's claims on todos it did not delete"""
+    await tombstones_collection.delete_many(
+        {"user_id": user_id, "id": {"$in": todo_ids}, "claim": claim}
+    )
 
-    # Merge the existing todo with the update data to preserve fields not included in the update
-    merged_data = existing_todo.copy()
-    merged_data.update(converted_data)
 
-    # Update the todo with the merged data
-    result = todos_collection.update_one(
-        {"id": todo_id, "user_id": user_id}, {"$set": converted_data}
+async def get_todo_changes(
+    user_id: int, since: datetime
+) -> Tuple[List[dict], List[int]]:
+    """Todos updated and ids deleted at or after ``since``"""
+    todos, tombstones = await asyncio.gather(
+        _find_todos(
+            {"user_id": user_id, "updated_at": {"$gte": since}},
+            [("updated_at", ASCENDING)],
+        ),
+        tombstones_collection.find(
+            {"user_id": user_id, "deleted_at": {"$gte": since}},
+            projection={"id": 1, "_id": 0},
+        ).to_list(length=None),
     )
+    return todos, sorted({tombstone["id"] for tombstone in tombstones})
 
-    # Return the updated todo
-    if result.modified_count > 0:
-        return todos_collection.find_one({"id": todo_id, "user_id": user_id})
-    return None
+
+async def _bulk_write(
+    operations: list, ordered: bool
+) -> Tuple[Dict[int, str], int, int]:
+    """Run operations in one bulk_write
+
+    Returns the error message per failed operation index, the number of
+    operations the server attempted (an ordered batch stops at its first
+    error) and the number of documents inserted, matched or removed.
+    """
+    try:
+        result = await todos_collection.bulk_write(operations, ordered=ordered)
+    except BulkWriteError as e:
+        errors = {
+            error["index"]: error.get("errmsg", "Write failed")
+            for error in e.details.get("writeErrors", [])
+        }
+        attempted = min(errors) + 1 if ordered and errors else len(operations)
+        return errors, attempted, _applied(e.details)
+    return {}, len(operations), _applied(result.bulk_api_result)
+
+
+def _applied(details: dict) -> int:
+    return details["nInserted"] + details["nMatched"] + details["nRemoved"]
+
+
+def _batch_statuses(
+    count: int, ok: str, errors: Dict[int, str], attempted: int
+) -> List[Tuple[str, Optional[str]]]:
+    statuses = []
+    for index in range(count):
+        if index in errors:
+            statuses.append(("error", errors[index]))
+        elif index >= attempted:
+            statuses.append(("skipped", None))
+        else:
+            statuses.append((ok, None))
+    return statuses
+
+
+def _batch_plan(
+    todo_ids: List[int], found, ordered: bool
+) -> Tuple[List[int], List[Tuple[str, Optional[str]]]]:
+    """Positions to write and the statuses of the others
+
+    Todos not in ``found`` are not found, which stops an ordered batch; the
+    items after that are skipped.
+    """
+    statuses: List[Tuple[str, Optional[str]]] = [("skipped", None)] * len(todo_ids)
+    positions = []
+    for index, todo_id in enumerate(todo_ids):
+        if todo_id not in found:
+            statuses[index] = ("not_found", None)
+            if ordered:
+                break
+        else:
+            positions.append(index)
+    return positions, statuses
+
+
+def _pinned(todo: dict) -> dict:
+    """Filter matching a todo only while it is at the version read earlier"""
+    return storage.query(
+        {
+            "id": todo["id"],
+            "user_id": todo["user_id"],
+            "updated_at": todo.get("updated_at"),
+        }
+    )
 
 
-def delete_todo(todo_id: int, user_id: int) -> bool:
-    """Delete a todo"""
-    result = todos_collection.delete_one({"id": todo_id, "user_id": user_id})
-    return result.deleted_count > 0
+def _stored_time(value: datetime) -> datetime:
+    # BSON dates keep milliseconds
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
 
 
-def get_todos_by_deadline(deadline: str, user_id: int) -> list:
+def _updated(todo: dict, fields: dict) -> dict:
+    """A todo with the Todo fields of an update applied, as stored"""
+    document = storage.encode(todo)
+    operators = storage.update(
+        {field: value for field, value in fields.items() if field in TODO_FIELDS}
+    )
+    for name in operators.get("$unset", {}):
+        document.pop(name, None)
+    document.update(operators.get("$set", {}))
+    return {
+        field: _stored_time(value) if isinstance(value, datetime) else value
+        for field, value in storage.decode(document).items()
+    }
+
+
+def _carries(todo: dict, fields: dict) -> bool:
+    """Whether a stored todo holds all the Todo fields an update set
+
+    Search terms are not read back, and a field left at its default is left
+    out of the stored document, so it reads back as missing.
+    """
+    for field, value in fields.items():
+        if field not in TODO_FIELDS:
+            continue
+        stored = todo.get(field)
+        if storage._omitted(value):
+            if not storage._omitted(stored):
+                return False
+            continue
+        if isinstance(value, datetime):
+            value = _stored_time(value)
+        if stored != value:
+            return False
+    return True
+
+
+async def _existing_todos(user_id: int, todo_ids: List[int]) -> Dict[int, dict]:
+    # Whole todos, so update events can carry the updated version
+    todos = await _find_todos({"user_id": user_id, "id": {"$in": todo_ids}})
+    return {todo["id"]: todo for todo in todos}
+
+
+async def create_todos(
+    todos: List[dict], ordered: bool = False
+) -> Tuple[List[dict], List[Tuple[str, Optional[str]]]]:
+    """Insert several todos in one round trip
+
+    Returns the stored documents and a (status, error) pair per todo.
+    """
+    documents = [prepare_todo_document(todo) for todo in todos]
+    errors, attempted, _ = await _bulk_write(
+        [InsertOne(storage.encode(document)) for document in documents], ordered
+    )
+    statuses = _batch_statuses(len(documents), "created", errors, attempted)
+    changes = Counter()
+    created = []
+    for document, (status, _) in zip(documents, statuses):
+        if status == "created":
+            changes.update(stats.increments(document))
+            created.append(events.todo_event("created", document))
+    if documents:
+        await _todos_changed(documents[0]["user_id"], changes, created)
+    return documents, statuses
+
+
+async def update_todos(
+    user_id: int, updates: List[Tuple[int, dict]], ordered: bool = False
+) -> List[Tuple[str, Optional[str]]]:
+    """Apply several (todo_id, update_data) updates in one bulk write
+
+    Each update only matches its todo at the version read beforehand, which
+    the stats are adjusted from. When fewer todos matched than were written
+    to, they are read again: a todo holding all the fields an update set
+    took it, and the updates of the other todos still there are applied
+    again one at a time. A todo updated twice in one batch gets its later
+    updates one at a time too. When the count cannot be attributed to the
+    todos, the stats are rebuilt from the todos rather than incremented.
+    """
+    update_fields = [
+        (todo_id, prepare_todo_update(update_data)) for todo_id, update_data in updates
+    ]
+    todo_ids = [todo_id for todo_id, _ in updates]
+    existing = await _existing_todos(user_id, todo_ids)
+    positions, statuses = _batch_plan(todo_ids, existing, ordered)
+    first_positions: Dict[int, int] = {}
+    for i in positions:
+        first_positions.setdefault(todo_ids[i], i)
+    first = sorted(first_positions.values())
+    reconcile = False
+    errors, attempted, applied = (
+        await _bulk_write(
+            [
+                UpdateOne(
+                    _pinned(existing[todo_ids[i]]), storage.update(update_fields[i][1])
+                )
+                for i in first
+            ],
+            ordered,
+        )
+        if first
+        else ({}, 0, 0)
+    )
+    results = _batch_statuses(len(first), "updated", errors, attempted)
+    for index, result in zip(first, results):
+        statuses[index] = result
+    done = [i for i in first if statuses[i][0] == "updated"]
+    # Positions re-applied one at a time, which do their own bookkeeping
+    retry = [i for i in positions if first_positions[todo_ids[i]] != i]
+    if ordered and len(done) < len(first):
+        stop = next(i for i in first if statuses[i][0] != "updated")
+        for i in retry:
+            if i > stop:
+                statuses[i] = ("skipped", None)
+        retry = [i for i in retry if i < stop]
+
+    if applied < len(done):
+        current = await _existing_todos(user_id, [todo_ids[i] for i in done])
+        took = {
+            i
+            for i in done
+            if todo_ids[i] in current
+            and _carries(current[todo_ids[i]], update_fields[i][1])
+        }
+        # A todo still there without the fields either missed its update or
+        # took it and changed again; applying it again one at a time reports
+        # it updated only once that write matched
+        for i in done:
+            if i in took:
+                continue
+            if todo_ids[i] in current:
+                retry.append(i)
+            else:
+                statuses[i] = ("not_found", None)
+        # When the todos that took an update are not all of the matches,
+        # the stats of the others cannot be attributed and are rebuilt
+        reconcile = len(took) != applied
+        done = sorted(took)
+
+    changes = Counter()
+    updated = []
+    for i in done:
+        before = existing[todo_ids[i]]
+        after = _updated(before, update_fields[i][1])
+        if not reconcile:
+            changes.update(stats.update_increments(before, after))
+        updated.append(events.todo_event("updated", after))
+    await _todos_changed(user_id, changes, updated)
+    for i in sorted(retry):
+        after = await update_todo(todo_ids[i], user_id, updates[i][1])
+        statuses[i] = ("updated", None) if after else ("not_found", None)
+    if reconcile:
+        await rebuild_todo_stats(user_id)
+    return statuses
+
+
+async def delete_todos(
+    user_id: int, todo_ids: List[int], ordered: bool = False
+) -> List[Tuple[str, Optional[str]]]:
+    """Delete several todos in one bulk write
+
+    The todos are claimed first by storing their tombstones, so when batch
+    deletes overlap each todo is deleted and reported by one of them; the
+    claims of todos left undeleted are dropped however the batch ends. The
+    deletes only match the version read beforehand, which the stats are
+    adjusted from; a todo updated in between is deleted again on its own.
+    A single delete takes no claim, so when one removed a todo of the batch
+    the tombstones tell whose todos are gone, and if they cannot the stats
+    are rebuilt rather than guessed.
+    """
+    existing = await _existing_todos(user_id, todo_ids)
+    # A todo listed twice is not found the second time
+    found: Dict[int, int] = {}
+    for index, todo_id in enumerate(todo_ids):
+        if todo_id in existing:
+            found.setdefault(todo_id, index)
+    now = _stored_time(datetime.now())
+    claim = uuid.uuid4().hex
+    claimed = await _claim_deletes(user_id, list(found), now, claim)
+    deleted: Dict[int, dict] = {}
+    settled = False
+    try:
+        statuses, reconcile = await _delete_claimed(
+            user_id, todo_ids, existing, found, claimed, deleted, claim, ordered
+        )
+        settled = True
+    finally:
+        unused = claimed - deleted.keys()
+        if not settled and unused:
+            # Only the todos known to be still there give their claims back
+            unused &= (await _existing_todos(user_id, list(unused))).keys()
+        if unused:
+            await _release_claims(user_id, list(unused), claim)
+    if deleted:
+        changes = Counter()
+        if not reconcile:
+            for todo in deleted.values():
+                changes.update(stats.increments(todo, -1))
+        await _todos_changed(
+            user_id, changes, [events.deleted_event(todo_id) for todo_id in deleted]
+        )
+    if reconcile:
+        await rebuild_todo_stats(user_id)
+    return statuses
+
+
+async def _delete_claimed(
+    user_id: int,
+    todo_ids: List[int],
+    existing: Dict[int, dict],
+    found: Dict[int, int],
+    claimed: set,
+    deleted: Dict[int, dict],
+    claim: str,
+    ordered: bool,
+) -> Tuple[List[Tuple[str, Optional[str]]], bool]:
+    """Delete the claimed todos of a batch, filling in ``deleted``
+
+    Returns the statuses and whether the stats have to be rebuilt.
+    """
+    positions, statuses = _batch_plan(
+        [
+            todo_id if found.get(todo_id) == index and todo_id in claimed else None
+            for index, todo_id in enumerate(todo_ids)
+        ],
+        claimed,
+        ordered,
+    )
+    errors, attempted, applied = (
+        await _bulk_write(
+            [DeleteOne(_pinned(existing[todo_ids[i]])) for i in positions], ordered
+        )
+        if positions
+        else ({}, 0, 0)
+    )
+    results = _batch_statuses(len(positions), "deleted", errors, attempted)
+    for index, result in zip(positions, results):
+        statuses[index] = result
+    deleted.update(
+        (todo_ids[i], existing[todo_ids[i]])
+        for i in positions
+        if statuses[i][0] == "deleted"
+    )
+    if applied == len(deleted):
+        return statuses, False
+    current = await _existing_todos(user_id, list(deleted))
+    gone = [todo_id for todo_id in deleted if todo_id not in current]
+    reconcile = False
+    if len(gone) > applied:
+        # Single deletes removed some of them and cleared their claims
+        ours = {
+            tombstone["id"]
+            for tombstone in await tombstones_collection.find(
+                {"user_id": user_id, "id": {"$in": gone}, "claim": claim},
+                projection={"id": 1, "_id": 0},
+            ).to_list(length=None)
+        }
+        for todo_id in gone:
+            if todo_id not in ours:
+                statuses[found[todo_id]] = ("not_found", None)
+                del deleted[todo_id]
+        reconcile = len(ours) != applied
+    # The todos still there were updated after the read
+    for todo_id in current:
+        deleted[todo_id] = storage.decode(
+            await todos_collection.find_one_and_delete(
+                storage.query({"id": todo_id, "user_id": user_id}),
+                projection=storage.PROJECTION,
+            )
+        )
+        if deleted[todo_id] is None:
+            statuses[found[todo_id]] = ("not_found", None)
+            del deleted[todo_id]
+    return statuses, reconcile
+
+
+async def _todos_changed(
+    user_id: int, changes: Dict[str, int], todo_events: List[dict]
+) -> None:
+    """Bookkeeping after a write to a user's todos: cache, stats and events"""
+    await result_cache.invalidate_user(user_id)
+    changes = {path: value for path, value in changes.items() if value}
+    if changes:
+        await _increment_stats(user_id, changes)
+    if todo_events:
+        events.publish(user_id, todo_events)
+
+
+async def _increment_stats(user_id: int, changes: Dict[str, int]) -> None:
+    update = {"$inc": {**changes, stats.VERSION: 1}}
+    days = stats.emptied_days(changes)
+    if not days:
+        await todo_stats_collection.update_one({"_id": user_id}, update, upsert=True)
+        return
+    # Days whose counter dropped are read back and removed once at zero,
+    # unless an increment brought them back up in between
+    summary = await todo_stats_collection.find_one_and_update(
+        {"_id": user_id},
+        update,
+        projection=dict.fromkeys(days, 1),
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    open_by_deadline = summary.get("open_by_deadline", {})
+    for path in days:
+        if open_by_deadline.get(path.partition(".")[2]) == 0:
+            await todo_stats_collection.update_one(
+                {"_id": user_id, path: 0}, {"$unset": {path: ""}}
+            )
+
+
+async def get_todo_stats(user_id: int) -> dict:
+    """The user's summary document, built from the todos if it is missing"""
+    summary = await todo_stats_collection.find_one({"_id": user_id})
+    if summary is None:
+        summary = await rebuild_todo_stats(user_id)
+    return summary
+
+
+async def rebuild_todo_stats(user_id: int) -> dict:
+    """Recompute the user's summary document with an aggregation
+
+    The document is only replaced at the version read before counting; an
+    increment landing meanwhile changes the version and the todos are
+    counted again. A write whose todo was counted but whose increment only
+    lands after the replace is still counted twice, until the next rebuild.
+    """
+    for _ in range(STATS_REBUILD_ATTEMPTS):
+        current = await todo_stats_collection.find_one(
+            {"_id": user_id}, {stats.VERSION: 1}
+        )
+        summary = await _count_todo_stats(user_id)
+        if current is None:
+            try:
+                await todo_stats_collection.insert_one(summary)
+            except DuplicateKeyError:
+                continue
+            return summary
+        summary[stats.VERSION] = current.get(stats.VERSION, 0)
+        result = await todo_stats_collection.replace_one(
+            {"_id": user_id, stats.VERSION: current.get(stats.VERSION)}, summary
+        )
+        if result.matched_count:
+            return summary
+    logger.warning("Stats of user %s kept changing; not rebuilt", user_id)
+    return summary
+
+
+async def _count_todo_stats(user_id: int) -> dict:
+    results = await todos_collection.aggregate(stats.rebuild_pipeline(user_id)).to_list(
+        length=1
+    )
+    return stats.from_rebuild(user_id, results[0] if results else None)
+
+
+async def get_todos_by_deadline(deadline: str, user_id: int) -> list:
     """Get todos by deadline"""
     # Convert string date to datetime for query
     deadline_date = datetime.strptime(deadline, "%Y-%m-%d")
-    return list(
-        todos_collection.find(
-            {
-                "deadline": {
-                    "$gte": datetime.combine(deadline_date, datetime.min.time()),
-                    "$lt": datetime.combine(deadline_date, datetime.max.time()),
-                },
-                "user_id": user_id,
-            }
-        )
+    return await _find_todos(
+        {
+            "deadline": {
+                "$gte": datetime.combine(deadline_date, datetime.min.time()),
+                "$lt": datetime.combine(deadline_date, datetime.max.time()),
+            },
+            "user_id": user_id,
+        }
+    )
+
+
+async def get_todo_calendar(
+    user_id: int, start: date, end: date, counts_only: bool = False
+) -> List[dict]:
+    """Todos due from ``start`` to ``end`` inclusive, one bucket per day
+
+    Each bucket has the day, the number of todos and of completed todos,
+    and unless ``counts_only`` the todos themselves in (deadline, id) order.
+    """
+    group: Dict[str, Any] = {
+        "_id": {
+            "$dateToString": {"format": "%Y-%m-%d", "date": storage.path("deadline")}
+        },
+        "count": {"$sum": 1},
+        "completed": {
+            "$sum": {"$cond": [{"$eq": [storage.path("completed"), True]}, 1, 0]}
+        },
+    }
+    if not counts_only:
+        group["todos"] = {"$push": "$$ROOT"}
+    match = {
+        "user_id": user_id,
+        "deadline": {
+            "$gte": datetime.combine(start, datetime.min.time()),
+            "$lt": datetime.combine(end + timedelta(days=1), datetime.min.time()),
+        },
+    }
+    pipeline = [
+        {"$match": storage.query(match)},
+        # Served by the (user_id, deadline, id) index, so $push keeps this order
+        {"$sort": storage.sort({"deadline": ASCENDING, "id": ASCENDING})},
+        {"$project": storage.PROJECTION},
+        {"$group": group},
+        {"$sort": {"_id": ASCENDING}},
+    ]
+    days = await todos_collection.aggregate(pipeline).to_list(length=None)
+    for day in days:
+        if "todos" in day:
+            day["todos"] = [storage.decode(todo) for todo in day["todos"]]
+    return days
+
+
+async def get_due_todos(user_id: int, until: date) -> List[dict]:
+    """Open todos due before ``until``, by deadline, then priority, then id
+
+    Todos without a priority come after the prioritized ones of their day.
+    """
+    sort = todo_query.build_sort("deadline")
+    todos = await _find_todos(
+        {
+            "user_id": user_id,
+            "deadline": {"$lt": datetime.combine(until, datetime.min.time())},
+            "completed": {"$ne": True},
+        },
+        sort,
+        hint=todo_query.choose_index(sort),
     )
+    # The deadline index returns each day's todos by id; ordering them by
+    # priority here keeps a blocking sort out of the query
+    todos.sort(key=lambda todo: (todo["deadline"], _priority_order(todo)))
+    return todos
+
 
+def _priority_order(todo: dict) -> int:
+    priority = todo.get("priority")
+    return 99 if priority is None else priority
 
-def get_todos_by_area(area: str, user_id: int) -> list:
+
+async def get_todos_by_area(area: str, user_id: int) -> list:
     """Get todos by area"""
-    return list(todos_collection.find({"area": area, "user_id": user_id}))
+    return await _find_todos({"area": area, "user_id": user_id})
 
 
-def check_user_todos(user_id: int) -> bool:
+async def check_user_todos(user_id: int) -> bool:
     """Check if a user has any todos"""
     try:
-        count = todos_collection.count_documents({"user_id": user_id})
-        print(f"User {user_id} has {count} todos")
+        count = await todos_collection.count_documents(
+            storage.query({"user_id": user_id})
+        )
         return count > 0
-    except Exception as e:
-        print(f"Error checking user todos: {str(e)}")
+    except Exception:
+        logger.exception("Error checking todos of user %s", user_id)
         return False
 
 
-def search_todos(query: str, user_id: int) -> List[dict]:
-    """Search todos by title or description"""
-    try:
-        print(f"=== Database Search ===")
-        print(f"Query: {query}")
-        print(f"User ID: {user_id}")
+async def search_todos(query: str, user_id: int, limit: int = 50) -> List[dict]:
+    """Search todos by words or word prefixes in the title or description"""
+    search_query = search.build_query(query)
+    if search_query is None:
+        return []
+    search_query["user_id"] = user_id
+
+    candidates = await _find_todos(
+        search_query,
+        todo_query.build_sort("updated_at", descending=True),
+        search.CANDIDATE_LIMIT,
+    )
+    return search.rank(query, candidates, limit)
 
-        # Build the search query
-        search_query = {
-            "user_id": user_id,
-            "$or": [
-                {"title": {"$regex": query, "$options": "i"}},
-                {"description": {"$regex": query, "$options": "i"}},
-            ],
-        }
 
-        # Execute the query
-        result = list(todos_collection.find(search_query))
-        print(f"Found {len(result)} matching todos")
+class MongoBackend(StorageBackend):
+    """StorageBackend over the module functions above"""
 
-        if not result:
-            print("No todos found matching the search criteria")
-            return []
+    def __init__(self):
+        self._change_stream: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        from migrations import AUTO_MIGRATE, migrate, wait_for_migrations
+
+        database = connect()
+        # No worker serves before the database is at the latest version
+        if AUTO_MIGRATE:
+            await migrate(database)
+        else:
+            await wait_for_migrations(database)
+        if events.EVENTS_SOURCE == "changestream":
+            self._change_stream = asyncio.create_task(
+                events.follow_change_stream(database)
+            )
 
-        print(f"=== Database Search Complete ===")
-        return result
-    except Exception as e:
-        print(f"Error in search_todos: {str(e)}")
-        raise Exception(f"Failed to search todos: {str(e)}")
+    async def stop(self) -> None:
+        if self._change_stream is not None:
+            self._change_stream.cancel()
+            self._change_stream = None
+        close()
+
+    ping = staticmethod(ping)
+    get_user = staticmethod(get_user)
+    create_user = staticmethod(create_user)
+    create_refresh_token = staticmethod(create_refresh_token)
+    use_refresh_token = staticmethod(use_refresh_token)
+    revoke_refresh_tokens = staticmethod(revoke_refresh_tokens)
+    next_user_id = staticmethod(next_user_id)
+    next_todo_id = staticmethod(next_todo_id)
+    reserve_todo_ids = staticmethod(reserve_todo_ids)
+    get_todo = staticmethod(get_todo)
+    get_user_todos = staticmethod(get_user_todos)
+    iter_user_todos = staticmethod(iter_user_todos)
+    get_todos_page = staticmethod(get_todos_page)
+    create_todo = staticmethod(create_todo)
+    update_todo = staticmethod(update_todo)
+    delete_todo = staticmethod(delete_todo)
+    create_todos = staticmethod(create_todos)
+    update_todos = staticmethod(update_todos)
+    delete_todos = staticmethod(delete_todos)
+    get_todo_changes = staticmethod(get_todo_changes)
+    get_todo_stats = staticmethod(get_todo_stats)
+    rebuild_todo_stats = staticmethod(rebuild_todo_stats)
+    get_todos_by_deadline = staticmethod(get_todos_by_deadline)
+    get_todos_by_area = staticmethod(get_todos_by_area)
+    get_todo_calendar = staticmethod(get_todo_calendar)
+    get_due_todos = staticmethod(get_due_todos)
+    search_todos = staticmethod(search_todos)
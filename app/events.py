@@ -0,0 +1,171 @@
+"""Push notifications of todo changes to connected clients.
+
+Writes in database.py publish created/updated/deleted events to an
+in-process broker, which fans them out to the Server-Sent Events streams
+of the todo owner. With several workers a client only hears about writes
+handled by its own worker, unless EVENTS_SOURCE=changestream: then every
+worker follows a MongoDB change stream (replica set required) instead, and
+the local publishing is switched off so events are not sent twice.
+
+Each stream has a bounded queue. A client that falls more than
+EVENTS_QUEUE_SIZE events behind gets a ``resync`` event and is
+disconnected instead of buffering without limit; like a reconnecting
+client, it catches up through /api/todos/changes with the token from the
+``ready`` event.
+"""
+
+import asyncio
+import logging
+import os
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+
+import orjson
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure, PyMongoError
+
+import storage
+from serializers import TODO_FIELDS, todo_to_json
+
+logger = logging.getLogger(__name__)
+
+EVENTS_SOURCE = os.getenv("EVENTS_SOURCE", "local")
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "100"))
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+
+HEARTBEAT = b": heartbeat\n\n"
+
+
+def todo_event(kind: str, todo: dict) -> dict:
+    """created or updated event carrying the todo in its response form"""
+    fields = {field: todo[field] for field in TODO_FIELDS if field in todo}
+    return {"type": kind, "id": todo["id"], "todo": todo_to_json(fields)}
+
+
+def deleted_event(todo_id: int) -> dict:
+    return {"type": "deleted", "id": todo_id}
+
+
+def frame(kind: str, data: dict, event_id: Optional[int] = None) -> bytes:
+    """One Server-Sent Events message"""
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {kind}\n".encode() + b"data: " + orjson.dumps(data) + b"\n\n"
+
+
+class Subscription:
+    def __init__(self, max_queue: int):
+        self.queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self.overflowed = False
+
+
+class EventBroker:
+    def __init__(self, max_queue: int = 100):
+        self.max_queue = max_queue
+        self.subscribers: Dict[int, Set[Subscription]] = {}
+        self._last_id = 0
+
+    def subscribe(self, user_id: int) -> Subscription:
+        subscription = Subscription(self.max_queue)
+        self.subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, user_id: int, subscription: Subscription) -> None:
+        subscriptions = self.subscribers.get(user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscribers[user_id]
+
+    def publish(self, user_id: int, events: Iterable[dict]) -> None:
+        """Queue events for every stream of the user without waiting"""
+        subscriptions = self.subscribers.get(user_id)
+        if not subscriptions:
+            return
+        # Encoded once, shared by all of the user's streams
+        frames = []
+        for event in events:
+            self._last_id += 1
+            frames.append(frame(event["type"], event, self._last_id))
+        for subscription in subscriptions:
+            if subscription.overflowed:
+                continue
+            for message in frames:
+                try:
+                    subscription.queue.put_nowait(message)
+                except asyncio.QueueFull:
+                    subscription.overflowed = True
+                    break
+
+    async def stream(
+        self, subscription: Subscription, first: bytes, heartbeat: float
+    ) -> AsyncIterator[bytes]:
+        """Messages for one client, with a comment line after idle periods"""
+        yield first
+        while not subscription.overflowed:
+            try:
+                yield await asyncio.wait_for(subscription.queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield HEARTBEAT
+        yield frame("resync", {"reason": "Client fell behind"})
+
+
+event_broker = EventBroker(EVENTS_QUEUE_SIZE)
+
+
+def publish(user_id: int, events: List[dict]) -> None:
+    """Publish events of a write handled by this worker"""
+    if EVENTS_SOURCE == "local":
+        event_broker.publish(user_id, events)
+
+
+def _change_event(change: dict) -> Optional[Tuple[int, dict]]:
+    """Owner and event of a change stream document"""
+    document = change.get("fullDocument")
+    if document is None:
+        # Deleted again before the update lookup ran
+        return None
+    if change["ns"]["coll"] == "tombstones":
+        return document["user_id"], deleted_event(document["id"])
+    todo = storage.decode(document)
+    kind = "created" if change["operationType"] == "insert" else "updated"
+    return todo["user_id"], todo_event(kind, todo)
+
+
+async def follow_change_stream(db: AsyncIOMotorDatabase) -> None:
+    """Publish todo writes of every worker from a MongoDB change stream
+
+    Deletions are taken from the tombstone inserts, which carry the user id
+    and todo id that a delete event lacks. Runs until cancelled.
+    """
+    pipeline = [
+        {
+            "$match": {
+                "$or": [
+                    {
+                        "ns.coll": "todos",
+                        "operationType": {"$in": ["insert", "update", "replace"]},
+                    },
+                    {"ns.coll": "tombstones", "operationType": "insert"},
+                ]
+            }
+        }
+    ]
+    resume_token = None
+    while True:
+        try:
+            async with db.watch(
+                pipeline, full_document="updateLookup", resume_after=resume_token
+            ) as changes:
+                async for change in changes:
+                    resume_token = changes.resume_token
+                    owner_event = _change_event(change)
+                    if owner_event is not None:
+                        user_id, event = owner_event
+                        event_broker.publish(user_id, [event])
+        except OperationFailure:
+            # Typically a resume token that fell off the oplog
+            logger.exception("Change stream failed, restarting from now")
+            resume_token = None
+            await asyncio.sleep(1)
+        except PyMongoError:
+            logger.exception("Change stream failed, resuming")
+            await asyncio.sleep(1)
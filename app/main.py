@@ -1,41 +1,89 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Request, Query
+from fastapi import FastAPI, HTTPException, Depends, status, Request, Query, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from enum import IntEnum, Enum
-from typing import List, Optional
-from pydantic import BaseModel, Field, EmailStr
+from contextlib import asynccontextmanager
+from typing import Annotated, Dict, List, Optional
+from pydantic import BaseModel, Field, EmailStr, ValidationError
 from datetime import datetime, date, timedelta
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 import os
+import asyncio
+import logging
+import time
+import hashlib
+import orjson
 from dotenv import load_dotenv
-from database import (
-    get_user,
-    create_user,
-    get_todo,
-    get_user_todos,
-    create_todo,
-    update_todo,
-    delete_todo,
-    get_todos_by_deadline,
-    get_todos_by_area,
-    users_collection,
-    todos_collection,
-    search_todos,
+from admission import AdmissionMiddleware
+from backends import TOMBSTONE_RETENTION_DAYS, create_backend
+from pagination import InvalidCursor, decode_cursor, encode_cursor
+from serializers import TodoListResponse, encode_todos, todo_to_json
+from query_cache import result_cache
+import stats
+import ndjson
+import refresh_tokens
+import todo_query
+import events
+from auth_cache import principal_cache
+from passwords import HasherBusy, password_hasher
+from metrics import JWT_SECONDS, MetricsMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from logging_config import (
+    new_request_id,
+    redact_headers,
+    request_id_var,
+    setup_logging,
+    should_sample,
+    shutdown_logging,
 )
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Security configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-for-development")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+MAX_PAGE_SIZE = 500
+MAX_BATCH_SIZE = 500
+MAX_DESCRIPTION_LENGTH = 10_000
+# Overlap between sync windows so writes committed late are not missed
+SYNC_CLOCK_SKEW = timedelta(seconds=5)
+MAX_CALENDAR_DAYS = 366
+# Longest accepted line and number of failing lines reported by an import
+MAX_IMPORT_LINE_BYTES = 64 * 1024
+MAX_IMPORT_ERRORS = 100
+READINESS_TIMEOUT_SECONDS = float(os.getenv("READINESS_TIMEOUT_SECONDS", "2"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/token")
 
-app = FastAPI()
+# Users and todos, in the engine selected by STORAGE_BACKEND
+store = create_backend()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs in every worker process, after any fork, so each gets its own
+    # pool and its own thread draining the log queue
+    setup_logging()
+    await store.start()
+    yield
+    await store.stop()
+    password_hasher.shutdown()
+    shutdown_logging()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Per-client rate limits and the concurrency cap; added before CORS so
+# rejected requests still get CORS headers. token_subject is defined with
+# the other auth helpers below.
+app.add_middleware(
+    AdmissionMiddleware, token_subject=lambda token: token_subject(token)
+)
 
 # Configure CORS
 app.add_middleware(
@@ -44,17 +92,39 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor", "X-Request-ID", "ETag"],
 )
+app.add_middleware(MetricsMiddleware)
 
 
 # Request logging middleware
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    print(f"Received request: {request.method} {request.url}")
-    print(f"Headers: {request.headers}")
-    response = await call_next(request)
-    print(f"Response status: {response.status_code}")
-    return response
+    request_id = new_request_id(request.headers)
+    token = request_id_var.set(request_id)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+        response.headers["X-Request-ID"] = request_id
+
+        route = request.scope.get("route")
+        route_path = route.path if route else request.url.path
+        if response.status_code >= 500 or should_sample(route_path):
+            extra = {
+                "method": request.method,
+                "route": route_path,
+                "status": response.status_code,
+                "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+            }
+            if logger.isEnabledFor(logging.DEBUG):
+                extra["headers"] = redact_headers(request.headers)
+            logger.info("request", extra=extra)
+        return response
+    except Exception:
+        logger.exception("Unhandled error for %s %s", request.method, request.url.path)
+        raise
+    finally:
+        request_id_var.reset(token)
 
 
 class Priority(IntEnum):
@@ -93,6 +163,14 @@ class UserInDB(User):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    expires_in: int = Field(..., description="Seconds until the access token expires")
+    refresh_token: str = Field(
+        ..., description="Single-use token for /api/token/refresh"
+    )
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 
 class TokenData(BaseModel):
@@ -102,7 +180,7 @@ class TokenData(BaseModel):
 # Todo models with user relationship
 class TodoBase(BaseModel):
     title: str = Field(..., min_length=3, max_length=512)
-    description: Optional[str] = Field(None)
+    description: Optional[str] = Field(None, max_length=MAX_DESCRIPTION_LENGTH)
     completed: bool = Field(False)
     priority: Optional[Priority] = Field(None)
     area: Optional[TodoArea] = Field(None)
@@ -111,7 +189,7 @@ class TodoBase(BaseModel):
 
 class TodoCreate(BaseModel):
     title: str = Field(..., min_length=3, max_length=512)
-    description: Optional[str] = Field(None)
+    description: Optional[str] = Field(None, max_length=MAX_DESCRIPTION_LENGTH)
     completed: bool = Field(False)
     priority: Optional[Priority] = Field(None)
     area: Optional[TodoArea] = Field(None)
@@ -119,6 +197,8 @@ class TodoCreate(BaseModel):
 
 
 class Todo(TodoCreate):
+    # Todos stored before descriptions were limited may be longer
+    description: Optional[str] = Field(None)
     id: int = Field(..., description="Unique identifier of the todo")
     user_id: int = Field(..., description="ID of the user who owns this todo")
     created_at: datetime = Field(default_factory=datetime.now)
@@ -130,26 +210,133 @@ class Todo(TodoCreate):
 
 class TodoUpdate(BaseModel):
     title: Optional[str] = Field(None, min_length=3, max_length=512)
-    description: Optional[str] = Field(None)
+    description: Optional[str] = Field(None, max_length=MAX_DESCRIPTION_LENGTH)
     completed: Optional[bool] = Field(None)
     priority: Optional[Priority] = Field(None)
     area: Optional[TodoArea] = Field(None)
     deadline: Optional[date] = Field(None)
 
 
+class TodoBatchCreate(BaseModel):
+    todos: List[TodoCreate] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
+    ordered: bool = Field(
+        False, description="Stop at the first failing item; the rest are skipped"
+    )
+
+
+class TodoBatchUpdateItem(TodoUpdate):
+    id: int = Field(..., description="ID of the todo to update")
+
+
+class TodoBatchUpdate(BaseModel):
+    todos: List[TodoBatchUpdateItem] = Field(
+        ..., min_length=1, max_length=MAX_BATCH_SIZE
+    )
+    ordered: bool = Field(
+        False,
+        description="Stop at the first item that fails or is not found; the "
+        "rest are skipped",
+    )
+
+
+class TodoBatchDelete(BaseModel):
+    ids: List[int] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
+    ordered: bool = Field(
+        False,
+        description="Stop at the first item that fails or is not found; the "
+        "rest are skipped",
+    )
+
+
+class BatchItemResult(BaseModel):
+    index: int
+    id: Optional[int] = None
+    status: str = Field(
+        ..., description="created, updated, deleted, not_found, error or skipped"
+    )
+    detail: Optional[str] = None
+    todo: Optional[Todo] = None
+
+
+class BatchResult(BaseModel):
+    results: List[BatchItemResult]
+
+
+class ImportLineError(BaseModel):
+    line: int
+    detail: str
+
+
+class ImportResult(BaseModel):
+    imported: int
+    failed: int
+    errors: List[ImportLineError] = Field(
+        ..., description=f"The first {MAX_IMPORT_ERRORS} failing lines"
+    )
+
+
+class TodoChanges(BaseModel):
+    todos: List[Todo]
+    deleted: List[int] = Field(..., description="IDs of todos deleted since then")
+    next_token: str = Field(..., description="Pass as since on the next sync")
+    full_resync: bool = Field(
+        ...,
+        description="True when todos is the full list and local state must be replaced",
+    )
+
+
+class TodoStats(BaseModel):
+    total: int
+    completed: int
+    open: int
+    overdue: int = Field(..., description="Open todos whose deadline has passed")
+    by_area: Dict[str, int] = Field(..., description="Todo count per area or none")
+    by_priority: Dict[str, int] = Field(
+        ..., description="Todo count per priority value or none"
+    )
+
+
+class CalendarDay(BaseModel):
+    date: date
+    count: int
+    completed: int
+    todos: Optional[List[Todo]] = Field(None, description="Omitted with counts_only")
+
+
+class Calendar(BaseModel):
+    days: List[CalendarDay] = Field(..., description="Days with at least one todo")
+
+
+class DueTodos(BaseModel):
+    overdue: List[Todo] = Field(..., description="Open todos due before today")
+    upcoming: List[Todo] = Field(..., description="Open todos due from today on")
+
+
+class SortField(str, Enum):
+    PRIORITY = "priority"
+    DEADLINE = "deadline"
+    CREATED_AT = "created_at"
+    UPDATED_AT = "updated_at"
+
+
 class TodoFilter(BaseModel):
-    area: Optional[TodoArea] = Field(None)
-    deadline: Optional[date] = Field(None)
-    sort_by_deadline: Optional[bool] = Field(
-        False, description="Sort todos by deadline"
+    completed: Optional[bool] = Field(None)
+    priority: Optional[List[Priority]] = Field(None, description="Any of these")
+    area: Optional[List[TodoArea]] = Field(None, description="Any of these")
+    deadline: Optional[date] = Field(None, description="Due on this day")
+    deadline_from: Optional[date] = Field(None, description="Due on or after")
+    deadline_to: Optional[date] = Field(None, description="Due on or before")
+    sort_by: Optional[SortField] = Field(
+        None, description="Sort field, ties broken by id; unset todos sort last"
     )
+    descending: bool = Field(False)
 
 
-def authenticate_user(username: str, password: str):
-    user = get_user(username)
+async def authenticate_user(username: str, password: str):
+    user = await store.get_user(username)
     if not user:
         return False
-    if not verify_password(password, user["hashed_password"]):
+    if not await verify_password(password, user["hashed_password"]):
         return False
     return user
 
@@ -161,16 +348,59 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    with JWT_SECONDS.labels("encode").time():
+        encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    try:
+        return await password_hasher.verify(plain_password, hashed_password)
+    except HasherBusy:
+        raise password_hasher_busy()
+
+
+async def get_password_hash(password):
+    try:
+        return await password_hasher.hash(password)
+    except HasherBusy:
+        raise password_hasher_busy()
+
+
+def password_hasher_busy():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, please try again",
+        headers={"Retry-After": "1"},
+    )
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+def token_subject(token: str) -> Optional[str]:
+    """Username of a valid, unexpired access token, or None"""
+    username = principal_cache.get_username(token)
+    if username is not None:
+        return username
+    try:
+        with JWT_SECONDS.labels("decode").time():
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    username = payload.get("sub")
+    session = payload.get("sid")
+    if username is None or principal_cache.session_revoked(session):
+        return None
+    token_data = TokenData(username=username)
+    principal_cache.put_token(
+        token, token_data.username, payload.get("exp", 0), session
+    )
+    return token_data.username
+
+
+def revoke_session(family: str) -> None:
+    """Refuse the access tokens of a logged out session in this worker"""
+    principal_cache.revoke_session(
+        family, time.time() + ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    )
 
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
@@ -179,54 +409,99 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
+    username = token_subject(token)
+    if username is None:
         raise credentials_exception
-    user = get_user(username=token_data.username)
+    user = principal_cache.get_user(username)
     if user is None:
-        raise credentials_exception
+        user = await store.get_user(username=username)
+        if user is None:
+            raise credentials_exception
+        principal_cache.put_user(user)
     return user
 
 
 # Auth endpoints
 @app.post("/api/register", response_model=User)
 async def register(user: UserCreate):
-    if get_user(user.username):
+    if await store.get_user(user.username):
         raise HTTPException(status_code=400, detail="Username already registered")
 
-    # Get the current number of users to generate a new ID
-    users_count = users_collection.count_documents({})
     db_user = {
-        "id": users_count + 1,  # Generate a new ID based on user count
+        "id": await store.next_user_id(),
         "email": user.email,
         "username": user.username,
-        "hashed_password": get_password_hash(user.password),
+        "hashed_password": await get_password_hash(user.password),
         "is_active": True,
         "created_at": datetime.now(),
     }
-    created_user = create_user(db_user)
+    created_user = await store.create_user(db_user)
     return created_user
 
 
 @app.post("/api/token", response_model=Token)
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    return await issue_tokens(user)
+
+
+async def issue_tokens(user: dict, family: Optional[str] = None) -> dict:
+    """Access token plus the next refresh token of the session ``family``"""
+    refresh_token, record = refresh_tokens.issue(user, datetime.now(), family)
+    await store.create_refresh_token(record)
     access_token = create_access_token(
-        data={"sub": user["username"]}, expires_delta=access_token_expires
+        data={"sub": user["username"], "sid": record["family"]},
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+        "refresh_token": refresh_token,
+    }
+
+
+@app.post("/api/token/refresh", response_model=Token)
+async def refresh_access_token(body: RefreshRequest):
+    """Trade a refresh token for a new access and refresh token, no password"""
+    now = datetime.now()
+    record = await store.use_refresh_token(
+        refresh_tokens.hash_token(body.refresh_token), now
+    )
+    if record is not None and record.get("used_at") is not None:
+        # Replayed: whoever holds the family's latest token is logged out too
+        logger.warning(
+            "Refresh token reused, revoking session of %s", record["username"]
+        )
+        await store.revoke_refresh_tokens(record["family"])
+        revoke_session(record["family"])
+        record = None
+    if record is None or record["expires_at"] <= now:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired refresh token",
+        )
+    return await issue_tokens(
+        {"id": record["user_id"], "username": record["username"]}, record["family"]
+    )
+
+
+@app.post("/api/token/revoke", status_code=status.HTTP_204_NO_CONTENT)
+async def revoke_refresh_token(body: RefreshRequest):
+    """Log out: end the session the refresh token belongs to"""
+    record = await store.use_refresh_token(
+        refresh_tokens.hash_token(body.refresh_token), datetime.now()
+    )
+    if record is not None:
+        await store.revoke_refresh_tokens(record["family"])
+        revoke_session(record["family"])
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
 @app.post("/api/forgot-password")
@@ -240,104 +515,463 @@ async def forgot_password(email: str):
 
 
 # Updated todo endpoints to include user authentication
+def new_todo_data(todo: TodoCreate, todo_id: int, user_id: int) -> dict:
+    now = datetime.now()
+    return {
+        "id": todo_id,
+        "user_id": user_id,
+        **todo.dict(),
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def todo_update_data(todo_update: TodoUpdate) -> dict:
+    # Convert the update data to a dict, including the completed field
+    update_data = todo_update.dict(exclude_unset=True, exclude={"id"})
+
+    # Handle priority conversion if present
+    if "priority" in update_data and update_data["priority"] is not None:
+        update_data["priority"] = update_data["priority"].value
+
+    # Ensure completed is a boolean
+    if "completed" in update_data:
+        update_data["completed"] = bool(update_data["completed"])
+
+    update_data["updated_at"] = datetime.now()
+    return update_data
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header matches a strong entity tag
+
+    The header is ``*`` or a comma separated list of tags, weak ones
+    prefixed with ``W/``; If-None-Match compares them weakly.
+    """
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
 @app.post("/api/todos", response_model=Todo)
 async def create_todo_endpoint(
     todo: TodoCreate, current_user: dict = Depends(get_current_user)
 ):
-    new_todo_id = len(get_user_todos(current_user["id"])) + 1
-    new_todo = {
-        "id": new_todo_id,
-        "user_id": current_user["id"],
-        **todo.dict(),
-        "created_at": datetime.now(),
-        "updated_at": datetime.now(),
-    }
-    created_todo = create_todo(new_todo)
+    new_todo = new_todo_data(
+        todo, await store.next_todo_id(current_user["id"]), current_user["id"]
+    )
+    created_todo = await store.create_todo(new_todo)
     return created_todo
 
 
 @app.get("/api/todos", response_model=List[Todo])
 async def list_todos(
+    request: Request,
     current_user: dict = Depends(get_current_user),
-    area: Optional[TodoArea] = None,
+    completed: Optional[bool] = None,
+    priority: Annotated[Optional[List[Priority]], Query()] = None,
+    area: Annotated[Optional[List[TodoArea]], Query()] = None,
     deadline: Optional[date] = None,
+    deadline_from: Optional[date] = None,
+    deadline_to: Optional[date] = None,
+    sort_by: Optional[SortField] = None,
+    descending: bool = False,
     sort_by_deadline: bool = False,
+    limit: Annotated[Optional[int], Query(ge=1, le=MAX_PAGE_SIZE)] = None,
+    cursor: Optional[str] = None,
 ):
-    # Always include user_id in the query
-    query = {"user_id": current_user["id"]}
-
-    # Add area filter if provided
-    if area:
-        query["area"] = area.value
-
-    # Add deadline filter if provided
-    if deadline:
-        deadline_date = datetime.combine(deadline, datetime.min.time())
-        query["deadline"] = {
-            "$gte": deadline_date,
-            "$lt": datetime.combine(deadline, datetime.max.time()),
-        }
-
-    # Get todos from database with the query
-    todos = get_user_todos(current_user["id"], query)
-
-    # Sort by deadline if requested
-    if sort_by_deadline:
-        todos.sort(key=lambda x: x.get("deadline", datetime.max) or datetime.max)
+    """List todos, optionally filtered, sorted and one page at a time
+
+    ``priority`` and ``area`` may be repeated to match any of the values.
+    ``sort_by_deadline`` is short for ``sort_by=deadline``. Pass ``limit``
+    to page through the list, newest updated first unless ``sort_by`` is
+    given. When more todos follow, the response carries an
+    ``X-Next-Cursor`` header to send back as ``cursor``. Responses carry an
+    ``ETag`` of their body; a request whose ``If-None-Match`` still matches
+    gets an empty 304. The tag is hashed from the body, so a 304 only saves
+    sending it; the todos are read and encoded all the same.
+    """
+    if deadline_from and deadline_to and deadline_to < deadline_from:
+        raise HTTPException(
+            status_code=400, detail="deadline_to must not be before deadline_from"
+        )
+    paged = bool(limit or cursor)
+    if sort_by is None and sort_by_deadline:
+        sort_by = SortField.DEADLINE
+    elif sort_by is None and paged:
+        sort_by, descending = SortField.UPDATED_AT, True
+    todo_filter = TodoFilter(
+        completed=completed,
+        priority=priority,
+        area=area,
+        deadline=deadline,
+        deadline_from=deadline_from,
+        deadline_to=deadline_to,
+        sort_by=sort_by,
+        descending=descending,
+    )
+    query = todo_query.build(current_user["id"], todo_filter)
+
+    # Filtered, sorted and paged by the storage backend
+    headers = {}
+    if paged:
+        try:
+            after = decode_cursor(cursor) if cursor else None
+            todos, next_position = await store.get_todos_page(
+                current_user["id"], query, limit, after
+            )
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if next_position is not None:
+            headers["X-Next-Cursor"] = encode_cursor(next_position)
+        body = encode_todos(todos)
+    else:
 
-    # Convert datetime back to date for response
-    for todo in todos:
-        if isinstance(todo.get("deadline"), datetime):
-            todo["deadline"] = todo["deadline"].date()
+        async def load() -> bytes:
+            if query.sort is not None:
+                todos, _ = await store.get_todos_page(current_user["id"], query)
+            else:
+                todos = await store.get_user_todos(current_user["id"], query.filter)
+            return encode_todos(todos)
+
+        body = await result_cache.get_or_load(
+            current_user["id"],
+            "list",
+            {"filter": query.filter, "sort": query.sort},
+            load,
+        )
 
-    return todos
+    # Hashed from what is sent, so a body served from a worker's cache
+    # always carries its own tag
+    tag = hashlib.sha1(body)
+    tag.update(headers.get("X-Next-Cursor", "").encode())
+    etag = '"%s"' % tag.hexdigest()
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+        )
+    headers["ETag"] = etag
+    return TodoListResponse(body, headers=headers)
 
 
 @app.get("/api/todos/search", response_model=List[Todo])
 async def search_todos_endpoint(
     current_user: dict = Depends(get_current_user),
     query: str = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = 50,
 ):
-    """Search todos by title or description"""
-    try:
-        print(f"=== Search Request ===")
-        print(f"Query: {query}")
-        print(f"User ID: {current_user['id']}")
+    """Search todos by words or word prefixes, best matches first
 
-        # If no query provided, return all todos
+    Without a query the ``limit`` most recently updated todos are returned.
+    """
+    try:
         if not query:
-            return await list_todos(current_user=current_user)
-
-        # Build the search query
-        search_query = {
-            "user_id": current_user["id"],
-            "$or": [
-                {"title": {"$regex": query, "$options": "i"}},
-                {"description": {"$regex": query, "$options": "i"}},
-            ],
+            recent = todo_query.build(
+                current_user["id"],
+                TodoFilter(sort_by=SortField.UPDATED_AT, descending=True),
+            )
+            todos, _ = await store.get_todos_page(current_user["id"], recent, limit)
+            return TodoListResponse(todos)
+
+        # Look the words up in the search index
+        todos = await store.search_todos(query, current_user["id"], limit)
+        return TodoListResponse(todos)
+    except Exception as e:
+        logger.exception("Error in search endpoint")
+        raise HTTPException(status_code=500, detail=f"Failed to search todos: {str(e)}")
+
+
+@app.get("/api/todos/changes", response_model=TodoChanges)
+async def get_todo_changes_endpoint(
+    current_user: dict = Depends(get_current_user),
+    since: Optional[str] = None,
+):
+    """Todos changed and deleted since the ``next_token`` of the last sync
+
+    Without ``since``, or when it is older than the tombstone retention,
+    the full list is returned with ``full_resync`` set.
+    """
+    sync_started = datetime.now()
+    changed_since = None
+    if since:
+        try:
+            changed_since = decode_cursor(since).get("t")
+        except InvalidCursor:
+            changed_since = None
+        if not isinstance(changed_since, datetime):
+            raise HTTPException(status_code=400, detail="Invalid sync token")
+    retention_start = sync_started - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+
+    if changed_since is None or changed_since < retention_start:
+        todos, deleted = await store.get_user_todos(current_user["id"]), []
+        full_resync = True
+    else:
+        todos, deleted = await store.get_todo_changes(current_user["id"], changed_since)
+        full_resync = False
+    return ORJSONResponse(
+        {
+            "todos": [todo_to_json(todo) for todo in todos],
+            "deleted": deleted,
+            "next_token": encode_cursor({"t": sync_started - SYNC_CLOCK_SKEW}),
+            "full_resync": full_resync,
         }
+    )
 
-        # Get todos from database with the query
-        todos = get_user_todos(current_user["id"], search_query)
 
-        # Convert datetime back to date for response
-        for todo in todos:
-            if isinstance(todo.get("deadline"), datetime):
-                todo["deadline"] = todo["deadline"].date()
+@app.get("/api/todos/events")
+async def todo_events(current_user: dict = Depends(get_current_user)):
+    """Server-Sent Events stream of the user's todo changes
 
-        print(f"=== Search Complete ===")
-        print(f"Found {len(todos)} matching todos")
-        return todos
-    except Exception as e:
-        print(f"Error in search endpoint: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to search todos: {str(e)}")
+    Sends ``ready`` with a sync token first; passing it as ``since`` to
+    /api/todos/changes fills the gap before the stream started. Then
+    ``created``, ``updated`` and ``deleted`` events follow, with a comment
+    line every EVENTS_HEARTBEAT_SECONDS when idle. ``resync`` means the
+    client fell behind and the stream ends.
+    """
+    ready = events.frame(
+        "ready",
+        {"sync_token": encode_cursor({"t": datetime.now() - SYNC_CLOCK_SKEW})},
+    )
+
+    async def stream():
+        # Subscribed only once the response is being sent, so a stream that
+        # never starts cannot leave its subscription behind
+        subscription = events.event_broker.subscribe(current_user["id"])
+        try:
+            async for message in events.event_broker.stream(
+                subscription, ready, events.EVENTS_HEARTBEAT_SECONDS
+            ):
+                yield message
+        finally:
+            events.event_broker.unsubscribe(current_user["id"], subscription)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/todos/stats", response_model=TodoStats)
+async def get_todo_stats_endpoint(
+    current_user: dict = Depends(get_current_user),
+    reconcile: bool = False,
+):
+    """Dashboard counts from the user's summary document
+
+    ``reconcile=true`` recomputes the summary from the todos first.
+    """
+    if reconcile:
+        summary = await store.rebuild_todo_stats(current_user["id"])
+    else:
+        summary = await store.get_todo_stats(current_user["id"])
+    return stats.summarize(summary, date.today())
+
+
+@app.get("/api/todos/calendar", response_model=Calendar)
+async def get_todo_calendar_endpoint(
+    from_: Annotated[date, Query(alias="from")],
+    to: date,
+    counts_only: bool = False,
+    current_user: dict = Depends(get_current_user),
+):
+    """Todos due between ``from`` and ``to`` (inclusive), grouped by day"""
+    if to < from_:
+        raise HTTPException(status_code=400, detail="to must not be before from")
+    if (to - from_).days >= MAX_CALENDAR_DAYS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Calendar range is limited to {MAX_CALENDAR_DAYS} days",
+        )
+
+    async def load() -> bytes:
+        days = await store.get_todo_calendar(current_user["id"], from_, to, counts_only)
+        for day in days:
+            for todo in day.get("todos", ()):
+                todo_to_json(todo)
+        return orjson.dumps({"days": [{"date": day.pop("_id"), **day} for day in days]})
+
+    body = await result_cache.get_or_load(
+        current_user["id"],
+        "calendar",
+        {"from": from_, "to": to, "counts_only": counts_only},
+        load,
+    )
+    return Response(body, media_type="application/json")
+
+
+@app.get("/api/todos/due", response_model=DueTodos)
+async def get_due_todos_endpoint(
+    within: Annotated[int, Query(ge=0, le=MAX_CALENDAR_DAYS)] = 7,
+    current_user: dict = Depends(get_current_user),
+):
+    """Open todos that are overdue or due in the next ``within`` days
+
+    Both lists are sorted by deadline, then priority (high first).
+    """
+    today = date.today()
+
+    async def load() -> bytes:
+        todos = await store.get_due_todos(
+            current_user["id"], today + timedelta(days=within + 1)
+        )
+        due = {"overdue": [], "upcoming": []}
+        for todo in map(todo_to_json, todos):
+            due["overdue" if todo["deadline"] < today else "upcoming"].append(todo)
+        return orjson.dumps(due)
+
+    body = await result_cache.get_or_load(
+        current_user["id"], "due", {"today": today, "within": within}, load
+    )
+    return Response(body, media_type="application/json")
+
+
+@app.post("/api/todos/batch", response_model=BatchResult)
+async def create_todos_batch(
+    batch: TodoBatchCreate, current_user: dict = Depends(get_current_user)
+):
+    """Create several todos with one counter round trip and one bulk write"""
+    todo_ids = await store.reserve_todo_ids(current_user["id"], len(batch.todos))
+    new_todos = [
+        new_todo_data(todo, todo_id, current_user["id"])
+        for todo, todo_id in zip(batch.todos, todo_ids)
+    ]
+    documents, statuses = await store.create_todos(new_todos, batch.ordered)
+    results = []
+    for index, (document, (status_, detail)) in enumerate(zip(documents, statuses)):
+        if isinstance(document.get("deadline"), datetime):
+            document["deadline"] = document["deadline"].date()
+        results.append(
+            {
+                "index": index,
+                "id": document["id"],
+                "status": status_,
+                "detail": detail,
+                "todo": document if status_ == "created" else None,
+            }
+        )
+    return {"results": results}
+
+
+@app.patch("/api/todos/batch", response_model=BatchResult)
+async def update_todos_batch(
+    batch: TodoBatchUpdate, current_user: dict = Depends(get_current_user)
+):
+    """Update several todos with one bulk write"""
+    updates = [(item.id, todo_update_data(item)) for item in batch.todos]
+    statuses = await store.update_todos(current_user["id"], updates, batch.ordered)
+    return {
+        "results": [
+            {"index": index, "id": item.id, "status": status_, "detail": detail}
+            for index, (item, (status_, detail)) in enumerate(
+                zip(batch.todos, statuses)
+            )
+        ]
+    }
+
+
+@app.delete("/api/todos/batch", response_model=BatchResult)
+async def delete_todos_batch(
+    batch: TodoBatchDelete, current_user: dict = Depends(get_current_user)
+):
+    """Delete several todos with one bulk write"""
+    statuses = await store.delete_todos(current_user["id"], batch.ids, batch.ordered)
+    return {
+        "results": [
+            {"index": index, "id": todo_id, "status": status_, "detail": detail}
+            for index, (todo_id, (status_, detail)) in enumerate(
+                zip(batch.ids, statuses)
+            )
+        ]
+    }
+
+
+@app.get("/api/todos/export")
+async def export_todos(current_user: dict = Depends(get_current_user)):
+    """Stream every todo as NDJSON, one todo per line"""
+    return StreamingResponse(
+        ndjson.stream_todos(store.iter_user_todos(current_user["id"])),
+        media_type=ndjson.MEDIA_TYPE,
+        headers={"Content-Disposition": 'attachment; filename="todos.ndjson"'},
+    )
+
+
+@app.post("/api/todos/import", response_model=ImportResult)
+async def import_todos(
+    request: Request, current_user: dict = Depends(get_current_user)
+):
+    """Create todos from an NDJSON body, one TodoCreate per line
+
+    Lines are inserted in batches of MAX_BATCH_SIZE as the body arrives; a
+    line that fails validation or insertion is reported and skipped.
+    """
+    imported = 0
+    errors: List[dict] = []
+    failed = 0
+
+    def fail(line_number: int, detail: str) -> None:
+        nonlocal failed
+        failed += 1
+        if len(errors) < MAX_IMPORT_ERRORS:
+            errors.append({"line": line_number, "detail": detail})
+
+    async def flush(pending: List[tuple]) -> None:
+        nonlocal imported
+        todo_ids = await store.reserve_todo_ids(current_user["id"], len(pending))
+        new_todos = [
+            new_todo_data(todo, todo_id, current_user["id"])
+            for (_, todo), todo_id in zip(pending, todo_ids)
+        ]
+        _, statuses = await store.create_todos(new_todos)
+        for (line_number, _), (status_, detail) in zip(pending, statuses):
+            if status_ == "created":
+                imported += 1
+            else:
+                fail(line_number, detail or status_)
+
+    pending: List[tuple] = []
+    async for line_number, line in ndjson.iter_lines(
+        request.stream(), MAX_IMPORT_LINE_BYTES
+    ):
+        if line is None:
+            fail(line_number, f"Line is longer than {MAX_IMPORT_LINE_BYTES} bytes")
+            continue
+        try:
+            pending.append((line_number, TodoCreate.model_validate_json(line)))
+        except ValidationError as e:
+            fail(
+                line_number,
+                "; ".join(
+                    (
+                        ".".join(str(part) for part in error["loc"])
+                        + ": "
+                        + error["msg"]
+                        if error["loc"]
+                        else error["msg"]
+                    )
+                    for error in e.errors()
+                ),
+            )
+            continue
+        if len(pending) >= MAX_BATCH_SIZE:
+            await flush(pending)
+            pending = []
+    if pending:
+        await flush(pending)
+    return {"imported": imported, "failed": failed, "errors": errors}
 
 
 @app.get("/api/todos/{todo_id}", response_model=Todo)
 async def get_todo_endpoint(
     todo_id: int, current_user: dict = Depends(get_current_user)
 ):
-    todo = get_todo(todo_id, current_user["id"])
+    todo = await store.get_todo(todo_id, current_user["id"])
     if not todo:
         raise HTTPException(status_code=404, detail="Todo not found")
     # Convert datetime back to date for response
@@ -352,26 +986,10 @@ async def update_todo_endpoint(
     todo_update: TodoUpdate,
     current_user: dict = Depends(get_current_user),
 ):
-    # First get the todo to ensure it belongs to the current user
-    todo = get_todo(todo_id, current_user["id"])
-    if not todo:
-        raise HTTPException(status_code=404, detail="Todo not found")
-
-    # Convert the update data to a dict, including the completed field
-    update_data = todo_update.dict(exclude_unset=True)
-
-    # Handle priority conversion if present
-    if "priority" in update_data and update_data["priority"] is not None:
-        update_data["priority"] = update_data["priority"].value
-
-    # Ensure completed is a boolean
-    if "completed" in update_data:
-        update_data["completed"] = bool(update_data["completed"])
-
-    update_data["updated_at"] = datetime.now()
-
-    # Update the todo
-    updated_todo = update_todo(todo_id, current_user["id"], update_data)
+    # Update the todo; the filter also checks it belongs to the current user
+    updated_todo = await store.update_todo(
+        todo_id, current_user["id"], todo_update_data(todo_update)
+    )
     if not updated_todo:
         raise HTTPException(status_code=404, detail="Todo not found")
 
@@ -385,12 +1003,9 @@ async def update_todo_endpoint(
 async def delete_todo_endpoint(
     todo_id: int, current_user: dict = Depends(get_current_user)
 ):
-    todo = get_todo(todo_id, current_user["id"])
+    todo = await store.delete_todo(todo_id, current_user["id"])
     if not todo:
         raise HTTPException(status_code=404, detail="Todo not found")
-
-    if not delete_todo(todo_id, current_user["id"]):
-        raise HTTPException(status_code=404, detail="Todo not found")
     # Convert datetime back to date for response
     if isinstance(todo.get("deadline"), datetime):
         todo["deadline"] = todo["deadline"].date()
@@ -401,24 +1016,32 @@ async def delete_todo_endpoint(
 async def get_todos_by_deadline_endpoint(
     deadline_date: date, current_user: dict = Depends(get_current_user)
 ):
-    todos = get_todos_by_deadline(deadline_date.isoformat(), current_user["id"])
-    # Convert datetime back to date for response
-    for todo in todos:
-        if isinstance(todo.get("deadline"), datetime):
-            todo["deadline"] = todo["deadline"].date()
-    return todos
+    async def load() -> bytes:
+        return encode_todos(
+            await store.get_todos_by_deadline(
+                deadline_date.isoformat(), current_user["id"]
+            )
+        )
+
+    body = await result_cache.get_or_load(
+        current_user["id"], "deadline", {"date": deadline_date}, load
+    )
+    return TodoListResponse(body)
 
 
 @app.get("/api/todos/area/{area}", response_model=List[Todo])
 async def get_todos_by_area_endpoint(
     area: TodoArea, current_user: dict = Depends(get_current_user)
 ):
-    todos = get_todos_by_area(area.value, current_user["id"])
-    # Convert datetime back to date for response
-    for todo in todos:
-        if isinstance(todo.get("deadline"), datetime):
-            todo["deadline"] = todo["deadline"].date()
-    return todos
+    async def load() -> bytes:
+        return encode_todos(
+            await store.get_todos_by_area(area.value, current_user["id"])
+        )
+
+    body = await result_cache.get_or_load(
+        current_user["id"], "area", {"area": area.value}, load
+    )
+    return TodoListResponse(body)
 
 
 @app.get("/api/users/me", response_model=User)
@@ -426,8 +1049,33 @@ async def read_users_me(current_user: dict = Depends(get_current_user)):
     return current_user
 
 
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    """Liveness: the process is up and serving requests"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    """Readiness: the storage backend answers a ping within READINESS_TIMEOUT_SECONDS"""
+    try:
+        await asyncio.wait_for(store.ping(), READINESS_TIMEOUT_SECONDS)
+    except Exception as e:
+        logger.warning("Readiness check failed: %r", e)
+        return ORJSONResponse(
+            {"status": "unavailable"},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+    return {"status": "ok"}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics of this worker process"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/api/test")
 async def test_endpoint():
     """Test endpoint to verify server connectivity"""
-    print("Test endpoint called")
     return {"message": "Server is working!"}
@@ -0,0 +1,170 @@
+"""Storage backend keeping users and todos in dicts of the worker process.
+
+Meant for tests and local development (STORAGE_BACKEND=memory): there is
+no server to run, but nothing is persisted and every worker has its own
+data, so run a single worker. Stored todos are copied on the way in and
+out, so callers may modify what they get back.
+"""
+
+import operator
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import search
+from backends import TOMBSTONE_RETENTION_DAYS, DuplicateTodo, LocalBackend
+from serializers import TODO_FIELDS
+
+_OPERATORS: Dict[str, Callable[[Any, Any], bool]] = {
+    "$gt": operator.gt,
+    "$gte": operator.ge,
+    "$lt": operator.lt,
+    "$lte": operator.le,
+}
+
+
+def _plain(value):
+    # Enum members compare like the values they were built from
+    return getattr(value, "value", value)
+
+
+def _matches_condition(value, condition) -> bool:
+    if not isinstance(condition, dict):
+        return _plain(value) == _plain(condition)
+    for op, operand in condition.items():
+        if op == "$ne":
+            if _plain(value) == _plain(operand):
+                return False
+        elif op == "$in":
+            if _plain(value) not in [_plain(item) for item in operand]:
+                return False
+        elif op in _OPERATORS:
+            # Like Mongo, a range never matches a missing value
+            if value is None or not _OPERATORS[op](value, operand):
+                return False
+        else:
+            raise ValueError(f"Unsupported query operator {op}")
+    return True
+
+
+def matches(todo: dict, query: Dict[str, Any]) -> bool:
+    """Whether a todo satisfies a Mongo-style filter on Todo fields"""
+    return all(
+        _matches_condition(todo.get(field), condition)
+        for field, condition in query.items()
+    )
+
+
+def _public(todo: dict) -> dict:
+    return {field: todo[field] for field in TODO_FIELDS if field in todo}
+
+
+class MemoryBackend(LocalBackend):
+    def __init__(self):
+        self.users: Dict[str, dict] = {}
+        # user id -> todo id -> stored todo, search terms included
+        self.todos: Dict[int, Dict[int, dict]] = {}
+        # user id -> (deleted_at, todo id) in deletion order
+        self.tombstones: Dict[int, List[Tuple[datetime, int]]] = {}
+        self.sequences: Dict[str, int] = {}
+        self.refresh_tokens: Dict[str, dict] = {}
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def ping(self) -> None:
+        pass
+
+    async def get_user(self, username: str) -> Optional[dict]:
+        user = self.users.get(username)
+        return dict(user) if user is not None else None
+
+    async def _insert_user(self, user: dict) -> None:
+        self.users[user["username"]] = dict(user)
+
+    async def create_refresh_token(self, record: dict) -> None:
+        now = record["created_at"]
+        # Expired tokens are dropped here, as Mongo's TTL index would
+        self.refresh_tokens = {
+            token_hash: stored
+            for token_hash, stored in self.refresh_tokens.items()
+            if stored["expires_at"] > now
+        }
+        self.refresh_tokens[record["token_hash"]] = dict(record)
+
+    async def use_refresh_token(
+        self, token_hash: str, used_at: datetime
+    ) -> Optional[dict]:
+        record = self.refresh_tokens.get(token_hash)
+        if record is None:
+            return None
+        before = dict(record)
+        record["used_at"] = used_at
+        return before
+
+    async def revoke_refresh_tokens(self, family: str) -> None:
+        self.refresh_tokens = {
+            token_hash: record
+            for token_hash, record in self.refresh_tokens.items()
+            if record["family"] != family
+        }
+
+    async def _reserve(self, name: str, count: int) -> range:
+        first = self.sequences.get(name, 0) + 1
+        self.sequences[name] = first + count - 1
+        return range(first, first + count)
+
+    async def _find(self, query: Dict[str, Any]) -> List[dict]:
+        todos = self.todos.get(query["user_id"], {}).values()
+        return [_public(todo) for todo in todos if matches(todo, query)]
+
+    async def _insert(self, todo: dict) -> None:
+        todos = self.todos.setdefault(todo["user_id"], {})
+        if todo["id"] in todos:
+            raise DuplicateTodo(f"Todo {todo['id']} already exists")
+        todos[todo["id"]] = dict(todo)
+
+    async def _update(
+        self, user_id: int, todo_id: int, fields: Dict[str, Any]
+    ) -> Optional[dict]:
+        todo = self.todos.get(user_id, {}).get(todo_id)
+        if todo is None:
+            return None
+        before = _public(todo)
+        todo.update(fields)
+        return before
+
+    async def _delete(self, user_id: int, todo_id: int) -> Optional[dict]:
+        todo = self.todos.get(user_id, {}).pop(todo_id, None)
+        return _public(todo) if todo is not None else None
+
+    async def _search(self, user_id: int, terms: List[str], limit: int) -> List[dict]:
+        found = []
+        for todo in self.todos.get(user_id, {}).values():
+            todo_terms = set(todo.get(search.TITLE_TERMS) or [])
+            todo_terms.update(todo.get(search.DESCRIPTION_TERMS) or [])
+            if todo_terms.issuperset(terms):
+                found.append(_public(todo))
+        found.sort(key=lambda todo: (todo["updated_at"], todo["id"]), reverse=True)
+        return found[:limit]
+
+    async def _add_tombstones(
+        self, user_id: int, todo_ids: List[int], deleted_at: datetime
+    ) -> None:
+        cutoff = deleted_at - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+        tombstones = [
+            tombstone
+            for tombstone in self.tombstones.get(user_id, [])
+            if tombstone[0] >= cutoff
+        ]
+        tombstones.extend((deleted_at, todo_id) for todo_id in todo_ids)
+        self.tombstones[user_id] = tombstones
+
+    async def _deleted_since(self, user_id: int, since: datetime) -> List[int]:
+        return [
+            todo_id
+            for deleted_at, todo_id in self.tombstones.get(user_id, [])
+            if deleted_at >= since
+        ]
@@ -0,0 +1,185 @@
+"""Prometheus metrics for requests, admission, MongoDB commands, bcrypt and JWT.
+
+Served in the Prometheus text format by the /metrics endpoint. Request
+metrics are labelled with the route template (``/api/todos/{todo_id}``), not
+the raw path, to keep the number of series bounded. Every worker process
+exposes its own numbers.
+"""
+
+import threading
+import time
+from typing import Dict, Tuple
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from pymongo import monitoring
+
+REQUESTS = Counter(
+    "taskdo_http_requests_total",
+    "HTTP requests by method, route template and status code",
+    ["method", "route", "status"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "taskdo_http_requests_in_flight", "HTTP requests currently being handled"
+)
+REQUEST_SECONDS = Histogram(
+    "taskdo_http_request_duration_seconds",
+    "HTTP request latency by method and route template",
+    ["method", "route"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+ADMISSION_REJECTED = Counter(
+    "taskdo_admission_rejected_total",
+    "Requests turned away by admission control, by reason (rate or concurrency)",
+    ["reason"],
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    "taskdo_mongodb_command_duration_seconds",
+    "MongoDB command latency by collection and command",
+    ["collection", "command"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "taskdo_mongodb_command_failures_total",
+    "Failed MongoDB commands by collection and command",
+    ["collection", "command"],
+)
+PASSWORD_HASH_SECONDS = Histogram(
+    "taskdo_password_hash_duration_seconds",
+    "bcrypt hash and verify time including queueing for a pool thread",
+    ["operation"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+JWT_SECONDS = Histogram(
+    "taskdo_jwt_duration_seconds",
+    "JWT encode and decode time",
+    ["operation"],
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005),
+)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command the client sends, labelled by collection"""
+
+    def __init__(self):
+        self._collections: Dict[Tuple[object, int], str] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _collection(event: monitoring.CommandStartedEvent) -> str:
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        return target if isinstance(target, str) else "none"
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = (
+                self._collection(event)
+            )
+
+    def _finished(self, event, failed: bool) -> None:
+        with self._lock:
+            collection = self._collections.pop(
+                (event.connection_id, event.request_id), "none"
+            )
+        MONGO_COMMAND_SECONDS.labels(collection, event.command_name).observe(
+            event.duration_micros / 1_000_000
+        )
+        if failed:
+            MONGO_COMMAND_FAILURES.labels(collection, event.command_name).inc()
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finished(event, failed=False)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finished(event, failed=True)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request counts, latency and concurrency"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            # The router stores the matched route in the scope
+            route = scope.get("route")
+            route_path = route.path if route else "unmatched"
+            method = scope["method"]
+            REQUEST_SECONDS.labels(method, route_path).observe(
+                time.perf_counter() - start
+            )
+            REQUESTS.labels(method, route_path, str(status_code)).inc()
+
+
+class StatsCollector:
+    """Exposes the counters kept by the caches and the password hasher"""
+
+    def describe(self):
+        # Registering calls this rather than collect(), which imports the
+        # modules that import this one
+        yield CounterMetricFamily(
+            "taskdo_cache_lookups",
+            "Cache lookups by cache and result",
+            labels=["cache", "result"],
+        )
+        yield GaugeMetricFamily(
+            "taskdo_password_hash_pending", "Password operations running or queued"
+        )
+        yield CounterMetricFamily(
+            "taskdo_password_hash_rejected",
+            "Password operations rejected because the queue was full",
+        )
+
+    def collect(self):
+        from auth_cache import principal_cache
+        from passwords import password_hasher
+        from query_cache import result_cache
+
+        lookups = CounterMetricFamily(
+            "taskdo_cache_lookups",
+            "Cache lookups by cache and result",
+            labels=["cache", "result"],
+        )
+        for name, cache_stats in (
+            ("auth_tokens", principal_cache.tokens.stats()),
+            ("auth_users", principal_cache.users.stats()),
+            ("query_results", result_cache.stats()),
+        ):
+            lookups.add_metric([name, "hit"], cache_stats["hits"])
+            lookups.add_metric([name, "miss"], cache_stats["misses"])
+        yield lookups
+
+        hasher_stats = password_hasher.stats()
+        yield GaugeMetricFamily(
+            "taskdo_password_hash_pending",
+            "Password operations running or queued",
+            value=hasher_stats["pending"],
+        )
+        yield CounterMetricFamily(
+            "taskdo_password_hash_rejected",
+            "Password operations rejected because the queue was full",
+            value=hasher_stats["rejected"],
+        )
+
+
+REGISTRY.register(StatsCollector())
@@ -0,0 +1,536 @@
+"""Versioned index and schema migrations for the taskdo database.
+
+Migrations run in order from the command line, as a release step before
+the workers start, or on application startup with AUTO_MIGRATE=true.
+Runners take a lock document with a lease first, so of several runners one
+applies the migrations while the others wait for it. Workers started
+without AUTO_MIGRATE wait until the database is at the latest version:
+
+    python migrations.py             # apply pending migrations
+    python migrations.py --status    # show the applied version
+    python migrations.py --explain   # verify every query in database.py uses an index
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, ReplaceOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+import search
+import stats
+import storage
+import todo_query
+
+logger = logging.getLogger(__name__)
+
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "false").lower() == "true"
+# How long a worker waits at startup for the release step to migrate
+MIGRATION_WAIT = timedelta(seconds=int(os.getenv("MIGRATION_WAIT_SECONDS", "300")))
+
+MIGRATIONS_COLLECTION = "migrations"
+MIGRATION_LOCK_COLLECTION = "migration_lock"
+# How long the lock is held without being renewed; the lock of a runner
+# that died is taken over after this. It is renewed after each migration.
+MIGRATION_LOCK_LEASE = timedelta(
+    seconds=int(os.getenv("MIGRATION_LOCK_LEASE_SECONDS", "600"))
+)
+MIGRATION_LOCK_POLL_SECONDS = 1.0
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[AsyncIOMotorDatabase], Awaitable[None]]
+
+
+async def _duplicates(collection, key) -> List[dict]:
+    """Groups of documents sharing ``key`` (a field path or an object of them)"""
+    pipeline = [
+        {"$group": {"_id": key, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    return await collection.aggregate(pipeline, allowDiskUse=True).to_list(length=None)
+
+
+async def _check_unique_users(db: AsyncIOMotorDatabase) -> None:
+    # Todos point at their owner by id, so which of two users sharing an id
+    # owns which todo cannot be worked out here
+    duplicates = await _duplicates(db["users"], "$username")
+    duplicates += await _duplicates(db["users"], "$id")
+    if duplicates:
+        shared = ", ".join(repr(group["_id"]) for group in duplicates)
+        raise RuntimeError(
+            f"Users share a username or id ({shared}). Give each of them a "
+            "unique username and id, moving their todos' user_id along, then "
+            "rerun the migrations (python migrations.py)."
+        )
+
+
+async def _renumber_duplicate_todos(db: AsyncIOMotorDatabase) -> None:
+    # Ids used to be the user's todo count plus one, which repeats an id
+    # after any delete. The oldest todo keeps the id and the others get new
+    # ones after the user's highest; migration 2 seeds the counters past them.
+    todos = db["todos"]
+    renumbered = 0
+    for group in await _duplicates(todos, {"user_id": "$user_id", "id": "$id"}):
+        user_id = group["_id"].get("user_id")
+        highest = await todos.find_one(
+            {"user_id": user_id}, sort=[("id", DESCENDING)], projection={"id": 1}
+        )
+        next_id = (highest.get("id") or 0) + 1
+        for document_id in sorted(group["ids"])[1:]:
+            await todos.update_one({"_id": document_id}, {"$set": {"id": next_id}})
+            next_id += 1
+            renumbered += 1
+    if renumbered:
+        logger.warning("Gave %s todos with duplicate ids new ids", renumbered)
+
+
+async def _create_initial_indexes(db: AsyncIOMotorDatabase) -> None:
+    await _check_unique_users(db)
+    await _renumber_duplicate_todos(db)
+    await db["users"].create_index([("username", ASCENDING)], unique=True)
+    await db["users"].create_index([("id", ASCENDING)], unique=True)
+    await db["todos"].create_index(
+        [("user_id", ASCENDING), ("id", ASCENDING)], unique=True
+    )
+    await db["todos"].create_index([("user_id", ASCENDING), ("area", ASCENDING)])
+    await db["todos"].create_index([("user_id", ASCENDING), ("deadline", ASCENDING)])
+
+
+async def _seed_id_counters(db: AsyncIOMotorDatabase) -> None:
+    # Start every sequence after the highest id already handed out so the
+    # counters never collide with ids generated by the old count-based scheme
+    max_user = await db["users"].find_one(sort=[("id", -1)], projection={"id": 1})
+    if max_user:
+        await db["counters"].update_one(
+            {"_id": "users"}, {"$max": {"seq": max_user["id"]}}, upsert=True
+        )
+    async for row in db["todos"].aggregate(
+        [{"$group": {"_id": "$user_id", "max_id": {"$max": "$id"}}}]
+    ):
+        await db["counters"].update_one(
+            {"_id": f"todos:{row['_id']}"},
+            {"$max": {"seq": row["max_id"]}},
+            upsert=True,
+        )
+
+
+async def _create_sort_indexes(db: AsyncIOMotorDatabase) -> None:
+    # Keyset pagination seeks on (deadline, id) and (updated_at, id); the
+    # deadline variant also serves the plain deadline range queries
+    await db["todos"].create_index(
+        [("user_id", ASCENDING), ("deadline", ASCENDING), ("id", ASCENDING)]
+    )
+    await db["todos"].create_index(
+        [("user_id", ASCENDING), ("updated_at", DESCENDING), ("id", DESCENDING)]
+    )
+    if "user_id_1_deadline_1" in await db["todos"].index_information():
+        await db["todos"].drop_index("user_id_1_deadline_1")
+
+
+async def _create_search_index(db: AsyncIOMotorDatabase) -> None:
+    cursor = db["todos"].find(
+        {search.TITLE_TERMS: {"$exists": False}},
+        projection={"title": 1, "description": 1},
+    )
+    batch = []
+    async for todo in cursor:
+        batch.append(
+            UpdateOne(
+                {"_id": todo["_id"]},
+                {
+                    "$set": search.search_fields(
+                        {
+                            "title": todo.get("title"),
+                            "description": todo.get("description"),
+                        }
+                    )
+                },
+            )
+        )
+        if len(batch) == 1000:
+            await db["todos"].bulk_write(batch, ordered=False)
+            batch = []
+    if batch:
+        await db["todos"].bulk_write(batch, ordered=False)
+    await db["todos"].create_index(
+        [("user_id", ASCENDING), (search.TITLE_TERMS, ASCENDING)]
+    )
+    await db["todos"].create_index(
+        [("user_id", ASCENDING), (search.DESCRIPTION_TERMS, ASCENDING)]
+    )
+
+
+async def _create_tombstone_indexes(db: AsyncIOMotorDatabase) -> None:
+    retention_days = int(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))
+    await db["tombstones"].create_index(
+        [("deleted_at", ASCENDING)], expireAfterSeconds=retention_days * 24 * 3600
+    )
+    await db["tombstones"].create_index(
+        [("user_id", ASCENDING), ("deleted_at", ASCENDING)]
+    )
+
+
+async def _build_todo_stats(db: AsyncIOMotorDatabase) -> None:
+    # Summary documents are only ever incremented afterwards, so they must
+    # exist for every user that already has todos
+    async for row in db["todos"].aggregate(
+        [{"$group": {"_id": storage.path("user_id")}}]
+    ):
+        results = (
+            await db["todos"]
+            .aggregate(stats.rebuild_pipeline(row["_id"]))
+            .to_list(length=1)
+        )
+        await db["todo_stats"].replace_one(
+            {"_id": row["_id"]},
+            stats.from_rebuild(row["_id"], results[0] if results else None),
+            upsert=True,
+        )
+
+
+def _compact_indexes() -> List[tuple]:
+    """(keys, options) of the todos indexes on the compact field names"""
+
+    def keys(*fields):
+        return [(storage.key(field), direction) for field, direction in fields]
+
+    return [
+        # Sparse, as documents not rewritten yet have neither field
+        (keys(("user_id", 1), ("id", 1)), {"unique": True, "sparse": True}),
+        (keys(("user_id", 1), ("area", 1)), {}),
+        (keys(("user_id", 1), ("deadline", 1), ("id", 1)), {}),
+        (keys(("user_id", 1), ("updated_at", -1), ("id", -1)), {}),
+        (keys(("user_id", 1), (search.TITLE_TERMS, 1)), {}),
+        (keys(("user_id", 1), (search.DESCRIPTION_TERMS, 1)), {}),
+    ]
+
+
+async def _compact_todos(db: AsyncIOMotorDatabase) -> None:
+    # The new indexes are built before any old one is dropped, so workers
+    # serving meanwhile never query an unindexed collection
+    todos = db["todos"]
+    compact = _compact_indexes()
+    for index, options in compact:
+        await todos.create_index(index, **options)
+    # Rewritten documents lack the long names, so the old unique
+    # (user_id, id) index would see duplicate nulls. It goes now; lookups by
+    # user keep the old (user_id, ...) indexes until the rewrite is done.
+    if "user_id_1_id_1" in await todos.index_information():
+        await todos.drop_index("user_id_1_id_1")
+    # Only documents still using the long names match, so an interrupted
+    # run picks up where it stopped
+    cursor = todos.find({"user_id": {"$exists": True}})
+    batch = []
+    async for todo in cursor:
+        batch.append(ReplaceOne({"_id": todo["_id"]}, storage.encode(todo)))
+        if len(batch) == 1000:
+            await todos.bulk_write(batch, ordered=False)
+            batch = []
+    if batch:
+        await todos.bulk_write(batch, ordered=False)
+    kept = [
+        [(name, int(direction)) for name, direction in index] for index, _ in compact
+    ]
+    for name, info in (await todos.index_information()).items():
+        key = [(field, int(direction)) for field, direction in info["key"]]
+        if name != "_id_" and key not in kept:
+            await todos.drop_index(name)
+    # Area codes changed the grouping keys of the summaries
+    await _build_todo_stats(db)
+
+
+async def _create_refresh_token_indexes(db: AsyncIOMotorDatabase) -> None:
+    await db["refresh_tokens"].create_index([("token_hash", ASCENDING)], unique=True)
+    await db["refresh_tokens"].create_index([("family", ASCENDING)])
+    await db["refresh_tokens"].create_index(
+        [("expires_at", ASCENDING)], expireAfterSeconds=0
+    )
+
+
+async def _create_listing_sort_indexes(db: AsyncIOMotorDatabase) -> None:
+    # The deadline and updated_at sorts are served by migration 7's indexes
+    for index in todo_query.INDEXES:
+        await db["todos"].create_index(storage.sort(index))
+
+
+async def _create_unique_tombstone_index(db: AsyncIOMotorDatabase) -> None:
+    # Overlapping batch deletes used to record a todo's tombstone twice; the
+    # unique index now decides which delete a todo belongs to
+    tombstones = db["tombstones"]
+    for group in await _duplicates(tombstones, {"user_id": "$user_id", "id": "$id"}):
+        await tombstones.delete_many({"_id": {"$in": sorted(group["ids"])[1:]}})
+    await tombstones.create_index(
+        [("user_id", ASCENDING), ("id", ASCENDING)], unique=True
+    )
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "initial users and todos indexes", _create_initial_indexes),
+    Migration(2, "seed id counters from existing ids", _seed_id_counters),
+    Migration(3, "indexes for keyset pagination", _create_sort_indexes),
+    Migration(4, "backfill and index search terms", _create_search_index),
+    Migration(5, "tombstones for delta sync", _create_tombstone_indexes),
+    Migration(6, "build per-user todo stats", _build_todo_stats),
+    Migration(7, "compact todo documents (storage schema 1)", _compact_todos),
+    Migration(8, "refresh token indexes", _create_refresh_token_indexes),
+    Migration(9, "indexes for sorted todo listings", _create_listing_sort_indexes),
+    Migration(10, "one tombstone per deleted todo", _create_unique_tombstone_index),
+]
+
+
+async def get_applied_version(db: AsyncIOMotorDatabase) -> int:
+    """Return the highest migration version recorded in the database"""
+    latest = await db[MIGRATIONS_COLLECTION].find_one(sort=[("_id", -1)])
+    return latest["_id"] if latest else 0
+
+
+async def _take_lock(db: AsyncIOMotorDatabase, owner: str) -> bool:
+    """Take or renew the migration lock; False while another runner holds it"""
+    now = datetime.now()
+    try:
+        await db[MIGRATION_LOCK_COLLECTION].update_one(
+            {
+                "_id": "migrations",
+                "$or": [{"owner": owner}, {"expires_at": {"$lte": now}}],
+            },
+            {"$set": {"owner": owner, "expires_at": now + MIGRATION_LOCK_LEASE}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # The lock exists and matched neither condition
+        return False
+    return True
+
+
+@asynccontextmanager
+async def migration_lock(db: AsyncIOMotorDatabase) -> AsyncIterator[Callable]:
+    """Hold the migration lock, waiting while another runner has it
+
+    Yields a coroutine function renewing the lease, which raises if the
+    lease ran out and another runner took the lock over.
+    """
+    owner = uuid.uuid4().hex
+    if not await _take_lock(db, owner):
+        logger.info("Waiting for another process to finish the migrations")
+        while not await _take_lock(db, owner):
+            await asyncio.sleep(MIGRATION_LOCK_POLL_SECONDS)
+
+    async def renew() -> None:
+        if not await _take_lock(db, owner):
+            raise RuntimeError("Lost the migration lock to another process")
+
+    try:
+        yield renew
+    finally:
+        await db[MIGRATION_LOCK_COLLECTION].delete_one(
+            {"_id": "migrations", "owner": owner}
+        )
+
+
+async def migrate(db: AsyncIOMotorDatabase) -> int:
+    """Apply every pending migration and return the resulting version"""
+    if await get_applied_version(db) >= MIGRATIONS[-1].version:
+        return MIGRATIONS[-1].version
+    async with migration_lock(db) as renew:
+        # Read again under the lock; the previous holder may have applied them
+        return await _apply_pending(db, renew)
+
+
+async def wait_for_migrations(db: AsyncIOMotorDatabase) -> int:
+    """Wait until another process has applied every migration
+
+    Raises if the database is still behind after MIGRATION_WAIT.
+    """
+    latest = MIGRATIONS[-1].version
+    deadline = datetime.now() + MIGRATION_WAIT
+    applied = await get_applied_version(db)
+    if applied < latest:
+        logger.info(
+            "Database is at version %s, waiting for migrations to %s", applied, latest
+        )
+    while applied < latest:
+        if datetime.now() >= deadline:
+            raise RuntimeError(
+                f"Database is at version {applied}, not {latest}. Run the "
+                "migrations (python migrations.py) before starting the workers, "
+                "or set AUTO_MIGRATE=true."
+            )
+        await asyncio.sleep(MIGRATION_LOCK_POLL_SECONDS)
+        applied = await get_applied_version(db)
+    return applied
+
+
+async def _apply_pending(
+    db: AsyncIOMotorDatabase, renew: Callable[[], Awaitable[None]]
+) -> int:
+    applied = await get_applied_version(db)
+    for migration in MIGRATIONS:
+        if migration.version <= applied:
+            continue
+        logger.info(
+            "Applying migration %s: %s", migration.version, migration.description
+        )
+        await migration.apply(db)
+        await db[MIGRATIONS_COLLECTION].update_one(
+            {"_id": migration.version},
+            {
+                "$set": {
+                    "description": migration.description,
+                    "applied_at": datetime.now(),
+                }
+            },
+            upsert=True,
+        )
+        applied = migration.version
+        await renew()
+    return applied
+
+
+def query_shapes(db: AsyncIOMotorDatabase) -> Dict[str, tuple]:
+    """Representative filters for every query issued by database.py"""
+    day = datetime(2024, 1, 1)
+    return {
+        "get_user": (db["users"], {"username": "alice"}),
+        "use_refresh_token": (db["refresh_tokens"], {"token_hash": "0" * 64}),
+        "revoke_refresh_tokens": (db["refresh_tokens"], {"family": "0" * 32}),
+        "get_todo": (db["todos"], {"id": 1, "user_id": 1}),
+        "get_user_todos": (db["todos"], {"user_id": 1}),
+        "get_todos_by_deadline": (
+            db["todos"],
+            {"deadline": {"$gte": day, "$lt": day.replace(hour=23)}, "user_id": 1},
+        ),
+        "get_todos_by_area": (db["todos"], {"area": "work", "user_id": 1}),
+        "get_todo_calendar": (
+            db["todos"],
+            {"user_id": 1, "deadline": {"$gte": day, "$lt": day.replace(day=28)}},
+        ),
+        "get_todo_changes": (
+            db["todos"],
+            {"user_id": 1, "updated_at": {"$gte": day}},
+        ),
+        "get_todo_changes_tombstones": (
+            db["tombstones"],
+            {"user_id": 1, "deleted_at": {"$gte": day}},
+        ),
+        "search_todos": (
+            db["todos"],
+            {"user_id": 1, **search.build_query("buy mi")},
+        ),
+    }
+
+
+def listing_shapes() -> Dict[str, tuple]:
+    """(filter, sort, hint) of each run of a sorted todo listing"""
+    day = datetime(2024, 1, 1)
+    due_sort = todo_query.build_sort("deadline")
+    shapes = {
+        "get_due_todos": (
+            {"user_id": 1, "deadline": {"$lt": day}, "completed": {"$ne": True}},
+            due_sort,
+            todo_query.choose_index(due_sort),
+        )
+    }
+    for field, _ in (index[1] for index in todo_query.INDEXES):
+        for descending in (False, True):
+            sort = todo_query.build_sort(field, descending)
+            query = todo_query.TodoQuery(
+                {
+                    "user_id": 1,
+                    "completed": {"$ne": True},
+                    "priority": {"$in": [1, 2]},
+                    "area": {"$in": ["life", "work"]},
+                    "deadline": {"$gte": day},
+                },
+                sort,
+                todo_query.choose_index(sort),
+            )
+            order = "desc" if descending else "asc"
+            for run, (condition, run_sort) in enumerate(todo_query.split(query, None)):
+                shapes[f"get_todos_page_{field}_{order}_{run}"] = (
+                    {"$and": [query.filter, condition]},
+                    run_sort,
+                    query.index,
+                )
+    return shapes
+
+
+def _plan_stages(plan: dict) -> List[str]:
+    stages = [plan.get("stage", "")]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages.extend(_plan_stages(plan[key]))
+    for child in plan.get("inputStages", []):
+        stages.extend(_plan_stages(child))
+    return stages
+
+
+async def check_query_plans(db: AsyncIOMotorDatabase) -> Dict[str, List[str]]:
+    """Explain each query shape and fail if any of them scans a collection
+
+    Sorted listings must also be read in order from the index they hint.
+    """
+    plans = {}
+    for name, (collection, query) in query_shapes(db).items():
+        if collection.name == "todos":
+            # Shapes are written with Todo field names
+            query = storage.query(query)
+        explain = await collection.find(query).explain()
+        stages = _plan_stages(explain["queryPlanner"]["winningPlan"])
+        plans[name] = stages
+        if "COLLSCAN" in stages:
+            raise RuntimeError(f"{name} does a collection scan: {stages}")
+    for name, (query, sort, index) in listing_shapes().items():
+        explain = await (
+            db["todos"]
+            .find(storage.query(query))
+            .sort(storage.sort(sort))
+            .hint(storage.sort(index))
+            .explain()
+        )
+        stages = _plan_stages(explain["queryPlanner"]["winningPlan"])
+        plans[name] = stages
+        # The hinted index must return the todos in order, without a
+        # blocking in-memory sort
+        if "SORT" in stages or "IXSCAN" not in stages:
+            raise RuntimeError(f"{name} is not sorted by its index: {stages}")
+    return plans
+
+
+async def _main() -> None:
+    parser = argparse.ArgumentParser(description="taskdo database migrations")
+    parser.add_argument("--status", action="store_true", help="show applied version")
+    parser.add_argument(
+        "--explain", action="store_true", help="verify that every query uses an index"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    from database import close, connect
+
+    db = connect()
+    try:
+        if args.status:
+            print(f"Applied version: {await get_applied_version(db)}")
+            print(f"Latest version: {MIGRATIONS[-1].version}")
+            return
+        version = await migrate(db)
+        print(f"Database is at version {version}")
+        if args.explain:
+            for name, stages in (await check_query_plans(db)).items():
+                print(f"{name}: {' <- '.join(stages)}")
+    finally:
+        close()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
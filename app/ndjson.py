@@ -0,0 +1,55 @@
+"""Newline-delimited JSON for streaming todo export and import.
+
+Export writes one todo per line as it is read from the cursor, so memory
+use does not depend on the number of todos. Import reads the request body
+chunk by chunk and hands out one line at a time; a line longer than
+``max_line_bytes`` is reported as None instead of being buffered.
+"""
+
+from typing import AsyncIterable, AsyncIterator, Optional, Tuple
+
+import orjson
+
+from serializers import todo_to_json
+
+MEDIA_TYPE = "application/x-ndjson"
+
+
+def encode_todo(todo: dict) -> bytes:
+    """One NDJSON line for a stored todo"""
+    return orjson.dumps(todo_to_json(todo), option=orjson.OPT_APPEND_NEWLINE)
+
+
+async def stream_todos(todos: AsyncIterable[dict]) -> AsyncIterator[bytes]:
+    """NDJSON body chunks for todos as they arrive"""
+    async for todo in todos:
+        yield encode_todo(todo)
+
+
+async def iter_lines(
+    chunks: AsyncIterable[bytes], max_line_bytes: int
+) -> AsyncIterator[Tuple[int, Optional[bytes]]]:
+    """(line number, line) for every non-blank line of a chunked body
+
+    The line is None when it exceeded ``max_line_bytes``.
+    """
+    buffer = b""
+    line_number = 0
+    oversized = False
+    async for chunk in chunks:
+        *lines, buffer = (buffer + chunk).split(b"\n")
+        for line in lines:
+            line_number += 1
+            if oversized or len(line) > max_line_bytes:
+                oversized = False
+                yield line_number, None
+            elif line.strip():
+                yield line_number, line
+        if len(buffer) > max_line_bytes:
+            # Drop the rest of this line as it arrives
+            oversized = True
+            buffer = b""
+    if oversized:
+        yield line_number + 1, None
+    elif buffer.strip():
+        yield line_number + 1, buffer
@@ -0,0 +1,73 @@
+"""Opaque cursors and keyset filters for paginated todo listings."""
+
+import base64
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+from pymongo import ASCENDING
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    raise TypeError(f"Cannot encode {type(value).__name__} in a cursor")
+
+
+def _decode_value(value: dict) -> Any:
+    if "$dt" in value:
+        decoded = datetime.fromisoformat(value["$dt"])
+        # Stored times are naive UTC and cannot be compared with aware ones
+        if decoded.tzinfo is not None:
+            raise ValueError("time has a timezone")
+        return decoded
+    return value
+
+
+def encode_cursor(position: Dict[str, Any]) -> str:
+    """Encode the sort key of the last returned document as an opaque token"""
+    raw = json.dumps(position, default=_encode_value, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    """Decode a token produced by encode_cursor"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode())
+        position = json.loads(raw, object_hook=_decode_value)
+    except ValueError as e:
+        raise InvalidCursor(f"Invalid cursor: {str(e)}")
+    if not isinstance(position, dict):
+        raise InvalidCursor("Invalid cursor")
+    return position
+
+
+def check_position(sort: List[Tuple[str, int]], position: Dict[str, Any]) -> None:
+    """Raise InvalidCursor unless ``position`` has a value for every sort field"""
+    missing = [field for field, _ in sort if field not in position]
+    if missing:
+        raise InvalidCursor(f"Cursor is missing {', '.join(missing)}")
+
+
+def keyset_filter(sort: List[Tuple[str, int]], position: Dict[str, Any]) -> dict:
+    """Match documents that sort strictly after ``position``
+
+    For a sort on (a, b) this is ``a > x or (a == x and b > y)``, with the
+    comparison flipped for descending fields, so Mongo can seek straight to
+    the page in the matching compound index instead of skipping documents.
+    """
+    try:
+        clauses = []
+        for i, (field, direction) in enumerate(sort):
+            clause = {prefix: position[prefix] for prefix, _ in sort[:i]}
+            op = "$gt" if direction == ASCENDING else "$lt"
+            clause[field] = {op: position[field]}
+            clauses.append(clause)
+    except KeyError as e:
+        raise InvalidCursor(f"Cursor is missing {str(e)}")
+    return {"$or": clauses}
@@ -0,0 +1,83 @@
+"""bcrypt password hashing off the event loop.
+
+Hashing and verifying run in a bounded thread pool; the bcrypt extension
+releases the GIL, so the event loop keeps serving other requests while a
+login is being checked. When more than ``max_workers + max_queue`` calls
+are outstanding new ones fail fast with HasherBusy instead of queueing
+without bound behind a burst of logins.
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+from passlib.context import CryptContext
+
+from metrics import PASSWORD_HASH_SECONDS
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, rounds: int = 12, max_workers: int = 4, max_queue: int = 64):
+        self.context = CryptContext(
+            schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds
+        )
+        self.max_pending = max_workers + max_queue
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="bcrypt"
+        )
+        self._pending = 0
+        self._rejected = 0
+        self._timings: Dict[str, Dict[str, float]] = {
+            operation: {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+            for operation in ("hash", "verify")
+        }
+
+    async def _run(self, operation: str, func: Callable, *args):
+        if self._pending >= self.max_pending:
+            self._rejected += 1
+            raise HasherBusy("Too many password operations in progress")
+        self._pending += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self._pending -= 1
+            elapsed = time.perf_counter() - start
+            timing = self._timings[operation]
+            timing["count"] += 1
+            timing["total_seconds"] += elapsed
+            timing["max_seconds"] = max(timing["max_seconds"], elapsed)
+            PASSWORD_HASH_SECONDS.labels(operation).observe(elapsed)
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", self.context.hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run("verify", self.context.verify, password, hashed_password)
+
+    def stats(self) -> dict:
+        """Call counts and wall time (queueing included) per operation"""
+        return {
+            "pending": self._pending,
+            "rejected": self._rejected,
+            **{operation: dict(timing) for operation, timing in self._timings.items()},
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+password_hasher = PasswordHasher(
+    rounds=int(os.getenv("BCRYPT_ROUNDS", "12")),
+    max_workers=int(
+        os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1)))
+    ),
+    max_queue=int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", "64")),
+)
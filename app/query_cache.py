@@ -0,0 +1,123 @@
+"""Read-through cache for encoded todo list responses.
+
+Entries are keyed by user id, the user's current generation, the endpoint
+and its normalized query parameters. Every write to a user's todos bumps
+that user's generation, so all of their cached results stop matching at
+once, without scanning for keys. The generation is read before a result is
+loaded, so a write that lands during the load also leaves the stored entry
+unreachable.
+
+Backends implement CacheBackend. LRUCacheBackend keeps everything in
+process; with several workers each worker only sees its own invalidations
+and other workers would serve results up to ``ttl`` seconds old, with an
+ETag matching the stale body. The cache is therefore off unless
+QUERY_CACHE_ENABLED=true, which is only safe with a single worker or a
+backend on a shared store (e.g. Redis with INCR for generations) that gives
+exact invalidation across workers.
+"""
+
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Mapping, Optional
+
+from auth_cache import TTLCache
+
+
+class CacheBackend:
+    async def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes) -> None:
+        raise NotImplementedError
+
+    async def get_generation(self, user_id: int) -> int:
+        raise NotImplementedError
+
+    async def bump_generation(self, user_id: int) -> int:
+        raise NotImplementedError
+
+
+class LRUCacheBackend(CacheBackend):
+    def __init__(self, maxsize: int = 1000, ttl: float = 30.0):
+        self.entries = TTLCache(maxsize, ttl)
+        # Generations of the users written to most recently, at most
+        # ``maxsize`` of them. Users without one share ``floor``; forgetting
+        # a generation raises the floor past every generation handed out,
+        # so entries stored under the forgotten one never match again.
+        self.maxsize = maxsize
+        self.generations: "OrderedDict[int, int]" = OrderedDict()
+        self.clock = 0
+        self.floor = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.entries.get(key)
+
+    async def set(self, key: str, value: bytes) -> None:
+        self.entries.set(key, value)
+
+    async def get_generation(self, user_id: int) -> int:
+        return self.generations.get(user_id, self.floor)
+
+    async def bump_generation(self, user_id: int) -> int:
+        self.clock += 1
+        self.generations.pop(user_id, None)
+        self.generations[user_id] = self.clock
+        if len(self.generations) > self.maxsize:
+            self.generations.popitem(last=False)
+            self.clock += 1
+            self.floor = self.clock
+        return self.generations[user_id]
+
+
+class QueryCache:
+    def __init__(self, backend: CacheBackend, enabled: bool = True):
+        self.backend = backend
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    async def get_or_load(
+        self,
+        user_id: int,
+        name: str,
+        params: Mapping[str, object],
+        load: Callable[[], Awaitable[bytes]],
+    ) -> bytes:
+        """Cached result of ``load`` for this user, endpoint and parameters"""
+        if not self.enabled:
+            return await load()
+        generation = await self.backend.get_generation(user_id)
+        normalized = "&".join(
+            f"{key}={params[key]}" for key in sorted(params) if params[key] is not None
+        )
+        key = f"{user_id}:{generation}:{name}:{normalized}"
+        value = await self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = await load()
+        await self.backend.set(key, value)
+        return value
+
+    async def invalidate_user(self, user_id: int) -> None:
+        """Drop every cached result of a user"""
+        if self.enabled:
+            await self.backend.bump_generation(user_id)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+result_cache = QueryCache(
+    LRUCacheBackend(
+        maxsize=int(os.getenv("QUERY_CACHE_SIZE", "1000")),
+        ttl=float(os.getenv("QUERY_CACHE_TTL_SECONDS", "30")),
+    ),
+    enabled=os.getenv("QUERY_CACHE_ENABLED", "false").lower() == "true",
+)
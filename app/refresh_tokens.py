@@ -0,0 +1,44 @@
+"""Long-lived, rotating refresh tokens.
+
+/api/token issues an access token and a refresh token. When the access
+token expires, the client trades the refresh token at /api/token/refresh
+for a new pair instead of sending its password again. That endpoint costs
+one indexed lookup: refresh tokens are 256 random bits, so they are stored
+as a SHA-256 hash, which is safe for high-entropy secrets and much cheaper
+than bcrypt.
+
+Every refresh token is good for one use. Tokens issued from the same login
+share a ``family``; presenting an already used token means it was copied
+or replayed, and the whole family is revoked, logging out both the thief
+and the real client. Logging out revokes the family as well.
+"""
+
+import hashlib
+import os
+import secrets
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+
+
+def hash_token(token: str) -> str:
+    """Key a refresh token is stored and looked up under"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def issue(user: dict, now: datetime, family: Optional[str] = None) -> Tuple[str, dict]:
+    """A new refresh token and the record to store for it
+
+    Without ``family`` the token starts a new session.
+    """
+    token = secrets.token_urlsafe(32)
+    record = {
+        "token_hash": hash_token(token),
+        "family": family or secrets.token_hex(16),
+        "user_id": user["id"],
+        "username": user["username"],
+        "created_at": now,
+        "expires_at": now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    }
+    return token, record
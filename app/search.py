@@ -0,0 +1,108 @@
+"""Tokenized prefix index for todo search.
+
+Every todo stores the prefixes of the words in its title and description in
+``title_terms`` and ``description_terms``. Both arrays are covered by
+multikey ``(user_id, <field>)`` indexes, which act as a per-user inverted
+index: a search-as-you-type query for "buy mi" becomes an exact lookup of
+the terms "buy" and "mi" instead of an unanchored regex over every document.
+"""
+
+import re
+import unicodedata
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+# Longer words are indexed by their first MAX_PREFIX_LENGTH characters only
+MAX_PREFIX_LENGTH = 20
+# Terms indexed per field; bounds the document and index entry size, as
+# every prefix of every word is stored
+MAX_INDEX_TERMS = 2000
+# Upper bound on the matches ranked per search request; the most recently
+# updated matches are the ones ranked, as rank() breaks ties that way too
+CANDIDATE_LIMIT = 1000
+
+TITLE_TERMS = "title_terms"
+DESCRIPTION_TERMS = "description_terms"
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Split text into lowercase words with accents removed"""
+    if not text:
+        return []
+    folded = unicodedata.normalize("NFKD", text.lower())
+    folded = "".join(c for c in folded if not unicodedata.combining(c))
+    return _WORD.findall(folded)
+
+
+def index_terms(text: Optional[str]) -> List[str]:
+    """Every prefix of every word in ``text``, used as index keys
+
+    Only the first MAX_INDEX_TERMS terms are kept, in the order their words
+    appear, so words far into a long text may not be searchable.
+    """
+    terms: Set[str] = set()
+    for word in tokenize(text):
+        word = word[:MAX_PREFIX_LENGTH]
+        for i in range(1, len(word) + 1):
+            if len(terms) == MAX_INDEX_TERMS:
+                return sorted(terms)
+            terms.add(word[:i])
+    return sorted(terms)
+
+
+def search_fields(todo_data: dict) -> Dict[str, List[str]]:
+    """Index fields to store for whichever text fields ``todo_data`` sets"""
+    fields = {}
+    if "title" in todo_data:
+        fields[TITLE_TERMS] = index_terms(todo_data["title"])
+    if "description" in todo_data:
+        fields[DESCRIPTION_TERMS] = index_terms(todo_data["description"])
+    return fields
+
+
+def query_terms(query: str) -> List[str]:
+    """Index terms a todo must have to match, most selective (longest) first"""
+    words = {word[:MAX_PREFIX_LENGTH] for word in tokenize(query)}
+    return sorted(words, key=len, reverse=True)
+
+
+def build_query(query: str) -> Optional[dict]:
+    """Mongo filter requiring every query word as a title or description term"""
+    # Longest words first so the planner probes the most selective ones first
+    words = query_terms(query)
+    if not words:
+        return None
+    return {
+        "$and": [
+            {"$or": [{TITLE_TERMS: word}, {DESCRIPTION_TERMS: word}]} for word in words
+        ]
+    }
+
+
+def _field_score(words: Iterable[str], text_words: List[str], weight: float) -> float:
+    score = 0.0
+    for word in words:
+        if word in text_words:
+            score += 2 * weight
+        elif any(text_word.startswith(word) for text_word in text_words):
+            score += weight
+    return score
+
+
+def score(query: str, todo: dict) -> float:
+    """Relevance of a matching todo: whole words beat prefixes, titles beat descriptions"""
+    words = set(tokenize(query))
+    return _field_score(words, tokenize(todo.get("title")), 3.0) + _field_score(
+        words, tokenize(todo.get("description")), 1.0
+    )
+
+
+def rank(query: str, todos: List[dict], limit: int) -> List[dict]:
+    """Order matching todos by relevance, then by most recently updated"""
+    todos = sorted(
+        todos, key=lambda todo: todo.get("updated_at") or datetime.min, reverse=True
+    )
+    todos.sort(key=lambda todo: score(query, todo), reverse=True)
+    return todos[:limit]
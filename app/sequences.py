@@ -0,0 +1,77 @@
+"""Atomic integer id allocation backed by a counters collection.
+
+Each sequence is a single document ``{"_id": name, "seq": last_issued}``.
+Allocating an id is one ``find_one_and_update`` with ``$inc``, so the cost
+does not depend on how many documents already exist and concurrent callers
+never receive the same id.
+
+With ``block_size > 1`` the allocator reserves a range of ids per round trip
+and hands them out from memory. Ids then stay unique across workers but are
+no longer strictly increasing between them. A block is forgotten once it is
+used up, and at most ``max_blocks`` partly used blocks are kept; the ids
+left in a block dropped from that cache are skipped.
+"""
+
+import asyncio
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+
+
+class SequenceAllocator:
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        block_size: int = 1,
+        max_blocks: int = 10000,
+    ):
+        if block_size < 1:
+            raise ValueError("block_size must be at least 1")
+        self.collection = collection
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        # name -> [next id, end of the block], least recently used first
+        self._blocks: "OrderedDict[str, List[int]]" = OrderedDict()
+        # name -> (lock, callers holding or waiting for it); dropped at 0
+        self._locks: Dict[str, Tuple[asyncio.Lock, List[int]]] = {}
+
+    async def reserve(self, name: str, count: int) -> range:
+        """Atomically reserve ``count`` consecutive ids from a sequence"""
+        counter = await self.collection.find_one_and_update(
+            {"_id": name},
+            {"$inc": {"seq": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        end = counter["seq"] + 1
+        return range(end - count, end)
+
+    async def next_id(self, name: str) -> int:
+        """Return the next id of a sequence"""
+        if self.block_size == 1:
+            return (await self.reserve(name, 1))[0]
+
+        lock, users = self._locks.setdefault(name, (asyncio.Lock(), [0]))
+        users[0] += 1
+        try:
+            async with lock:
+                return await self._next_from_block(name)
+        finally:
+            users[0] -= 1
+            if not users[0]:
+                del self._locks[name]
+
+    async def _next_from_block(self, name: str) -> int:
+        block = self._blocks.pop(name, None)
+        if block is None:
+            ids = await self.reserve(name, self.block_size)
+            block = [ids.start, ids.stop]
+        next_id = block[0]
+        block[0] += 1
+        if block[0] < block[1]:
+            self._blocks[name] = block
+            while len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+        return next_id
@@ -0,0 +1,488 @@
+"""Storage backend on an embedded SQLite database (STORAGE_BACKEND=sqlite).
+
+For single-node deployments that do not want to run MongoDB. The database
+file at SQLITE_PATH is opened in WAL mode, so readers in other processes
+are not blocked by a writer, and several workers on the same host can share
+it; writers wait up to SQLITE_BUSY_TIMEOUT_MS for each other. All statements
+of a worker run on one dedicated thread, keeping the event loop free.
+
+Todos are stored one row each with the filterable fields in indexed
+columns. Listings are sorted, positioned and limited in SQL, each sort
+served by an index on (user_id, field, id). Datetimes are ISO 8601 text with microseconds, so their text
+order is their time order. The search terms live in ``todo_terms``, an
+inverted index from (user_id, term) to todo ids.
+"""
+
+import asyncio
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from pymongo import ASCENDING
+
+import search
+import todo_query
+from backends import TOMBSTONE_RETENTION_DAYS, DuplicateTodo, LocalBackend
+from pagination import check_position, keyset_filter
+from serializers import TODO_FIELDS
+from todo_query import TodoQuery
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", "taskdo.sqlite3")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    email TEXT NOT NULL,
+    hashed_password TEXT NOT NULL,
+    is_active INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS todos (
+    user_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    description TEXT,
+    completed INTEGER NOT NULL DEFAULT 0,
+    priority INTEGER,
+    area TEXT,
+    deadline TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (user_id, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS todos_user_deadline ON todos (user_id, deadline, id);
+CREATE INDEX IF NOT EXISTS todos_user_area ON todos (user_id, area);
+CREATE INDEX IF NOT EXISTS todos_user_updated ON todos (user_id, updated_at, id);
+CREATE INDEX IF NOT EXISTS todos_user_priority ON todos (user_id, priority, id);
+CREATE INDEX IF NOT EXISTS todos_user_created ON todos (user_id, created_at, id);
+CREATE TABLE IF NOT EXISTS todo_terms (
+    user_id INTEGER NOT NULL,
+    term TEXT NOT NULL,
+    todo_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, term, todo_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS todo_terms_todo ON todo_terms (user_id, todo_id);
+CREATE TABLE IF NOT EXISTS tombstones (
+    user_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    deleted_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tombstones_user_deleted ON tombstones (user_id, deleted_at);
+CREATE TABLE IF NOT EXISTS refresh_tokens (
+    token_hash TEXT PRIMARY KEY,
+    family TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    expires_at TEXT NOT NULL,
+    used_at TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS refresh_tokens_family ON refresh_tokens (family);
+CREATE INDEX IF NOT EXISTS refresh_tokens_expires ON refresh_tokens (expires_at);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+);
+"""
+
+TODO_COLUMNS = list(TODO_FIELDS)
+_DATETIME_COLUMNS = ("deadline", "created_at", "updated_at", "expires_at", "used_at")
+_COMPARISONS = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+_CONNECTIVES = {"$and": " AND ", "$or": " OR "}
+
+
+def _to_sql(value):
+    value = getattr(value, "value", value)
+    if isinstance(value, datetime):
+        return value.isoformat(timespec="microseconds")
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def _from_row(row: sqlite3.Row) -> dict:
+    record = dict(row)
+    for column in _DATETIME_COLUMNS:
+        if record.get(column) is not None:
+            record[column] = datetime.fromisoformat(record[column])
+    if "completed" in record:
+        record["completed"] = bool(record["completed"])
+    if "is_active" in record:
+        record["is_active"] = bool(record["is_active"])
+    return record
+
+
+def _column(field: str) -> str:
+    if field not in TODO_COLUMNS:
+        raise ValueError(f"Cannot filter on {field!r}")
+    return field
+
+
+def order_by(sort: List[Tuple[str, int]]) -> str:
+    return ", ".join(
+        f"{_column(field)} {'ASC' if direction == ASCENDING else 'DESC'}"
+        for field, direction in sort
+    )
+
+
+def keyset(
+    sort: List[Tuple[str, int]], position: Dict[str, Any]
+) -> Tuple[str, List[Any]]:
+    """SQL condition matching rows that sort strictly after ``position``
+
+    Listing sorts run one way on every field, which a row value comparison
+    expresses so that SQLite seeks to the position in the index; mixed
+    directions fall back to the expanded form of keyset_filter.
+    """
+    directions = {direction for _, direction in sort}
+    if len(directions) > 1:
+        return where(keyset_filter(sort, position))
+    columns = ", ".join(_column(field) for field, _ in sort)
+    op = ">" if directions == {ASCENDING} else "<"
+    params = [_to_sql(position[field]) for field, _ in sort]
+    marks = ", ".join("?" * len(sort))
+    return f"({columns}) {op} ({marks})", params
+
+
+def where(query: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    """SQL condition and parameters for a Mongo-style filter on Todo fields"""
+    clauses = []
+    params: List[Any] = []
+    for field, condition in query.items():
+        if field in _CONNECTIVES:
+            parts = [where(clause) for clause in condition]
+            joined = _CONNECTIVES[field].join(f"({sql})" for sql, _ in parts)
+            clauses.append(f"({joined})")
+            for _, part_params in parts:
+                params.extend(part_params)
+            continue
+        column = _column(field)
+        if not isinstance(condition, dict):
+            # IS compares NULL like a value, as Mongo's equality does
+            clauses.append(f"{column} IS ?")
+            params.append(_to_sql(condition))
+            continue
+        for op, operand in condition.items():
+            if op == "$ne":
+                clauses.append(f"{column} IS NOT ?")
+                params.append(_to_sql(operand))
+            elif op == "$in":
+                clauses.append(f"{column} IN ({', '.join('?' * len(operand))})")
+                params.extend(_to_sql(item) for item in operand)
+            elif op in _COMPARISONS:
+                clauses.append(f"{column} {_COMPARISONS[op]} ?")
+                params.append(_to_sql(operand))
+            else:
+                raise ValueError(f"Unsupported query operator {op}")
+    return " AND ".join(clauses) or "1", params
+
+
+class SQLiteBackend(LocalBackend):
+    def __init__(self, path: str):
+        self.path = path
+        self.connection: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def _run(self, function: Callable, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(function, *args))
+
+    def _open(self) -> None:
+        connection = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False
+        )
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        # Durable at every checkpoint; WAL keeps the file consistent
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        connection.executescript(SCHEMA)
+        self.connection = connection
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # IMMEDIATE takes the write lock up front, so a read-then-write
+        # cannot interleave with another process's write
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    async def start(self) -> None:
+        if self.connection is not None:
+            return
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="sqlite")
+        await self._run(self._open)
+
+    async def stop(self) -> None:
+        if self.connection is None:
+            return
+        await self._run(self.connection.close)
+        self.connection = None
+        self._executor.shutdown()
+
+    async def ping(self) -> None:
+        if self.connection is None:
+            raise RuntimeError("SQLite database is not open")
+        await self._run(self.connection.execute, "SELECT 1")
+
+    def _select(self, sql: str, params: tuple = ()) -> List[dict]:
+        return [_from_row(row) for row in self.connection.execute(sql, params)]
+
+    async def get_user(self, username: str) -> Optional[dict]:
+        users = await self._run(
+            self._select, "SELECT * FROM users WHERE username = ?", (username,)
+        )
+        return users[0] if users else None
+
+    async def _insert_user(self, user: dict) -> None:
+        columns = [
+            "id",
+            "username",
+            "email",
+            "hashed_password",
+            "is_active",
+            "created_at",
+        ]
+        sql = (
+            f"INSERT INTO users ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))})"
+        )
+        params = tuple(_to_sql(user[column]) for column in columns)
+        await self._run(self.connection.execute, sql, params)
+
+    def _create_refresh_token_sync(self, record: dict) -> None:
+        columns = [
+            "token_hash",
+            "family",
+            "user_id",
+            "username",
+            "created_at",
+            "expires_at",
+        ]
+        with self._transaction() as connection:
+            # Expired tokens are dropped here, as Mongo's TTL index would
+            connection.execute(
+                "DELETE FROM refresh_tokens WHERE expires_at <= ?",
+                (_to_sql(record["created_at"]),),
+            )
+            connection.execute(
+                f"INSERT INTO refresh_tokens ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})",
+                [_to_sql(record[column]) for column in columns],
+            )
+
+    async def create_refresh_token(self, record: dict) -> None:
+        await self._run(self._create_refresh_token_sync, record)
+
+    def _use_refresh_token_sync(
+        self, token_hash: str, used_at: datetime
+    ) -> Optional[dict]:
+        with self._transaction() as connection:
+            records = self._select(
+                "SELECT * FROM refresh_tokens WHERE token_hash = ?", (token_hash,)
+            )
+            connection.execute(
+                "UPDATE refresh_tokens SET used_at = ? WHERE token_hash = ?",
+                (_to_sql(used_at), token_hash),
+            )
+        return records[0] if records else None
+
+    async def use_refresh_token(
+        self, token_hash: str, used_at: datetime
+    ) -> Optional[dict]:
+        return await self._run(self._use_refresh_token_sync, token_hash, used_at)
+
+    async def revoke_refresh_tokens(self, family: str) -> None:
+        await self._run(
+            self.connection.execute,
+            "DELETE FROM refresh_tokens WHERE family = ?",
+            (family,),
+        )
+
+    def _reserve_sync(self, name: str, count: int) -> range:
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO counters (name, seq) VALUES (?, 0)", (name,)
+            )
+            connection.execute(
+                "UPDATE counters SET seq = seq + ? WHERE name = ?", (count, name)
+            )
+            (last,) = connection.execute(
+                "SELECT seq FROM counters WHERE name = ?", (name,)
+            ).fetchone()
+        return range(last - count + 1, last + 1)
+
+    async def _reserve(self, name: str, count: int) -> range:
+        return await self._run(self._reserve_sync, name, count)
+
+    async def _find(self, query: Dict[str, Any]) -> List[dict]:
+        condition, params = where(query)
+        sql = f"SELECT {', '.join(TODO_COLUMNS)} FROM todos WHERE {condition}"
+        return await self._run(self._select, sql, tuple(params))
+
+    def _page_sync(
+        self, query: TodoQuery, fetch: Optional[int], after: Optional[Dict[str, Any]]
+    ) -> List[dict]:
+        todos: List[dict] = []
+        for run, (condition, sort) in enumerate(todo_query.split(query, after)):
+            if fetch is not None and len(todos) >= fetch:
+                break
+            sql_condition, params = where({"$and": [query.filter, condition]})
+            if after is not None and run == 0:
+                # The first run is the one holding the previous page's last todo
+                position, position_params = keyset(sort, after)
+                sql_condition += f" AND {position}"
+                params += position_params
+            sql = (
+                f"SELECT {', '.join(TODO_COLUMNS)} FROM todos "
+                f"WHERE {sql_condition} ORDER BY {order_by(sort)}"
+            )
+            if fetch is not None:
+                sql += " LIMIT ?"
+                params.append(fetch - len(todos))
+            todos += self._select(sql, tuple(params))
+        return todos
+
+    async def get_todos_page(
+        self,
+        user_id: int,
+        query: TodoQuery,
+        limit: Optional[int] = None,
+        after: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[List[dict], Optional[Dict[str, Any]]]:
+        if after is not None:
+            check_position(query.sort, after)
+        fetch = None if limit is None else limit + 1
+        todos = await self._run(self._page_sync, query, fetch, after)
+
+        if limit is None or len(todos) <= limit:
+            return todos, None
+        todos = todos[:limit]
+        return todos, {field: todos[-1].get(field) for field, _ in query.sort}
+
+    def _get(self, user_id: int, todo_id: int) -> Optional[dict]:
+        todos = self._select(
+            f"SELECT {', '.join(TODO_COLUMNS)} FROM todos "
+            "WHERE user_id = ? AND id = ?",
+            (user_id, todo_id),
+        )
+        return todos[0] if todos else None
+
+    def _write_terms(self, user_id: int, todo_id: int, todo: dict) -> None:
+        self.connection.execute(
+            "DELETE FROM todo_terms WHERE user_id = ? AND todo_id = ?",
+            (user_id, todo_id),
+        )
+        terms = set(search.index_terms(todo.get("title")))
+        terms.update(search.index_terms(todo.get("description")))
+        self.connection.executemany(
+            "INSERT INTO todo_terms (user_id, term, todo_id) VALUES (?, ?, ?)",
+            [(user_id, term, todo_id) for term in terms],
+        )
+
+    def _insert_sync(self, todo: dict) -> None:
+        columns = [column for column in TODO_COLUMNS if column in todo]
+        sql = (
+            f"INSERT INTO todos ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))})"
+        )
+        with self._transaction() as connection:
+            try:
+                connection.execute(sql, [_to_sql(todo[column]) for column in columns])
+            except sqlite3.IntegrityError as e:
+                raise DuplicateTodo(f"Todo {todo['id']} already exists: {e}")
+            self._write_terms(todo["user_id"], todo["id"], todo)
+
+    async def _insert(self, todo: dict) -> None:
+        await self._run(self._insert_sync, todo)
+
+    def _update_sync(
+        self, user_id: int, todo_id: int, fields: Dict[str, Any]
+    ) -> Optional[dict]:
+        columns = [column for column in TODO_COLUMNS if column in fields]
+        with self._transaction() as connection:
+            before = self._get(user_id, todo_id)
+            if before is None or not columns:
+                return before
+            connection.execute(
+                f"UPDATE todos SET {', '.join(f'{c} = ?' for c in columns)} "
+                "WHERE user_id = ? AND id = ?",
+                [_to_sql(fields[column]) for column in columns] + [user_id, todo_id],
+            )
+            if "title" in fields or "description" in fields:
+                self._write_terms(user_id, todo_id, {**before, **fields})
+        return before
+
+    async def _update(
+        self, user_id: int, todo_id: int, fields: Dict[str, Any]
+    ) -> Optional[dict]:
+        return await self._run(self._update_sync, user_id, todo_id, fields)
+
+    def _delete_sync(self, user_id: int, todo_id: int) -> Optional[dict]:
+        with self._transaction() as connection:
+            before = self._get(user_id, todo_id)
+            if before is not None:
+                connection.execute(
+                    "DELETE FROM todos WHERE user_id = ? AND id = ?",
+                    (user_id, todo_id),
+                )
+                connection.execute(
+                    "DELETE FROM todo_terms WHERE user_id = ? AND todo_id = ?",
+                    (user_id, todo_id),
+                )
+        return before
+
+    async def _delete(self, user_id: int, todo_id: int) -> Optional[dict]:
+        return await self._run(self._delete_sync, user_id, todo_id)
+
+    async def _search(self, user_id: int, terms: List[str], limit: int) -> List[dict]:
+        lookups = " AND ".join(
+            "id IN (SELECT todo_id FROM todo_terms WHERE user_id = ? AND term = ?)"
+            for _ in terms
+        )
+        params: List[Any] = [user_id]
+        for term in terms:
+            params.extend((user_id, term))
+        sql = (
+            f"SELECT {', '.join(TODO_COLUMNS)} FROM todos "
+            f"WHERE user_id = ? AND {lookups} "
+            "ORDER BY updated_at DESC, id DESC LIMIT ?"
+        )
+        return await self._run(self._select, sql, tuple(params + [limit]))
+
+    def _add_tombstones_sync(
+        self, user_id: int, todo_ids: List[int], deleted_at: datetime
+    ) -> None:
+        cutoff = deleted_at - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM tombstones WHERE user_id = ? AND deleted_at < ?",
+                (user_id, _to_sql(cutoff)),
+            )
+            connection.executemany(
+                "INSERT INTO tombstones (user_id, id, deleted_at) VALUES (?, ?, ?)",
+                [(user_id, todo_id, _to_sql(deleted_at)) for todo_id in todo_ids],
+            )
+
+    async def _add_tombstones(
+        self, user_id: int, todo_ids: List[int], deleted_at: datetime
+    ) -> None:
+        await self._run(self._add_tombstones_sync, user_id, todo_ids, deleted_at)
+
+    async def _deleted_since(self, user_id: int, since: datetime) -> List[int]:
+        rows = await self._run(
+            self._select,
+            "SELECT id FROM tombstones WHERE user_id = ? AND deleted_at >= ?",
+            (user_id, _to_sql(since)),
+        )
+        return [row["id"] for row in rows]
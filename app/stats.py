@@ -0,0 +1,177 @@
+"""Per-user todo statistics kept up to date with $inc.
+
+Each user has one summary document in the todo_stats collection:
+
+    {"_id": user_id, "total": 12, "completed": 5,
+     "by_area": {"work": 4, "none": 8}, "by_priority": {"1": 2, "none": 10},
+     "open_by_deadline": {"2024-05-01": 1}, "version": 31}
+
+Every write to a todo turns into a set of counter increments
+(``increments``), so reading the dashboard costs one document lookup. Open
+todos are counted per deadline day because "overdue" depends on the date
+the stats are read; a day's counter is removed once it drops to zero, so
+the document does not grow with every day that ever had a deadline.
+Increments are only applied for writes known to have happened, using the
+version of the todo they replaced. A batch write whose effect cannot be
+attributed to its todos (it raced with other writes to them) reconciles
+instead: ``rebuild_pipeline`` recomputes the document from the todos
+themselves, which also repairs any other drift. Every increment also bumps
+``version``, so a rebuild only replaces the document if no increment landed
+while it was counting.
+"""
+
+from collections import Counter
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional
+
+import storage
+
+NONE_KEY = "none"
+VERSION = "version"
+
+
+def _key(value) -> str:
+    if value is None:
+        return NONE_KEY
+    if isinstance(value, (date, datetime)):
+        return value.strftime("%Y-%m-%d")
+    return str(getattr(value, "value", value))
+
+
+def increments(todo: Optional[dict], sign: int = 1) -> Counter:
+    """Counter changes caused by adding (sign=1) or removing (sign=-1) a todo"""
+    changes: Counter = Counter()
+    if todo is None:
+        return changes
+    changes["total"] += sign
+    changes[f"by_area.{_key(todo.get('area'))}"] += sign
+    changes[f"by_priority.{_key(todo.get('priority'))}"] += sign
+    if todo.get("completed"):
+        changes["completed"] += sign
+    elif todo.get("deadline") is not None:
+        changes[f"open_by_deadline.{_key(todo['deadline'])}"] += sign
+    return changes
+
+
+def update_increments(before: dict, after: dict) -> Dict[str, int]:
+    """Counter changes caused by turning ``before`` into ``after``"""
+    changes = increments(after, 1)
+    changes.update(increments(before, -1))
+    return {path: value for path, value in changes.items() if value}
+
+
+def emptied_days(changes: Dict[str, int]) -> List[str]:
+    """Paths of the open_by_deadline counters an update decrements"""
+    return [
+        path
+        for path, value in changes.items()
+        if value < 0 and path.startswith("open_by_deadline.")
+    ]
+
+
+def summarize(stats: Optional[dict], today: date) -> dict:
+    """Response form of a summary document"""
+    stats = stats or {}
+    total = stats.get("total", 0)
+    completed = stats.get("completed", 0)
+    today_key = _key(today)
+    return {
+        "total": total,
+        "completed": completed,
+        "open": total - completed,
+        "overdue": sum(
+            count
+            for day, count in stats.get("open_by_deadline", {}).items()
+            if day < today_key
+        ),
+        "by_area": _non_zero(stats.get("by_area")),
+        "by_priority": _non_zero(stats.get("by_priority")),
+    }
+
+
+def _non_zero(counts: Optional[dict]) -> Dict[str, int]:
+    return {key: count for key, count in (counts or {}).items() if count}
+
+
+def from_todos(user_id: int, todos: Iterable[dict]) -> dict:
+    """Summary document counted directly from the todos"""
+    summary: dict = {
+        "_id": user_id,
+        "total": 0,
+        "completed": 0,
+        "by_area": {},
+        "by_priority": {},
+        "open_by_deadline": {},
+    }
+    changes: Counter = Counter()
+    for todo in todos:
+        changes.update(increments(todo))
+    for path, value in changes.items():
+        group, _, bucket = path.partition(".")
+        if bucket:
+            summary[group][bucket] = value
+        else:
+            summary[group] = value
+    return summary
+
+
+def rebuild_pipeline(user_id: int) -> List[dict]:
+    """Aggregation producing a fresh summary document for one user"""
+    return [
+        {"$match": storage.query({"user_id": user_id})},
+        {
+            "$facet": {
+                "total": [{"$count": "n"}],
+                "completed": [
+                    {"$match": storage.query({"completed": True})},
+                    {"$count": "n"},
+                ],
+                "by_area": [
+                    {"$group": {"_id": storage.path("area"), "n": {"$sum": 1}}}
+                ],
+                "by_priority": [
+                    {"$group": {"_id": storage.path("priority"), "n": {"$sum": 1}}}
+                ],
+                "open_by_deadline": [
+                    {
+                        "$match": storage.query(
+                            {"completed": {"$ne": True}, "deadline": {"$ne": None}}
+                        )
+                    },
+                    {
+                        "$group": {
+                            "_id": {
+                                "$dateToString": {
+                                    "format": "%Y-%m-%d",
+                                    "date": storage.path("deadline"),
+                                }
+                            },
+                            "n": {"$sum": 1},
+                        }
+                    },
+                ],
+            }
+        },
+    ]
+
+
+def from_rebuild(user_id: int, result: Optional[dict]) -> dict:
+    """Summary document from the output of ``rebuild_pipeline``"""
+    result = result or {}
+
+    def count(name: str) -> int:
+        rows = result.get(name) or []
+        return rows[0]["n"] if rows else 0
+
+    def buckets(name: str, decode=lambda value: value) -> Dict[str, int]:
+        return {_key(decode(row["_id"])): row["n"] for row in result.get(name) or []}
+
+    return {
+        "_id": user_id,
+        "total": count("total"),
+        "completed": count("completed"),
+        "by_area": buckets("by_area", storage.decode_area),
+        "by_priority": buckets("by_priority"),
+        "open_by_deadline": buckets("open_by_deadline"),
+        "rebuilt_at": datetime.now(),
+    }
@@ -0,0 +1,140 @@
+"""Compact storage form of todo documents.
+
+Todos are stored under one or two letter keys, areas as small integers,
+and fields holding their default (None, False, no search terms) are left
+out of the document entirely. Everything above the data layer keeps using
+the Todo field names: database.py encodes documents, filters, sorts and
+updates on the way in and decodes documents on the way out.
+
+    {"i": 7, "u": 1, "t": "Buy milk", "a": 3, "dl": datetime(...),
+     "ca": datetime(...), "ua": datetime(...), "tt": ["b", "bu", ...]}
+
+Queries on a left-out field behave as before, since Mongo treats a missing
+field as null and ``{"c": {"$ne": True}}`` matches it. SCHEMA_VERSION is
+the version of this mapping; migration 7 rewrites older documents.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import search
+from serializers import TODO_FIELDS
+
+SCHEMA_VERSION = 1
+
+KEYS = {
+    "id": "i",
+    "user_id": "u",
+    "title": "t",
+    "description": "d",
+    "completed": "c",
+    "priority": "p",
+    "area": "a",
+    "deadline": "dl",
+    "created_at": "ca",
+    "updated_at": "ua",
+    search.TITLE_TERMS: "tt",
+    search.DESCRIPTION_TERMS: "dt",
+}
+FIELDS = {key: field for field, key in KEYS.items()}
+
+# Codes are stored; never renumber, only append
+AREA_CODES = {"sports": 1, "university": 2, "life": 3, "work": 4}
+AREAS = {code: area for area, code in AREA_CODES.items()}
+
+PROJECTION = {"_id": 0, **{KEYS[field]: 1 for field in TODO_FIELDS}}
+
+
+def key(field: str) -> str:
+    """Stored key of a Todo field; other names are left alone"""
+    return KEYS.get(field, field)
+
+
+def path(field: str) -> str:
+    """Aggregation expression reading a Todo field"""
+    return f"${key(field)}"
+
+
+def encode_area(area):
+    area = getattr(area, "value", area)
+    return AREA_CODES.get(area, area)
+
+
+def decode_area(code):
+    return AREAS.get(code, code)
+
+
+def _omitted(value) -> bool:
+    return value is None or value is False or value == []
+
+
+def _encode_value(field: str, value):
+    if field == "area":
+        return encode_area(value)
+    if field == "priority" and value is not None:
+        return int(value)
+    return value
+
+
+def encode(todo: Dict[str, Any]) -> Dict[str, Any]:
+    """Storage form of a todo"""
+    return {
+        key(field): _encode_value(field, value)
+        for field, value in todo.items()
+        if not _omitted(value) or field not in KEYS
+    }
+
+
+def decode(document: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Todo field names and values of a stored document"""
+    if document is None:
+        return None
+    todo = {FIELDS.get(name, name): value for name, value in document.items()}
+    if "area" in todo:
+        todo["area"] = decode_area(todo["area"])
+    return todo
+
+
+def update(fields: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Update operators setting Todo fields, unsetting cleared ones"""
+    operators: Dict[str, Dict[str, Any]] = {}
+    for field, value in fields.items():
+        if _omitted(value):
+            operators.setdefault("$unset", {})[key(field)] = ""
+        else:
+            operators.setdefault("$set", {})[key(field)] = _encode_value(field, value)
+    return operators
+
+
+def _encode_condition(field: str, condition):
+    if field != "area":
+        return condition
+    if isinstance(condition, dict):
+        return {
+            op: (
+                [encode_area(area) for area in operand]
+                if isinstance(operand, list)
+                else encode_area(operand)
+            )
+            for op, operand in condition.items()
+        }
+    return encode_area(condition)
+
+
+def query(condition: Dict[str, Any]) -> Dict[str, Any]:
+    """Filter on Todo fields rewritten for the stored documents"""
+    encoded = {}
+    for name, value in condition.items():
+        if name in ("$and", "$or", "$nor"):
+            encoded[name] = [query(clause) for clause in value]
+        else:
+            encoded[key(name)] = _encode_condition(name, value)
+    return encoded
+
+
+def sort(
+    spec: Union[List[Tuple[str, int]], Dict[str, int]],
+) -> Union[List[Tuple[str, int]], Dict[str, int]]:
+    """Sort specification on Todo fields rewritten for the stored documents"""
+    if isinstance(spec, dict):
+        return {key(field): direction for field, direction in spec.items()}
+    return [(key(field), direction) for field, direction in spec]
@@ -0,0 +1,119 @@
+"""Server-side filtering and sorting of todo listings.
+
+``build`` turns a filter spec (the TodoFilter model of the list endpoint)
+into a TodoQuery: a filter on Todo field names, a sort that always ends
+with ``id`` as the tie-breaker, and the compound index that serves it.
+Every backend executes the same TodoQuery; MongoDB also gets the index as
+a hint, so a listing never falls back to a plan that sorts in memory.
+
+Todos without a priority or deadline sort last in both directions. Mongo
+orders missing values first, so the Mongo backend pages through the todos
+with and without a value separately (see ``split``).
+"""
+
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING
+
+SortSpec = List[Tuple[str, int]]
+
+# Sort fields a todo may leave unset
+OPTIONAL_SORT_FIELDS = ("priority", "deadline")
+
+# Sort indexes on todos in Todo field names, created by migrations 7 and 9.
+# A sort is served by the index continuing user_id with the sort field and
+# id, in the same or in reversed directions.
+INDEXES: List[SortSpec] = [
+    [("user_id", ASCENDING), ("deadline", ASCENDING), ("id", ASCENDING)],
+    [("user_id", ASCENDING), ("updated_at", DESCENDING), ("id", DESCENDING)],
+    [("user_id", ASCENDING), ("priority", ASCENDING), ("id", ASCENDING)],
+    [("user_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)],
+]
+
+
+class TodoQuery(NamedTuple):
+    filter: Dict[str, Any]
+    # None keeps the storage order (the unsorted, unpaged listing)
+    sort: Optional[SortSpec]
+    # Index to hint, serving the sort
+    index: Optional[SortSpec]
+
+
+def _day_start(day: date) -> datetime:
+    return datetime.combine(day, datetime.min.time())
+
+
+def _one_of(values: Iterable) -> Any:
+    values = sorted({getattr(value, "value", value) for value in values})
+    return values[0] if len(values) == 1 else {"$in": values}
+
+
+def build_filter(user_id: int, spec) -> Dict[str, Any]:
+    """Filter on Todo fields for the conditions set in ``spec``"""
+    query: Dict[str, Any] = {"user_id": user_id}
+    if spec.completed is not None:
+        # Open todos may not store completed at all
+        query["completed"] = True if spec.completed else {"$ne": True}
+    if spec.priority:
+        query["priority"] = _one_of(spec.priority)
+    if spec.area:
+        query["area"] = _one_of(spec.area)
+    start, end = spec.deadline_from, spec.deadline_to
+    if spec.deadline is not None:
+        start = end = spec.deadline
+    deadline: Dict[str, datetime] = {}
+    if start is not None:
+        deadline["$gte"] = _day_start(start)
+    if end is not None:
+        deadline["$lt"] = _day_start(end + timedelta(days=1))
+    if deadline:
+        query["deadline"] = deadline
+    return query
+
+
+def build_sort(field: Optional[str], descending: bool = False) -> Optional[SortSpec]:
+    """Sort on ``field`` with id as the tie-breaker, or None for no sort"""
+    if field is None:
+        return None
+    direction = DESCENDING if descending else ASCENDING
+    return [(field, direction), ("id", direction)]
+
+
+def choose_index(sort: Optional[SortSpec]) -> Optional[SortSpec]:
+    """The compound index that returns todos in ``sort`` order"""
+    if sort is None:
+        return None
+    reversed_sort = [(field, -direction) for field, direction in sort]
+    for index in INDEXES:
+        if index[1:] in (sort, reversed_sort):
+            return index
+    return None
+
+
+def build(user_id: int, spec) -> TodoQuery:
+    """TodoQuery for a user and a TodoFilter"""
+    sort_by = spec.sort_by.value if spec.sort_by is not None else None
+    query = build_filter(user_id, spec)
+    sort = build_sort(sort_by, spec.descending)
+    return TodoQuery(query, sort, choose_index(sort))
+
+
+def split(
+    query: TodoQuery, after: Optional[Dict[str, Any]]
+) -> List[Tuple[Dict[str, Any], SortSpec]]:
+    """(condition, sort) of each run of todos in listing order
+
+    An optional sort field gives two runs, todos with a value and then
+    todos without one by id; with ``after`` in the second run the first is
+    skipped. The conditions still need to be combined with the filter and
+    the keyset position of ``after``, which is left to the backend.
+    """
+    field, direction = query.sort[0]
+    if field not in OPTIONAL_SORT_FIELDS:
+        return [({}, query.sort)]
+    runs = []
+    if after is None or after.get(field) is not None:
+        runs.append(({field: {"$ne": None}}, query.sort))
+    runs.append(({field: None}, [("id", direction)]))
+    return runs
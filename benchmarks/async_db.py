@@ -0,0 +1,101 @@
+"""Concurrent-request throughput of the blocking vs. the async data layer.
+
+Runs against a local mongod (MONGODB_URL, default mongodb://localhost:27017/)
+using a throwaway database. Each simulated request looks up the user and then
+loads that user's todos, which is what an authenticated list request does.
+
+"before" calls synchronous pymongo inside ``async def`` handlers, exactly like
+the old database.py, so every round trip blocks the event loop.
+"after" awaits the same queries through Motor.
+
+    python benchmarks/async_db.py --requests 2000 --concurrency 100
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+
+MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017/")
+DB_NAME = "taskdo_bench_async"
+
+
+def seed(users: int, todos_per_user: int) -> None:
+    db = MongoClient(MONGODB_URL)[DB_NAME]
+    db.users.drop()
+    db.todos.drop()
+    db.users.insert_many(
+        [{"id": i, "username": f"user{i}"} for i in range(1, users + 1)]
+    )
+    now = datetime.now()
+    db.todos.insert_many(
+        [
+            {
+                "id": t,
+                "user_id": u,
+                "title": f"todo {t}",
+                "completed": False,
+                "created_at": now,
+                "updated_at": now,
+            }
+            for u in range(1, users + 1)
+            for t in range(1, todos_per_user + 1)
+        ]
+    )
+
+
+async def run_blocking(requests: int, concurrency: int, users: int) -> float:
+    db = MongoClient(MONGODB_URL)[DB_NAME]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handle(i: int) -> None:
+        async with semaphore:
+            user = db.users.find_one({"username": f"user{i % users + 1}"})
+            list(db.todos.find({"user_id": user["id"]}))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(handle(i) for i in range(requests)))
+    return time.perf_counter() - start
+
+
+async def run_async(requests: int, concurrency: int, users: int) -> float:
+    db = AsyncIOMotorClient(MONGODB_URL, maxPoolSize=concurrency)[DB_NAME]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handle(i: int) -> None:
+        async with semaphore:
+            user = await db.users.find_one({"username": f"user{i % users + 1}"})
+            await db.todos.find({"user_id": user["id"]}).to_list(length=None)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(handle(i) for i in range(requests)))
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--todos-per-user", type=int, default=20)
+    args = parser.parse_args()
+
+    seed(args.users, args.todos_per_user)
+    for name, runner in (
+        ("before (blocking)", run_blocking),
+        ("after (motor)", run_async),
+    ):
+        elapsed = asyncio.run(runner(args.requests, args.concurrency, args.users))
+        print(
+            f"{name:<18} {args.requests} requests in {elapsed:.2f}s "
+            f"-> {args.requests / elapsed:.0f} req/s"
+        )
+    MongoClient(MONGODB_URL).drop_database(DB_NAME)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+"""Load test for the taskdo API with per-endpoint latency percentiles.
+
+Seeds --users users with --todos todos each, then runs a weighted mix of
+login, refresh, list, search, create, update and delete requests from
+--concurrency concurrent clients for --duration seconds and prints a JSON
+report with throughput and p50/p95/p99 latency per endpoint.
+
+By default the app runs in-process (httpx ASGI transport) against the
+storage backend chosen by STORAGE_BACKEND; for MongoDB that is a throwaway
+taskdo_loadtest database at MONGODB_URL. --in-memory uses the memory
+backend instead and --url targets an already running server.
+
+    python benchmarks/loadtest.py --users 20 --todos 200 --concurrency 50 \\
+        --duration 30 --output after.json --baseline before.json
+
+The report includes the CPU time this process used during the run, per
+request. For in-process runs that is mostly the app itself, so comparing
+mixes shows the cost of an endpoint, e.g. --mix login=1 against
+--mix refresh=1 for re-authenticating with a password or a refresh token.
+
+An update of a todo another client deleted in the meantime answers 404;
+those are counted as conflicts rather than errors.
+
+With --baseline, endpoints whose p95 grew or whose throughput dropped by more
+than --max-regression (default 10%) are listed and the exit status is 1.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import string
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+import httpx
+
+APP_DIR = os.path.join(os.path.dirname(__file__), "..", "app")
+
+DEFAULT_MIX = "login=1,list=30,search=15,create=10,update=10,delete=5"
+WORDS = (
+    "buy milk call mom finish report book flight gym read pay rent plan trip".split()
+)
+PASSWORD = "benchmark-password"
+
+
+def parse_mix(spec: str) -> Dict[str, int]:
+    mix = {}
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        mix[name.strip()] = int(weight)
+    return mix
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+@asynccontextmanager
+async def open_client(args):
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=30) as client:
+            yield client
+        return
+
+    sys.path.insert(0, APP_DIR)
+    if args.in_memory:
+        os.environ["STORAGE_BACKEND"] = "memory"
+    os.environ.setdefault("LOG_DEFAULT_SAMPLE_RATE", "0")
+    # All simulated clients share one address and a few users, so admission
+    # control would measure its own limits; set these to load test it
+    os.environ.setdefault("ADMISSION_RATE", "0")
+    os.environ.setdefault("ADMISSION_MAX_CONCURRENCY", "0")
+    os.environ["MONGODB_DB"] = "taskdo_loadtest"
+    # The throwaway database has no release step to migrate it
+    os.environ.setdefault("AUTO_MIGRATE", "true")
+    import database
+    from main import app, store
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://loadtest", timeout=30
+        ) as client:
+            yield client
+        if isinstance(store, database.MongoBackend):
+            await database.client.drop_database(database.DB_NAME)
+
+
+class Session:
+    """One seeded user with a token and the ids of its todos"""
+
+    def __init__(self, username: str, tokens: dict, todo_ids: List[int]):
+        self.username = username
+        self.token = tokens["access_token"]
+        self.refresh_token = tokens.get("refresh_token")
+        self.todo_ids = todo_ids
+        # A real client refreshes once at a time; a refresh token presented
+        # twice would revoke the session
+        self.refreshing = asyncio.Lock()
+
+    def renew(self, tokens: dict) -> None:
+        self.token = tokens["access_token"]
+        self.refresh_token = tokens.get("refresh_token")
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.token}"}
+
+
+def random_title(rng: random.Random) -> str:
+    return " ".join(rng.sample(WORDS, 3))
+
+
+async def login(client: httpx.AsyncClient, username: str) -> dict:
+    response = await client.post(
+        "/api/token", data={"username": username, "password": PASSWORD}
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+async def seed(client: httpx.AsyncClient, args, rng: random.Random) -> List[Session]:
+    run_id = "".join(rng.choices(string.ascii_lowercase, k=6))
+    sessions = []
+    for i in range(args.users):
+        username = f"load_{run_id}_{i}"
+        response = await client.post(
+            "/api/register",
+            json={
+                "username": username,
+                "email": f"{username}@example.com",
+                "password": PASSWORD,
+            },
+        )
+        response.raise_for_status()
+        session = Session(username, await login(client, username), [])
+        for start in range(0, args.todos, 500):
+            todos = [
+                {"title": random_title(rng), "area": rng.choice(["work", "life"])}
+                for _ in range(min(500, args.todos - start))
+            ]
+            response = await client.post(
+                "/api/todos/batch", json={"todos": todos}, headers=session.headers
+            )
+            response.raise_for_status()
+            session.todo_ids += [item["id"] for item in response.json()["results"]]
+        sessions.append(session)
+    return sessions
+
+
+async def run_operation(
+    name: str, client: httpx.AsyncClient, session: Session, rng: random.Random
+) -> httpx.Response:
+    if name == "login":
+        response = await client.post(
+            "/api/token", data={"username": session.username, "password": PASSWORD}
+        )
+        if response.status_code == 200:
+            session.renew(response.json())
+        return response
+    if name == "refresh":
+        async with session.refreshing:
+            response = await client.post(
+                "/api/token/refresh", json={"refresh_token": session.refresh_token}
+            )
+            if response.status_code == 200:
+                session.renew(response.json())
+        return response
+    if name == "list":
+        return await client.get("/api/todos", headers=session.headers)
+    if name == "search":
+        query = rng.choice(WORDS)[: rng.randint(1, 4)]
+        return await client.get(
+            "/api/todos/search", params={"query": query}, headers=session.headers
+        )
+    if name == "create":
+        response = await client.post(
+            "/api/todos", json={"title": random_title(rng)}, headers=session.headers
+        )
+        if response.status_code == 200:
+            session.todo_ids.append(response.json()["id"])
+        return response
+    if name == "update":
+        todo_id = rng.choice(session.todo_ids)
+        return await client.put(
+            f"/api/todos/{todo_id}",
+            json={"completed": rng.random() < 0.5},
+            headers=session.headers,
+        )
+    if name == "delete":
+        todo_id = session.todo_ids.pop(rng.randrange(len(session.todo_ids)))
+        return await client.delete(f"/api/todos/{todo_id}", headers=session.headers)
+    raise ValueError(f"Unknown operation {name}")
+
+
+async def worker(
+    client: httpx.AsyncClient,
+    sessions: List[Session],
+    mix: Dict[str, int],
+    deadline: float,
+    rng: random.Random,
+    samples: Dict[str, List[float]],
+    errors: Dict[str, int],
+    conflicts: Dict[str, int],
+) -> None:
+    names, weights = list(mix), list(mix.values())
+    while time.perf_counter() < deadline:
+        session = rng.choice(sessions)
+        name = rng.choices(names, weights)[0]
+        if name in ("update", "delete") and not session.todo_ids:
+            name = "create"
+        start = time.perf_counter()
+        conflict = False
+        try:
+            response = await run_operation(name, client, session, rng)
+            # Workers share sessions, so the todo may have just been deleted
+            conflict = name == "update" and response.status_code == 404
+            failed = response.status_code >= 400 and not conflict
+        except httpx.HTTPError:
+            failed = True
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if conflict:
+            conflicts[name] = conflicts.get(name, 0) + 1
+        if failed:
+            errors[name] = errors.get(name, 0) + 1
+        else:
+            samples.setdefault(name, []).append(elapsed_ms)
+
+
+def build_report(
+    args,
+    samples: Dict[str, List[float]],
+    errors: Dict[str, int],
+    conflicts: Dict[str, int],
+    elapsed: float,
+    cpu_seconds: float,
+) -> dict:
+    endpoints = {}
+    for name in sorted(set(samples) | set(errors)):
+        latencies = samples.get(name, [])
+        endpoints[name] = {
+            "requests": len(latencies),
+            "errors": errors.get(name, 0),
+            "conflicts": conflicts.get(name, 0),
+            "throughput_rps": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 0.50), 3),
+            "p95_ms": round(percentile(latencies, 0.95), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3),
+        }
+    total = sum(len(latencies) for latencies in samples.values())
+    return {
+        "config": {
+            "users": args.users,
+            "todos": args.todos,
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "mix": args.mix,
+            "seed": args.seed,
+            "target": args.url or os.environ.get("STORAGE_BACKEND", "mongo"),
+        },
+        "total": {
+            "requests": total,
+            "errors": sum(errors.values()),
+            "conflicts": sum(conflicts.values()),
+            "throughput_rps": round(total / elapsed, 2),
+            "cpu_seconds": round(cpu_seconds, 3),
+            "cpu_ms_per_request": round(cpu_seconds * 1000 / total, 3) if total else 0,
+        },
+        "endpoints": endpoints,
+    }
+
+
+def compare(report: dict, baseline: dict, max_regression: float) -> List[str]:
+    """Endpoints that got slower or lost throughput beyond the allowance"""
+    regressions = []
+    for name, current in report["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if not previous:
+            continue
+        if previous["p95_ms"] and current["p95_ms"] > previous["p95_ms"] * (
+            1 + max_regression
+        ):
+            regressions.append(
+                f"{name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms"
+            )
+        if current["throughput_rps"] < previous["throughput_rps"] * (
+            1 - max_regression
+        ):
+            regressions.append(
+                f"{name}: throughput {previous['throughput_rps']} -> "
+                f"{current['throughput_rps']} req/s"
+            )
+    return regressions
+
+
+async def main(args) -> int:
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    async with open_client(args) as client:
+        sessions = await seed(client, args, rng)
+        samples: Dict[str, List[float]] = {}
+        errors: Dict[str, int] = {}
+        conflicts: Dict[str, int] = {}
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        deadline = start + args.duration
+        await asyncio.gather(
+            *(
+                worker(
+                    client,
+                    sessions,
+                    mix,
+                    deadline,
+                    random.Random(rng.random()),
+                    samples,
+                    errors,
+                    conflicts,
+                )
+                for _ in range(args.concurrency)
+            )
+        )
+        elapsed = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+
+    report = build_report(args, samples, errors, conflicts, elapsed, cpu_seconds)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--todos", type=int, default=100, help="todos per user")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="operation=weight,...")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--url", help="benchmark a running server instead")
+    parser.add_argument(
+        "--in-memory", action="store_true", help="use the memory storage backend"
+    )
+    parser.add_argument("--output", help="also write the JSON report here")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.10)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
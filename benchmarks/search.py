@@ -0,0 +1,117 @@
+"""Regex search vs. the prefix search index on one user's todos.
+
+Seeds a throwaway database on a local mongod (MONGODB_URL) with --todos
+todos for a single user, builds the indexes through the regular
+migrations, then times the old unanchored $regex query against the
+indexed term lookup for a few search-as-you-type queries.
+
+    python benchmarks/search.py --todos 100000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import search  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017/")
+DB_NAME = "taskdo_bench_search"
+USER_ID = 1
+
+WORDS = (
+    "buy milk call mom finish report book flight gym session read chapter "
+    "pay rent water plants clean kitchen email professor submit thesis plan "
+    "trip renew passport fix bike prepare slides review pull request walk dog"
+).split()
+QUERIES = ["m", "mi", "milk", "buy mi", "passport", "review pull", "zzz"]
+
+
+async def seed(db, todos: int) -> None:
+    await db.todos.drop()
+    await db.migrations.drop()
+    rng = random.Random(42)
+    now = datetime.now()
+    batch = []
+    for i in range(1, todos + 1):
+        title = " ".join(rng.sample(WORDS, 4))
+        description = " ".join(rng.sample(WORDS, 8))
+        batch.append(
+            {
+                "id": i,
+                "user_id": USER_ID,
+                "title": title,
+                "description": description,
+                "completed": False,
+                "created_at": now,
+                "updated_at": now,
+                **search.search_fields({"title": title, "description": description}),
+            }
+        )
+        if len(batch) == 5000:
+            await db.todos.insert_many(batch)
+            batch = []
+    if batch:
+        await db.todos.insert_many(batch)
+    await migrate(db)
+
+
+async def time_query(run, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await run()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--todos", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(MONGODB_URL)
+    db = client[DB_NAME]
+    await seed(db, args.todos)
+
+    print(f"{'query':<14}{'regex ms':>10}{'index ms':>10}{'matches':>10}")
+    for query in QUERIES:
+        pattern = re.escape(query)
+        regex_query = {
+            "user_id": USER_ID,
+            "$or": [
+                {"title": {"$regex": pattern, "$options": "i"}},
+                {"description": {"$regex": pattern, "$options": "i"}},
+            ],
+        }
+        index_query = {"user_id": USER_ID, **search.build_query(query)}
+
+        async def run_regex():
+            return await db.todos.find(regex_query).to_list(length=None)
+
+        async def run_index():
+            candidates = await db.todos.find(index_query).limit(1000).to_list(None)
+            return search.rank(query, candidates, args.limit)
+
+        regex_ms = await time_query(run_regex, args.repeat)
+        index_ms = await time_query(run_index, args.repeat)
+        matches = await db.todos.count_documents(index_query)
+        print(f"{query:<14}{regex_ms:>10.1f}{index_ms:>10.1f}{matches:>10}")
+
+    await client.drop_database(DB_NAME)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+"""Serialization time of todo list responses.
+
+Compares the previous path (convert deadlines by hand, validate against
+List[Todo] through response_model, jsonable_encoder, json.dumps) with
+TodoListResponse (one pass plus orjson) on in-memory documents shaped like
+Mongo results. No database is needed.
+
+    python benchmarks/serialization.py --sizes 1000 10000
+"""
+
+import argparse
+import copy
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from main import Todo  # noqa: E402
+from serializers import TodoListResponse  # noqa: E402
+
+
+def make_todos(count: int) -> List[dict]:
+    now = datetime(2024, 1, 1, 12, 0)
+    return [
+        {
+            "id": i,
+            "user_id": 1,
+            "title": f"Todo number {i}",
+            "description": "Something that needs doing before the deadline",
+            "completed": i % 3 == 0,
+            "priority": i % 3 + 1,
+            "area": "work",
+            "deadline": now + timedelta(days=i % 30) if i % 4 else None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        for i in range(1, count + 1)
+    ]
+
+
+def old_path(todos: List[dict], adapter: TypeAdapter) -> bytes:
+    for todo in todos:
+        if isinstance(todo.get("deadline"), datetime):
+            todo["deadline"] = todo["deadline"].date()
+    validated = adapter.validate_python(todos)
+    return json.dumps(jsonable_encoder(validated)).encode()
+
+
+def new_path(todos: List[dict], adapter: TypeAdapter) -> bytes:
+    return TodoListResponse(todos).body
+
+
+def measure(func, todos: List[dict], repeat: int) -> float:
+    adapter = TypeAdapter(List[Todo])
+    samples = []
+    for _ in range(repeat):
+        batch = copy.deepcopy(todos)
+        start = time.perf_counter()
+        func(batch, adapter)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'todos':>8}{'old ms':>10}{'new ms':>10}{'speedup':>10}")
+    for size in args.sizes:
+        todos = make_todos(size)
+        old_ms = measure(old_path, todos, args.repeat)
+        new_ms = measure(new_path, todos, args.repeat)
+        print(f"{size:>8}{old_ms:>10.2f}{new_ms:>10.2f}{old_ms / new_ms:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
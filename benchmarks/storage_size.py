@@ -0,0 +1,125 @@
+"""Storage size of todo documents and indexes.
+
+Without options, reports collStats of the todos collection at MONGODB_URL /
+MONGODB_DB (document count, data size, average document size, storage
+size and the size of each index). Save the report before running
+migrations.py and pass it as --baseline afterwards to see the difference.
+
+--sample N needs no database: it compares the BSON size of N generated
+todos in the old long-key layout with their compact storage form.
+
+    python benchmarks/storage_size.py --output before.json
+    python app/migrations.py
+    python benchmarks/storage_size.py --baseline before.json
+    python benchmarks/storage_size.py --sample 10000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+import bson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import search  # noqa: E402
+import storage  # noqa: E402
+
+WORDS = "buy milk call mom finish report book flight gym read pay rent".split()
+AREAS = [None, "sports", "university", "life", "work"]
+
+
+def make_todo(rng: random.Random, todo_id: int) -> dict:
+    """A todo the way the old schema stored it, every field present"""
+    now = datetime(2024, 1, 1, 12, 0)
+    todo = {
+        "_id": bson.ObjectId(),
+        "id": todo_id,
+        "user_id": rng.randint(1, 100),
+        "title": " ".join(rng.sample(WORDS, 3)),
+        "description": " ".join(rng.sample(WORDS, 6)) if rng.random() < 0.3 else None,
+        "completed": rng.random() < 0.4,
+        "priority": rng.choice([None, 1, 2, 3]),
+        "area": rng.choice(AREAS),
+        "deadline": (
+            now + timedelta(days=rng.randint(0, 60)) if rng.random() < 0.6 else None
+        ),
+        "created_at": now,
+        "updated_at": now,
+    }
+    todo.update(search.search_fields(todo))
+    return todo
+
+
+def sample_report(count: int) -> dict:
+    rng = random.Random(1)
+    legacy = compact = 0
+    for todo_id in range(1, count + 1):
+        todo = make_todo(rng, todo_id)
+        legacy += len(bson.encode(todo))
+        compact += len(bson.encode(storage.encode(todo)))
+    return {
+        "documents": count,
+        "legacy_bytes": legacy,
+        "compact_bytes": compact,
+        "legacy_avg_bytes": round(legacy / count, 1),
+        "compact_avg_bytes": round(compact / count, 1),
+        "saved_percent": round(100 * (1 - compact / legacy), 1),
+    }
+
+
+async def collection_report() -> dict:
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(os.getenv("MONGODB_URL", "mongodb://localhost:27017/"))
+    db = client[os.getenv("MONGODB_DB", "taskdo")]
+    try:
+        collstats = await db.command("collStats", "todos")
+    finally:
+        client.close()
+    return {
+        "documents": collstats.get("count", 0),
+        "size_bytes": collstats.get("size", 0),
+        "avg_document_bytes": collstats.get("avgObjSize", 0),
+        "storage_bytes": collstats.get("storageSize", 0),
+        "index_bytes": collstats.get("totalIndexSize", 0),
+        "indexes": collstats.get("indexSizes", {}),
+    }
+
+
+def compare(report: dict, baseline: dict) -> dict:
+    """Change of every size figure relative to the baseline, in percent"""
+    changes = {}
+    for name in ("size_bytes", "avg_document_bytes", "storage_bytes", "index_bytes"):
+        if baseline.get(name):
+            changes[name] = round(100 * (report[name] / baseline[name] - 1), 1)
+    return changes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sample", type=int, help="compare N generated todos")
+    parser.add_argument("--output", help="also write the JSON report here")
+    parser.add_argument("--baseline", help="collection report to compare against")
+    args = parser.parse_args()
+
+    if args.sample:
+        report = sample_report(args.sample)
+    else:
+        report = asyncio.run(collection_report())
+        if args.baseline:
+            with open(args.baseline) as f:
+                report["change_percent"] = compare(report, json.load(f))
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
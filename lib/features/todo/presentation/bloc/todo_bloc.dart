@@ -76,7 +76,10 @@ class TodoBloc extends Bloc<TodoEvent, TodoState> {
   Future<void> _onSearchTodos(SearchTodos event, Emitter<TodoState> emit) async {
     try {
       emit(const TodoLoading());
-      _todos = await _repository.searchTodos(event.query);
+      // The search endpoint returns only the latest todos for an empty query
+      _todos = event.query.isEmpty
+          ? await _repository.getTodos()
+          : await _repository.searchTodos(event.query);
       emit(TodoLoaded(todos: _todos));
     } catch (e) {
       emit(TodoError(e.toString()));
@@ -0,0 +1,158 @@
+"""Shared fixtures for the taskdo API tests.
+
+The app modules live in app/ and import each other by module name, so that
+directory goes on sys.path. Tests default to the memory backend. Tests that
+need MongoDB use the ``mongo_db`` fixture; each test gets a throwaway
+database that is dropped afterwards. They run against the server at
+MONGODB_URL, or on mongomock-motor when it is not set. mongomock has no
+query planner and emits no command events, so tests marked ``mongo_server``
+are skipped without a real server. The ``store`` fixture runs a test
+against every storage backend.
+"""
+
+import os
+import sys
+import uuid
+from contextlib import asynccontextmanager
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(__file__), "..", "app")
+sys.path.insert(0, os.path.abspath(APP_DIR))
+
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("LOG_DEFAULT_SAMPLE_RATE", "0")
+# Every test client comes from one address
+os.environ.setdefault("ADMISSION_RATE", "0")
+
+MONGODB_URL = os.getenv("MONGODB_URL")
+# mongomock keeps one in-process server per URL
+MOCK_MONGODB_URL = "mongodb://mongomock"
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+
+def mongo_client_class():
+    """Motor's client for a server at MONGODB_URL, else mongomock-motor's"""
+    if MONGODB_URL:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        return AsyncIOMotorClient
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        pytest.skip("MONGODB_URL is not set and mongomock-motor is not installed")
+    return AsyncMongoMockClient
+
+
+@asynccontextmanager
+async def throwaway_mongo_database(server_required: bool = False):
+    if server_required and not MONGODB_URL:
+        pytest.skip("Needs a MongoDB server at MONGODB_URL")
+    client = mongo_client_class()(
+        MONGODB_URL or MOCK_MONGODB_URL, serverSelectionTimeoutMS=1000
+    )
+    try:
+        await client.admin.command("ping")
+    except Exception as e:
+        client.close()
+        pytest.skip(f"MongoDB at MONGODB_URL is not reachable: {e}")
+    name = f"taskdo_test_{uuid.uuid4().hex[:12]}"
+    try:
+        yield client[name]
+    finally:
+        await client.drop_database(name)
+        client.close()
+
+
+@asynccontextmanager
+async def connected_database_module(mongo_db, monkeypatch):
+    import database
+    import migrations
+
+    monkeypatch.setattr(database, "AsyncIOMotorClient", mongo_client_class())
+    monkeypatch.setattr(database, "MONGODB_URL", MONGODB_URL or MOCK_MONGODB_URL)
+    monkeypatch.setattr(database, "DB_NAME", mongo_db.name)
+    database.close()
+    database.connect()
+    await migrations.migrate(database.db)
+    try:
+        yield database
+    finally:
+        database.close()
+
+
+@pytest.fixture
+async def mongo_db(request):
+    server_required = request.node.get_closest_marker("mongo_server") is not None
+    async with throwaway_mongo_database(server_required) as db:
+        yield db
+
+
+@pytest.fixture
+async def mongo_database(mongo_db, monkeypatch):
+    """The database module connected to the throwaway database, migrated"""
+    async with connected_database_module(mongo_db, monkeypatch) as database:
+        yield database
+
+
+@pytest.fixture(params=["memory", "sqlite", "mongo"])
+async def store(request, tmp_path, monkeypatch):
+    """A fresh StorageBackend of each engine"""
+    if request.param == "memory":
+        from memory_backend import MemoryBackend
+
+        backend = MemoryBackend()
+    elif request.param == "sqlite":
+        from sqlite_backend import SQLiteBackend
+
+        backend = SQLiteBackend(str(tmp_path / "taskdo.sqlite3"))
+    else:
+        async with throwaway_mongo_database() as db:
+            async with connected_database_module(db, monkeypatch) as database:
+                # Already connected and migrated
+                yield database.MongoBackend()
+        return
+    await backend.start()
+    try:
+        yield backend
+    finally:
+        await backend.stop()
+
+
+@pytest.fixture(scope="session")
+async def client():
+    """Client for the app; the lifespan runs once, as in a worker process"""
+    import httpx
+
+    import main
+
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app), base_url="http://test"
+        ) as client:
+            yield client
+
+
+@pytest.fixture
+async def auth_headers(client):
+    """Authorization header of a newly registered user"""
+    username = f"user_{uuid.uuid4().hex[:12]}"
+    response = await client.post(
+        "/api/register",
+        json={
+            "email": f"{username}@example.com",
+            "username": username,
+            "password": "secret1",
+        },
+    )
+    response.raise_for_status()
+    response = await client.post(
+        "/api/token", data={"username": username, "password": "secret1"}
+    )
+    response.raise_for_status()
+    return {"Authorization": "Bearer " + response.json()["access_token"]}
@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionMiddleware, TokenBuckets
+
+pytestmark = pytest.mark.anyio
+
+
+def test_bucket_spends_its_burst_then_waits_for_refill():
+    buckets = TokenBuckets(rate=2, burst=3, max_clients=10)
+
+    assert [buckets.take("a", 1, now=0) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take("a", 1, now=0) == pytest.approx(0.5)
+    # Half a second refills one token
+    assert buckets.take("a", 1, now=0.5) == 0
+
+
+def test_bucket_refills_up_to_the_burst():
+    buckets = TokenBuckets(rate=1, burst=2, max_clients=10)
+    buckets.take("a", 2, now=0)
+
+    assert buckets.take("a", 2, now=100) == 0
+    assert buckets.take("a", 1, now=100) == pytest.approx(1)
+
+
+def test_cost_above_the_burst_is_capped():
+    buckets = TokenBuckets(rate=1, burst=5, max_clients=10)
+
+    assert buckets.take("a", 10, now=0) == 0
+    assert buckets.take("a", 10, now=0) == pytest.approx(5)
+
+
+def test_clients_have_separate_buckets():
+    buckets = TokenBuckets(rate=1, burst=1, max_clients=10)
+    buckets.take("a", 1, now=0)
+
+    assert buckets.take("b", 1, now=0) == 0
+
+
+def test_least_recently_used_buckets_are_dropped():
+    buckets = TokenBuckets(rate=1, burst=1, max_clients=2)
+    buckets.take("a", 1, now=0)
+    buckets.take("b", 1, now=0)
+    buckets.take("a", 0, now=0)
+    buckets.take("c", 1, now=0)
+
+    assert len(buckets) == 2
+    # a is still empty; b was dropped and starts full again
+    assert buckets.take("a", 1, now=0) > 0
+    assert buckets.take("b", 1, now=0) == 0
+
+
+class App:
+    """ASGI app answering 200, optionally waiting until released"""
+
+    def __init__(self):
+        self.release = None
+
+    async def __call__(self, scope, receive, send):
+        if self.release is not None:
+            await self.release.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def request(app, path="/api/todos", method="GET", client="10.0.0.1", token=None):
+    headers = [(b"authorization", b"Bearer " + token.encode())] if token else []
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "headers": headers,
+        "client": (client, 5000),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start = messages[0]
+    return start["status"], dict(start["headers"])
+
+
+def middleware(**options):
+    # Tokens are valid when they name a user, e.g. "alice"
+    return AdmissionMiddleware(App(), token_subject=lambda token: token, **options)
+
+
+async def test_client_out_of_tokens_gets_429_with_retry_after():
+    app = middleware(rate=1, burst=2, max_concurrency=0)
+
+    assert [(await request(app))[0] for _ in range(2)] == [200, 200]
+    status, headers = await request(app)
+
+    assert status == 429
+    assert headers[b"retry-after"] == b"1"
+
+
+async def test_expensive_routes_cost_more():
+    app = middleware(rate=1, burst=10, max_concurrency=0)
+
+    assert (await request(app, "/api/token", "POST"))[0] == 200
+    assert (await request(app, "/api/token", "POST"))[0] == 429
+
+
+async def test_clients_are_limited_separately():
+    app = middleware(rate=1, burst=1, max_concurrency=0)
+    await request(app, client="10.0.0.1")
+
+    assert (await request(app, client="10.0.0.1"))[0] == 429
+    assert (await request(app, client="10.0.0.2"))[0] == 200
+    # Authenticated requests are limited per user, wherever they come from
+    assert (await request(app, client="10.0.0.1", token="alice"))[0] == 200
+    assert (await request(app, client="10.0.0.2", token="alice"))[0] == 429
+
+
+async def test_health_checks_are_never_limited():
+    app = middleware(rate=1, burst=1, max_concurrency=0)
+    await request(app)
+
+    assert (await request(app, "/healthz"))[0] == 200
+    assert (await request(app, "/metrics"))[0] == 200
+
+
+async def test_requests_beyond_the_concurrency_cap_get_503():
+    app = middleware(rate=0, max_concurrency=2)
+    app.app.release = asyncio.Event()
+    held = [asyncio.create_task(request(app)) for _ in range(2)]
+    await asyncio.sleep(0)
+
+    status, headers = await request(app)
+    assert status == 503
+    assert headers[b"retry-after"] == b"1"
+    # The event stream is not counted against the cap
+    held.append(asyncio.create_task(request(app, "/api/todos/events")))
+    app.app.release.set()
+    assert [status for status, _ in await asyncio.gather(*held)] == [200] * 3
+    assert app.in_flight == 0
+    assert (await request(app))[0] == 200
@@ -0,0 +1,135 @@
+import uuid
+
+import pytest
+
+import auth_cache
+from auth_cache import PrincipalCache, TTLCache
+
+
+class Clock:
+    """Stands in for the time module; both clocks move together"""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(auth_cache, "time", clock)
+    return clock
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = PrincipalCache(ttl=60)
+    cache.put_token("token", "alice", expires_at=clock.now + 3600)
+    cache.put_user({"username": "alice"})
+
+    clock.now += 59
+    assert cache.get_username("token") == "alice"
+    assert cache.get_user("alice") == {"username": "alice"}
+    clock.now += 1
+    assert cache.get_username("token") is None
+    assert cache.get_user("alice") is None
+
+
+def test_token_is_not_cached_past_its_own_expiry(clock):
+    cache = PrincipalCache(ttl=60)
+    cache.put_token("token", "alice", expires_at=clock.now + 10)
+
+    clock.now += 10
+    assert cache.get_username("token") is None
+    # Already expired tokens are not stored at all
+    cache.put_token("old", "alice", expires_at=clock.now - 1)
+    assert len(cache.tokens) == 0
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+
+
+def test_changed_user_is_read_again(clock):
+    cache = PrincipalCache()
+    cache.put_user({"username": "alice", "hashed_password": "old"})
+
+    cache.invalidate_user("alice")
+
+    assert cache.get_user("alice") is None
+
+
+def test_revoked_session_refuses_its_cached_tokens(clock):
+    cache = PrincipalCache()
+    cache.put_token("mine", "alice", clock.now + 600, session="s1")
+    cache.put_token("other", "alice", clock.now + 600, session="s2")
+
+    cache.revoke_session("s1", until=clock.now + 1800)
+
+    assert cache.get_username("mine") is None
+    assert cache.session_revoked("s1")
+    assert cache.get_username("other") == "alice"
+    # Forgotten once the session's tokens have expired
+    clock.now += 1800
+    assert not cache.session_revoked("s1")
+
+
+async def login(client):
+    username = f"user_{uuid.uuid4().hex[:12]}"
+    await client.post(
+        "/api/register",
+        json={
+            "email": f"{username}@example.com",
+            "username": username,
+            "password": "secret1",
+        },
+    )
+    response = await client.post(
+        "/api/token", data={"username": username, "password": "secret1"}
+    )
+    tokens = response.json()
+    return tokens, {"Authorization": "Bearer " + tokens["access_token"]}
+
+
+@pytest.mark.anyio
+async def test_logout_refuses_the_session_access_token(client):
+    tokens, headers = await login(client)
+    _, other_session = await login(client)
+    assert (await client.get("/api/users/me", headers=headers)).status_code == 200
+
+    response = await client.post(
+        "/api/token/revoke", json={"refresh_token": tokens["refresh_token"]}
+    )
+
+    assert response.status_code == 204
+    assert (await client.get("/api/users/me", headers=headers)).status_code == 401
+    assert (await client.get("/api/users/me", headers=other_session)).status_code == 200
+
+
+@pytest.mark.anyio
+async def test_replayed_refresh_token_refuses_the_session_access_token(client):
+    tokens, _ = await login(client)
+    refreshed = (
+        await client.post(
+            "/api/token/refresh", json={"refresh_token": tokens["refresh_token"]}
+        )
+    ).json()
+    headers = {"Authorization": "Bearer " + refreshed["access_token"]}
+    assert (await client.get("/api/users/me", headers=headers)).status_code == 200
+
+    replay = await client.post(
+        "/api/token/refresh", json={"refresh_token": tokens["refresh_token"]}
+    )
+
+    assert replay.status_code == 401
+    assert (await client.get("/api/users/me", headers=headers)).status_code == 401
@@ -0,0 +1,370 @@
+"""Behaviour every StorageBackend shares, run against each engine"""
+
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import refresh_tokens
+import stats
+import todo_query
+from main import SortField, TodoFilter
+
+pytestmark = pytest.mark.anyio
+
+USER_ID = 1
+OTHER_USER_ID = 2
+# Whole seconds, which every engine stores exactly
+CREATED = datetime(2024, 5, 1, 9, 0)
+
+
+def todo(todo_id, user_id=USER_ID, **fields):
+    return {
+        "id": todo_id,
+        "user_id": user_id,
+        "title": f"Todo {todo_id}",
+        "completed": False,
+        "created_at": CREATED,
+        "updated_at": CREATED,
+        **fields,
+    }
+
+
+def ids(todos):
+    return [todo["id"] for todo in todos]
+
+
+async def test_users_and_ids(store):
+    user_id = await store.next_user_id()
+    await store.create_user(
+        {
+            "id": user_id,
+            "username": "alice",
+            "email": "alice@example.com",
+            "hashed_password": "x",
+            "is_active": True,
+            "created_at": CREATED,
+        }
+    )
+
+    user = await store.get_user("alice")
+    assert (user["id"], user["email"]) == (user_id, "alice@example.com")
+    assert await store.get_user("bob") is None
+    assert await store.next_user_id() == user_id + 1
+    first = await store.next_todo_id(USER_ID)
+    assert list(await store.reserve_todo_ids(USER_ID, 3)) == [
+        first + 1,
+        first + 2,
+        first + 3,
+    ]
+    # Each user has their own sequence
+    assert await store.next_todo_id(OTHER_USER_ID) == 1
+
+
+async def test_create_read_update_delete(store):
+    await store.create_todo(todo(1, deadline=date(2024, 5, 3)))
+    await store.create_todo(todo(1, user_id=OTHER_USER_ID))
+
+    stored = await store.get_todo(1, USER_ID)
+    assert stored["title"] == "Todo 1"
+    # Deadlines are stored as midnight datetimes
+    assert stored["deadline"] == datetime(2024, 5, 3)
+
+    changed = datetime(2024, 5, 2)
+    updated = await store.update_todo(
+        1, USER_ID, {"completed": True, "priority": 1, "updated_at": changed}
+    )
+    assert (updated["completed"], updated["priority"]) == (True, 1)
+    assert (await store.get_todo(1, USER_ID))["updated_at"] == changed
+    assert await store.update_todo(9, USER_ID, {"completed": True}) is None
+
+    assert ids(await store.get_user_todos(USER_ID, {"completed": True})) == [1]
+    assert ids(await store.get_user_todos(USER_ID, {"priority": 2})) == []
+    assert ids(await store.get_todos_by_deadline("2024-05-03", USER_ID)) == [1]
+
+    assert (await store.delete_todo(1, USER_ID))["id"] == 1
+    assert await store.get_todo(1, USER_ID) is None
+    assert await store.delete_todo(1, USER_ID) is None
+    # The other user's todo with the same id is untouched
+    assert (await store.get_todo(1, OTHER_USER_ID))["title"] == "Todo 1"
+
+
+async def test_updated_todo_is_returned_as_stored(store):
+    await store.create_todo(todo(1, description="Two litres", priority=2))
+
+    updated = await store.update_todo(
+        1,
+        USER_ID,
+        {
+            "title": "Buy oat milk",
+            "description": None,
+            "deadline": date(2024, 5, 3),
+            "updated_at": datetime(2024, 5, 2, 10, 30, 15, 123456),
+        },
+    )
+
+    assert updated == await store.get_todo(1, USER_ID)
+
+
+async def test_export_is_in_id_order(store):
+    await store.create_todos([todo(3), todo(1), todo(2)])
+
+    assert ids([t async for t in store.iter_user_todos(USER_ID)]) == [1, 2, 3]
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+async def test_batch_create_statuses(store, ordered):
+    await store.create_todo(todo(2))
+
+    _, statuses = await store.create_todos([todo(1), todo(2), todo(3)], ordered)
+
+    expected_last = "skipped" if ordered else "created"
+    assert [status for status, _ in statuses] == ["created", "error", expected_last]
+    assert statuses[1][1]
+    expected_ids = [1, 2] if ordered else [1, 2, 3]
+    assert sorted(ids(await store.get_user_todos(USER_ID))) == expected_ids
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+async def test_batch_update_statuses(store, ordered):
+    await store.create_todos([todo(1), todo(3)])
+    update = {"completed": True, "updated_at": datetime(2024, 5, 2)}
+
+    statuses = await store.update_todos(
+        USER_ID, [(1, update), (2, update), (3, update)], ordered
+    )
+
+    expected_last = "skipped" if ordered else "updated"
+    assert statuses == [("updated", None), ("not_found", None), (expected_last, None)]
+    completed = ids(await store.get_user_todos(USER_ID, {"completed": True}))
+    assert sorted(completed) == ([1] if ordered else [1, 3])
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+async def test_batch_delete_statuses(store, ordered):
+    await store.create_todos([todo(1), todo(3)])
+
+    statuses = await store.delete_todos(USER_ID, [1, 2, 3], ordered)
+
+    expected_last = "skipped" if ordered else "deleted"
+    assert statuses == [("deleted", None), ("not_found", None), (expected_last, None)]
+    assert ids(await store.get_user_todos(USER_ID)) == ([3] if ordered else [])
+
+
+# (id, priority, deadline day, created minute, updated minute); ties on every
+# field are broken by id, and unset priorities and deadlines sort last
+LISTING = [
+    (1, 2, 5, 0, 4),
+    (2, None, 3, 1, 4),
+    (3, 1, None, 1, 9),
+    (4, 2, 3, 2, 0),
+    (5, None, None, 0, 7),
+    (6, 3, 5, 3, 4),
+    (7, 1, 1, 2, 2),
+]
+
+
+LISTING_TODOS = [
+    todo(
+        todo_id,
+        priority=priority,
+        deadline=None if day is None else datetime(2024, 5, day),
+        created_at=CREATED + timedelta(minutes=created),
+        updated_at=CREATED + timedelta(minutes=updated),
+    )
+    for todo_id, priority, day, created, updated in LISTING
+]
+
+
+def expected_order(field, descending):
+    valued = [t for t in LISTING_TODOS if t.get(field) is not None]
+    valued.sort(key=lambda t: (t[field], t["id"]), reverse=descending)
+    missing = [t for t in LISTING_TODOS if t.get(field) is None]
+    missing.sort(key=lambda t: t["id"], reverse=descending)
+    return ids(valued + missing)
+
+
+@pytest.mark.parametrize("sort_by", list(SortField))
+@pytest.mark.parametrize("descending", [False, True])
+@pytest.mark.parametrize("limit", [1, 2, 3])
+async def test_keyset_pages_cover_the_sorted_listing(store, sort_by, descending, limit):
+    await store.create_todos([dict(t) for t in LISTING_TODOS])
+    await store.create_todo(todo(1, user_id=OTHER_USER_ID))
+    query = todo_query.build(
+        USER_ID, TodoFilter(sort_by=sort_by, descending=descending)
+    )
+
+    everything, position = await store.get_todos_page(USER_ID, query)
+    assert position is None
+    paged = []
+    while True:
+        page, position = await store.get_todos_page(USER_ID, query, limit, position)
+        assert len(page) <= limit
+        paged += page
+        if position is None:
+            break
+
+    expected = expected_order(sort_by.value, descending)
+    assert ids(everything) == expected
+    assert ids(paged) == expected
+
+
+async def test_pages_apply_the_filter(store):
+    await store.create_todos([dict(t) for t in LISTING_TODOS])
+    spec = TodoFilter(sort_by=SortField.DEADLINE, priority=[1, 2])
+    query = todo_query.build(USER_ID, spec)
+
+    page, position = await store.get_todos_page(USER_ID, query, 2)
+    rest, end = await store.get_todos_page(USER_ID, query, 2, position)
+
+    assert ids(page) == [7, 4]
+    assert ids(rest) == [1, 3]
+    assert end is None
+
+
+async def test_search_matches_every_term(store):
+    await store.create_todos(
+        [
+            todo(1, title="Buy milk"),
+            todo(2, title="Call mum", description="Ask about the milk"),
+            todo(3, title="Buy bread"),
+            todo(4, user_id=OTHER_USER_ID, title="Buy milk"),
+        ]
+    )
+    await store.update_todo(3, USER_ID, {"title": "Buy oat milk"})
+
+    assert sorted(ids(await store.search_todos("milk", USER_ID))) == [1, 2, 3]
+    assert sorted(ids(await store.search_todos("buy milk", USER_ID))) == [1, 3]
+    assert ids(await store.search_todos("bread", USER_ID)) == []
+    assert await store.search_todos("", USER_ID) == []
+
+
+async def test_search_ranks_the_most_recently_updated_matches(store, monkeypatch):
+    import search
+
+    monkeypatch.setattr(search, "CANDIDATE_LIMIT", 2)
+    await store.create_todos(
+        [
+            todo(1, title="Milk", updated_at=CREATED),
+            todo(2, title="Oat milk", updated_at=CREATED + timedelta(hours=2)),
+            todo(3, title="Milk shake", updated_at=CREATED + timedelta(hours=1)),
+        ]
+    )
+
+    # Todo 1 would rank first, but the two newer matches are the candidates
+    assert ids(await store.search_todos("milk", USER_ID)) == [2, 3]
+
+
+async def test_changes_since_include_updates_and_tombstones(store):
+    await store.create_todos([todo(1), todo(2), todo(3), todo(4)])
+    # Whole seconds, which Mongo's milliseconds do not round below
+    since = datetime.now().replace(microsecond=0)
+
+    await store.update_todo(1, USER_ID, {"completed": True, "updated_at": since})
+    await store.delete_todo(2, USER_ID)
+    await store.delete_todos(USER_ID, [3, 9])
+
+    changed, deleted = await store.get_todo_changes(USER_ID, since)
+    assert ids(changed) == [1]
+    assert deleted == [2, 3]
+    _, deleted_for_other = await store.get_todo_changes(OTHER_USER_ID, since)
+    assert deleted_for_other == []
+
+
+async def test_calendar_buckets_by_deadline_day(store):
+    await store.create_todos(
+        [
+            todo(1, deadline=datetime(2024, 5, 2)),
+            todo(2, deadline=datetime(2024, 5, 1), completed=True),
+            todo(3, deadline=datetime(2024, 5, 2)),
+            todo(4, deadline=datetime(2024, 5, 9)),
+            todo(5),
+        ]
+    )
+
+    days = await store.get_todo_calendar(USER_ID, date(2024, 5, 1), date(2024, 5, 3))
+
+    assert [(d["_id"], d["count"], d["completed"]) for d in days] == [
+        ("2024-05-01", 1, 1),
+        ("2024-05-02", 2, 0),
+    ]
+    assert [ids(d["todos"]) for d in days] == [[2], [1, 3]]
+    counts = await store.get_todo_calendar(
+        USER_ID, date(2024, 5, 1), date(2024, 5, 3), counts_only=True
+    )
+    assert all("todos" not in d for d in counts)
+
+
+async def test_due_todos_by_deadline_then_priority(store):
+    await store.create_todos(
+        [
+            # (id, deadline day, priority, completed)
+            todo(i, deadline=datetime(2024, 5, day), priority=p, completed=done)
+            for i, day, p, done in [
+                (1, 2, None, False),
+                (2, 1, 3, False),
+                (3, 2, 1, False),
+                (4, 1, None, False),
+                (5, 2, 1, False),
+                (6, 1, 1, True),
+                (7, 9, 1, False),
+            ]
+        ]
+    )
+
+    due = await store.get_due_todos(USER_ID, date(2024, 5, 3))
+
+    assert ids(due) == [2, 4, 3, 5, 1]
+
+
+async def test_stats_follow_every_write(store):
+    today = date(2024, 5, 4)
+
+    async def check():
+        counted = stats.from_todos(USER_ID, await store.get_user_todos(USER_ID))
+        expected = stats.summarize(counted, today)
+        assert stats.summarize(await store.get_todo_stats(USER_ID), today) == expected
+        assert stats.summarize(await store.rebuild_todo_stats(USER_ID), today) == (
+            expected
+        )
+
+    await store.create_todo(todo(1, priority=1, area="work"))
+    await store.create_todos(
+        [todo(2, deadline=datetime(2024, 5, 1)), todo(3, area="life")]
+    )
+    await check()
+    await store.update_todo(1, USER_ID, {"completed": True, "priority": 2})
+    await store.update_todos(USER_ID, [(2, {"area": "work"}), (9, {"area": "life"})])
+    await check()
+    await store.delete_todo(3, USER_ID)
+    await store.delete_todos(USER_ID, [1, 9])
+    await check()
+
+    summary = stats.summarize(await store.get_todo_stats(USER_ID), today)
+    assert (summary["total"], summary["overdue"], summary["by_area"]) == (
+        1,
+        1,
+        {"work": 1},
+    )
+
+
+async def test_refresh_token_rotation_and_revocation(store):
+    user = {"id": USER_ID, "username": "alice"}
+    # Issued now, as Mongo's TTL index drops expired records
+    now = datetime.now().replace(microsecond=0)
+    _, record = refresh_tokens.issue(user, now)
+    _, sibling = refresh_tokens.issue(user, now, record["family"])
+    await store.create_refresh_token(record)
+    await store.create_refresh_token(sibling)
+
+    used = now + timedelta(minutes=1)
+    first = await store.use_refresh_token(record["token_hash"], used)
+    assert (first["family"], first["user_id"]) == (record["family"], USER_ID)
+    assert first.get("used_at") is None
+    # A second use returns the record as marked by the first
+    assert (await store.use_refresh_token(record["token_hash"], used))[
+        "used_at"
+    ] == used
+    assert await store.use_refresh_token("unknown", used) is None
+
+    await store.revoke_refresh_tokens(record["family"])
+    assert await store.use_refresh_token(sibling["token_hash"], used) is None
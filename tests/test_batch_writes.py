@@ -0,0 +1,272 @@
+"""Batch writes on MongoDB racing with other writes to the same todos"""
+
+import asyncio
+from datetime import date, datetime
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+USER_ID = 1
+
+
+def _counts(summary: dict) -> dict:
+    counts = {}
+    for name, value in summary.items():
+        if isinstance(value, dict):
+            value = {key: count for key, count in value.items() if count}
+        if name not in ("_id", "rebuilt_at", "version") and value:
+            counts[name] = value
+    return counts
+
+
+async def _assert_stats_exact(database):
+    summary = await database.todo_stats_collection.find_one({"_id": USER_ID})
+    assert _counts(summary) == _counts(await database.rebuild_todo_stats(USER_ID))
+
+
+def _update(**fields) -> dict:
+    return {**fields, "updated_at": datetime.now()}
+
+
+@pytest.fixture
+async def db(mongo_database):
+    now = datetime.now()
+    todo_ids = await mongo_database.reserve_todo_ids(USER_ID, 4)
+    await mongo_database.create_todos(
+        [
+            {
+                "id": todo_id,
+                "user_id": USER_ID,
+                "title": f"Todo {todo_id}",
+                "completed": False,
+                "priority": 1,
+                "created_at": now,
+                "updated_at": now,
+            }
+            for todo_id in todo_ids
+        ]
+    )
+    return mongo_database
+
+
+def _after_read(monkeypatch, database, write):
+    """Run ``write`` once, right after the batch read its todos"""
+    read = database._existing_todos
+    pending = [write]
+
+    async def existing_todos(user_id, todo_ids):
+        todos = await read(user_id, todo_ids)
+        if pending:
+            await pending.pop()()
+        return todos
+
+    monkeypatch.setattr(database, "_existing_todos", existing_todos)
+
+
+async def test_update_of_a_todo_changed_since_the_read_is_applied_again(
+    db, monkeypatch
+):
+    _after_read(
+        monkeypatch, db, lambda: db.update_todo(1, USER_ID, _update(completed=True))
+    )
+
+    statuses = await db.update_todos(
+        USER_ID, [(1, _update(priority=3)), (2, _update(priority=3))]
+    )
+
+    assert statuses == [("updated", None), ("updated", None)]
+    todo = await db.get_todo(1, USER_ID)
+    assert (todo["completed"], todo["priority"]) == (True, 3)
+    await _assert_stats_exact(db)
+
+
+async def test_update_missing_a_todo_changed_since_the_read_is_not_lost(
+    db, monkeypatch
+):
+    # Todo 1 takes its update; todo 2 changes in between and misses it
+    _after_read(
+        monkeypatch, db, lambda: db.update_todo(2, USER_ID, _update(priority=2))
+    )
+
+    statuses = await db.update_todos(
+        USER_ID, [(1, _update(title="Renamed")), (2, _update(completed=True))]
+    )
+
+    assert statuses == [("updated", None), ("updated", None)]
+    assert (await db.get_todo(1, USER_ID))["title"] == "Renamed"
+    todo = await db.get_todo(2, USER_ID)
+    assert (todo["completed"], todo["priority"]) == (True, 2)
+    summary = await db.todo_stats_collection.find_one({"_id": USER_ID})
+    assert "rebuilt_at" not in summary
+    await _assert_stats_exact(db)
+
+
+def test_update_fields_left_at_their_default_are_carried():
+    import database
+
+    stored = {"id": 1, "user_id": USER_ID, "title": "Todo", "priority": 1}
+
+    assert database._carries(
+        stored,
+        {
+            "title": "Todo",
+            "description": None,
+            "completed": False,
+            "title_terms": ["t", "to"],
+        },
+    )
+    assert not database._carries(stored, {"completed": True})
+    assert not database._carries({**stored, "completed": True}, {"completed": False})
+
+
+async def test_update_of_a_todo_deleted_since_the_read_is_not_found(db, monkeypatch):
+    _after_read(monkeypatch, db, lambda: db.delete_todo(1, USER_ID))
+
+    statuses = await db.update_todos(
+        USER_ID, [(1, _update(completed=True)), (2, _update(completed=True))]
+    )
+
+    assert statuses == [("not_found", None), ("updated", None)]
+    await _assert_stats_exact(db)
+
+
+async def test_unattributable_update_rebuilds_the_stats(db, monkeypatch):
+    # Todo 1 changes before the bulk write and todo 2 right after it, so one
+    # update matched but neither todo holds its fields any more
+    _after_read(
+        monkeypatch, db, lambda: db.update_todo(1, USER_ID, _update(completed=True))
+    )
+    bulk_write = db._bulk_write
+
+    async def write_then_change(operations, ordered):
+        result = await bulk_write(operations, ordered)
+        await db.update_todo(2, USER_ID, _update(priority=2))
+        return result
+
+    monkeypatch.setattr(db, "_bulk_write", write_then_change)
+
+    statuses = await db.update_todos(
+        USER_ID, [(1, _update(priority=3)), (2, _update(priority=3))]
+    )
+
+    assert statuses == [("updated", None), ("updated", None)]
+    summary = await db.todo_stats_collection.find_one({"_id": USER_ID})
+    assert "rebuilt_at" in summary
+    await _assert_stats_exact(db)
+
+
+async def test_delete_of_a_todo_changed_since_the_read(db, monkeypatch):
+    _after_read(
+        monkeypatch, db, lambda: db.update_todo(1, USER_ID, _update(priority=3))
+    )
+
+    statuses = await db.delete_todos(USER_ID, [1, 2])
+
+    assert statuses == [("deleted", None), ("deleted", None)]
+    assert await db.get_todo(1, USER_ID) is None
+    await _assert_stats_exact(db)
+
+
+async def test_single_delete_racing_a_batch_delete(db, monkeypatch):
+    bulk_write = db._bulk_write
+
+    async def delete_then_write(operations, ordered):
+        await db.delete_todo(1, USER_ID)
+        return await bulk_write(operations, ordered)
+
+    monkeypatch.setattr(db, "_bulk_write", delete_then_write)
+
+    statuses = await db.delete_todos(USER_ID, [1, 2])
+
+    assert statuses == [("not_found", None), ("deleted", None)]
+    _, tombstones = await db.get_todo_changes(USER_ID, datetime(2000, 1, 1))
+    assert tombstones == [1, 2]
+    await _assert_stats_exact(db)
+
+
+async def test_failed_batch_delete_gives_its_claims_back(db, monkeypatch):
+    async def fail(operations, ordered):
+        raise RuntimeError("connection lost")
+
+    monkeypatch.setattr(db, "_bulk_write", fail)
+
+    with pytest.raises(RuntimeError):
+        await db.delete_todos(USER_ID, [1, 2])
+
+    assert await db.tombstones_collection.count_documents({}) == 0
+    assert (await db.delete_todo(1, USER_ID))["id"] == 1
+
+
+async def test_overlapping_batch_deletes_report_each_todo_once(db):
+    first, second = await asyncio.gather(
+        db.delete_todos(USER_ID, [1, 2, 3]), db.delete_todos(USER_ID, [3, 2, 1])
+    )
+
+    deleted = [
+        todo_id
+        for todo_ids, statuses in (([1, 2, 3], first), ([3, 2, 1], second))
+        for todo_id, (status, _) in zip(todo_ids, statuses)
+        if status == "deleted"
+    ]
+    assert sorted(deleted) == [1, 2, 3]
+    _, tombstones = await db.get_todo_changes(USER_ID, datetime(2000, 1, 1))
+    assert tombstones == [1, 2, 3]
+    assert await db.tombstones_collection.count_documents({}) == 3
+    await _assert_stats_exact(db)
+
+
+async def test_deleting_a_missing_todo_leaves_no_tombstone(db):
+    assert await db.delete_todo(99, USER_ID) is None
+    assert await db.delete_todos(USER_ID, [98, 4]) == [
+        ("not_found", None),
+        ("deleted", None),
+    ]
+
+    _, tombstones = await db.get_todo_changes(USER_ID, datetime(2000, 1, 1))
+    assert tombstones == [4]
+
+
+async def test_day_counters_are_removed_at_zero(db):
+    day = date(2024, 5, 3)
+    await db.update_todo(1, USER_ID, _update(deadline=day))
+    await db.update_todo(2, USER_ID, _update(deadline=day))
+    await db.update_todo(1, USER_ID, _update(completed=True))
+
+    summary = await db.todo_stats_collection.find_one({"_id": USER_ID})
+    assert summary["open_by_deadline"] == {"2024-05-03": 1}
+
+    await db.delete_todo(2, USER_ID)
+
+    summary = await db.todo_stats_collection.find_one({"_id": USER_ID})
+    assert summary["open_by_deadline"] == {}
+    await _assert_stats_exact(db)
+
+
+async def test_rebuild_keeps_increments_landing_while_it_counts(db, monkeypatch):
+    count = db._count_todo_stats
+    pending = [
+        lambda: db.create_todo(
+            {
+                "id": 5,
+                "user_id": USER_ID,
+                "title": "Todo 5",
+                "created_at": datetime.now(),
+                "updated_at": datetime.now(),
+            }
+        )
+    ]
+
+    async def count_then_create(user_id):
+        summary = await count(user_id)
+        if pending:
+            await pending.pop()()
+        return summary
+
+    monkeypatch.setattr(db, "_count_todo_stats", count_then_create)
+
+    summary = await db.rebuild_todo_stats(USER_ID)
+
+    assert summary["total"] == 5
+    stored = await db.todo_stats_collection.find_one({"_id": USER_ID})
+    assert stored["total"] == 5
@@ -0,0 +1,38 @@
+from datetime import date, datetime
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_due_todos_by_deadline_then_priority(mongo_database):
+    now = datetime.now()
+    todos = [
+        # (id, deadline day, priority, completed)
+        (1, 2, None, False),
+        (2, 1, 3, False),
+        (3, 2, 1, False),
+        (4, 1, None, False),
+        (5, 2, 1, False),
+        (6, 1, 1, True),
+        (7, 9, 1, False),
+    ]
+    await mongo_database.create_todos(
+        [
+            {
+                "id": todo_id,
+                "user_id": 1,
+                "title": f"Todo {todo_id}",
+                "deadline": datetime(2024, 5, day),
+                "priority": priority,
+                "completed": completed,
+                "created_at": now,
+                "updated_at": now,
+            }
+            for todo_id, day, priority, completed in todos
+        ]
+    )
+
+    due = await mongo_database.get_due_todos(1, date(2024, 5, 3))
+
+    assert [todo["id"] for todo in due] == [2, 4, 3, 5, 1]
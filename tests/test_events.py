@@ -0,0 +1,87 @@
+import orjson
+import pytest
+
+import events
+from events import HEARTBEAT, EventBroker
+
+pytestmark = pytest.mark.anyio
+
+USER_ID = 1
+
+
+def event(todo_id: int) -> dict:
+    return events.deleted_event(todo_id)
+
+
+def parse(message: bytes) -> tuple:
+    fields = dict(line.split(": ", 1) for line in message.decode().strip().splitlines())
+    return fields["event"], orjson.loads(fields["data"])
+
+
+async def test_events_reach_every_stream_of_their_user():
+    broker = EventBroker()
+    mine, also_mine = broker.subscribe(USER_ID), broker.subscribe(USER_ID)
+    theirs = broker.subscribe(2)
+
+    broker.publish(USER_ID, [event(1), event(2)])
+
+    for subscription in (mine, also_mine):
+        queued = [subscription.queue.get_nowait() for _ in range(2)]
+        assert [parse(message)[1]["id"] for message in queued] == [1, 2]
+    assert theirs.queue.empty()
+
+
+async def test_stream_falling_behind_gets_resync_and_ends():
+    broker = EventBroker(max_queue=2)
+    subscription = broker.subscribe(USER_ID)
+
+    broker.publish(USER_ID, [event(1), event(2), event(3)])
+    broker.publish(USER_ID, [event(4)])
+
+    assert subscription.overflowed
+    assert subscription.queue.qsize() == 2
+    messages = [message async for message in broker.stream(subscription, b"ready", 1)]
+    assert messages[0] == b"ready"
+    assert [parse(message)[0] for message in messages[1:]] == ["resync"]
+
+
+async def test_idle_stream_sends_heartbeats():
+    broker = EventBroker()
+    subscription = broker.subscribe(USER_ID)
+    stream = broker.stream(subscription, b"ready", 0.01)
+
+    assert await stream.__anext__() == b"ready"
+    assert await stream.__anext__() == HEARTBEAT
+    assert await stream.__anext__() == HEARTBEAT
+    broker.publish(USER_ID, [event(1)])
+    assert parse(await stream.__anext__()) == ("deleted", {"type": "deleted", "id": 1})
+    await stream.aclose()
+
+
+async def test_disconnected_client_is_unsubscribed(auth_headers):
+    import main
+
+    user = await main.get_current_user(auth_headers["Authorization"].split()[1])
+    response = await main.todo_events(current_user=user)
+    body = response.body_iterator
+
+    assert parse(await body.__anext__())[0] == "ready"
+    assert user["id"] in events.event_broker.subscribers
+
+    # The server closes the generator when the client goes away
+    await body.aclose()
+
+    assert user["id"] not in events.event_broker.subscribers
+
+
+async def test_unsubscribing_keeps_the_user_s_other_streams():
+    broker = EventBroker()
+    first, second = broker.subscribe(USER_ID), broker.subscribe(USER_ID)
+
+    broker.unsubscribe(USER_ID, first)
+    broker.publish(USER_ID, [event(1)])
+
+    assert broker.subscribers == {USER_ID: {second}}
+    assert first.queue.empty() and second.queue.qsize() == 1
+    broker.unsubscribe(USER_ID, second)
+    assert broker.subscribers == {}
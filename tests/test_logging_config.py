@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+
+import logging_config
+
+
+def test_importing_the_app_starts_no_log_writer():
+    # Started by the lifespan handler in each worker, never before a fork;
+    # checked in a fresh interpreter since other tests run the lifespan
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import main, logging_config; assert logging_config._listener is None",
+        ],
+        cwd=os.path.dirname(logging_config.__file__),
+        check=True,
+    )
+
+
+def test_redact_headers():
+    headers = {"Authorization": "Bearer secret", "Accept": "*/*"}
+
+    assert logging_config.redact_headers(headers) == {
+        "Authorization": "[REDACTED]",
+        "Accept": "*/*",
+    }
+
+
+def test_sample_rates():
+    assert logging_config.parse_sample_rates("/api/todos=0.1, /api/test=0") == {
+        "/api/todos": 0.1,
+        "/api/test": 0.0,
+    }
@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+import pytest
+
+from metrics import MongoCommandMetrics
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_requests_are_labelled_by_route_template(client, auth_headers):
+    await client.get("/api/todos/987654", headers=auth_headers)
+
+    body = (await client.get("/metrics")).text
+
+    assert (
+        'taskdo_http_requests_total{method="GET",route="/api/todos/{todo_id}",'
+        'status="404"}' in body
+    )
+    assert "/api/todos/987654" not in body
+
+
+async def test_mongodb_commands_are_timed_by_collection(client):
+    listener = MongoCommandMetrics()
+    started = SimpleNamespace(
+        command_name="find",
+        command={"find": "metrics_probe", "filter": {}},
+        connection_id=("localhost", 27017),
+        request_id=1,
+    )
+    listener.started(started)
+    listener.succeeded(SimpleNamespace(**vars(started), duration_micros=1500))
+    listener.started(SimpleNamespace(**{**vars(started), "request_id": 2}))
+    listener.failed(
+        SimpleNamespace(**{**vars(started), "request_id": 2}, duration_micros=10)
+    )
+
+    body = (await client.get("/metrics")).text
+
+    assert (
+        'taskdo_mongodb_command_duration_seconds_count{collection="metrics_probe",'
+        'command="find"} 2.0' in body
+    )
+    assert (
+        'taskdo_mongodb_command_failures_total{collection="metrics_probe",'
+        'command="find"} 1.0' in body
+    )
+    assert not listener._collections
+
+
+@pytest.mark.mongo_server
+async def test_mongodb_client_reports_its_commands(mongo_database, client):
+    await mongo_database.get_todo(1, 1)
+
+    body = (await client.get("/metrics")).text
+
+    assert (
+        'taskdo_mongodb_command_duration_seconds_count{collection="todos",'
+        'command="find"}' in body
+    )
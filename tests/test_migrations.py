@@ -0,0 +1,170 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+import migrations
+import storage
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_migrate_renumbers_duplicate_todo_ids(mongo_db):
+    await mongo_db["users"].insert_one({"id": 1, "username": "alice"})
+    await mongo_db["todos"].insert_many(
+        [
+            {"user_id": 1, "id": todo_id, "title": f"Todo {n}"}
+            for n, todo_id in enumerate([1, 2, 2, 3, 2])
+        ]
+    )
+
+    assert await migrations.migrate(mongo_db) == migrations.MIGRATIONS[-1].version
+
+    todos = await mongo_db["todos"].find().sort("_id", 1).to_list(length=None)
+    assert [todo[storage.key("id")] for todo in todos] == [1, 2, 4, 3, 5]
+    counter = await mongo_db["counters"].find_one({"_id": "todos:1"})
+    assert counter["seq"] == 5
+
+
+async def test_migrate_refuses_users_sharing_an_id(mongo_db):
+    await mongo_db["users"].insert_many(
+        [{"id": 1, "username": "alice"}, {"id": 1, "username": "bob"}]
+    )
+
+    with pytest.raises(RuntimeError, match="unique username and id"):
+        await migrations.migrate(mongo_db)
+    assert await migrations.get_applied_version(mongo_db) == 0
+
+
+@pytest.fixture
+def counted_migrations(monkeypatch):
+    """Two slow migrations recording each time they are applied"""
+    applied = []
+
+    def migration(version):
+        async def apply(db):
+            applied.append(version)
+            await asyncio.sleep(0.05)
+
+        return migrations.Migration(version, f"migration {version}", apply)
+
+    monkeypatch.setattr(migrations, "MIGRATIONS", [migration(1), migration(2)])
+    monkeypatch.setattr(migrations, "MIGRATION_LOCK_POLL_SECONDS", 0.01)
+    return applied
+
+
+async def test_concurrent_runners_apply_each_migration_once(
+    mongo_db, counted_migrations
+):
+    versions = await asyncio.gather(*(migrations.migrate(mongo_db) for _ in range(3)))
+
+    assert versions == [2, 2, 2]
+    assert counted_migrations == [1, 2]
+    # The lock is released
+    assert await mongo_db[migrations.MIGRATION_LOCK_COLLECTION].count_documents({}) == 0
+
+
+async def test_runner_waits_while_the_lock_is_held(mongo_db, counted_migrations):
+    await mongo_db[migrations.MIGRATION_LOCK_COLLECTION].insert_one(
+        {
+            "_id": "migrations",
+            "owner": "other",
+            "expires_at": datetime.now() + timedelta(minutes=5),
+        }
+    )
+
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(migrations.migrate(mongo_db), 0.2)
+    assert counted_migrations == []
+
+
+async def test_lock_of_a_runner_that_died_is_taken_over(mongo_db, counted_migrations):
+    await mongo_db[migrations.MIGRATION_LOCK_COLLECTION].insert_one(
+        {
+            "_id": "migrations",
+            "owner": "dead",
+            "expires_at": datetime.now() - timedelta(seconds=1),
+        }
+    )
+
+    assert await migrations.migrate(mongo_db) == 2
+    assert counted_migrations == [1, 2]
+
+
+async def test_workers_wait_for_the_release_step(mongo_db, counted_migrations):
+    waiting = asyncio.create_task(migrations.wait_for_migrations(mongo_db))
+    await asyncio.sleep(0.05)
+    assert not waiting.done()
+
+    await migrations.migrate(mongo_db)
+
+    assert await asyncio.wait_for(waiting, 1) == 2
+
+
+async def test_workers_give_up_on_a_database_never_migrated(
+    mongo_db, counted_migrations, monkeypatch
+):
+    monkeypatch.setattr(migrations, "MIGRATION_WAIT", timedelta(seconds=0.05))
+
+    with pytest.raises(RuntimeError, match="python migrations.py"):
+        await migrations.wait_for_migrations(mongo_db)
+
+
+async def _migrate_to(db, version):
+    for migration in migrations.MIGRATIONS[:version]:
+        await migration.apply(db)
+
+
+async def test_compaction_builds_its_indexes_before_dropping_any(mongo_db, monkeypatch):
+    await mongo_db["todos"].insert_many(
+        [{"user_id": 1, "id": todo_id, "title": "Todo"} for todo_id in (1, 2)]
+    )
+    await _migrate_to(mongo_db, 6)
+    old = set(await mongo_db["todos"].index_information())
+
+    def interrupted(todo):
+        raise RuntimeError("interrupted")
+
+    monkeypatch.setattr(storage, "encode", interrupted)
+    with pytest.raises(RuntimeError):
+        await migrations._compact_todos(mongo_db)
+    monkeypatch.undo()
+
+    # Only the old unique index is gone, and the new ones are all there
+    during = set(await mongo_db["todos"].index_information())
+    assert old - during == {"user_id_1_id_1"}
+    assert len(during - old) == len(migrations._compact_indexes())
+
+    await migrations._compact_todos(mongo_db)
+
+    assert set(await mongo_db["todos"].index_information()) == {"_id_"} | (during - old)
+    assert await mongo_db["todos"].count_documents({"u": 1}) == 2
+    with pytest.raises(DuplicateKeyError):
+        await mongo_db["todos"].insert_one({"u": 1, "i": 2})
+
+
+@pytest.mark.mongo_server
+async def test_every_query_uses_an_index(mongo_db):
+    await migrations.migrate(mongo_db)
+    now = datetime(2024, 1, 1)
+    await mongo_db["users"].insert_one({"id": 1, "username": "alice"})
+    await mongo_db["todos"].insert_one(
+        storage.encode(
+            {
+                "user_id": 1,
+                "id": 1,
+                "title": "Buy milk",
+                "priority": 1,
+                "deadline": now,
+                "created_at": now,
+                "updated_at": now,
+            }
+        )
+    )
+
+    plans = await migrations.check_query_plans(mongo_db)
+
+    assert set(plans) == set(migrations.query_shapes(mongo_db)) | set(
+        migrations.listing_shapes()
+    )
@@ -0,0 +1,76 @@
+import orjson
+import pytest
+
+import ndjson
+
+pytestmark = pytest.mark.anyio
+
+
+async def chunked(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+async def lines(*chunks: bytes, max_line_bytes: int = 8):
+    return [line async for line in ndjson.iter_lines(chunked(*chunks), max_line_bytes)]
+
+
+async def test_lines_are_split_across_chunks():
+    assert await lines(b'{"a"', b":1}\n\n", b"  \n{}\n") == [
+        (1, b'{"a":1}'),
+        (4, b"{}"),
+    ]
+
+
+async def test_line_ending_at_a_chunk_boundary():
+    assert await lines(b"first\n", b"second\n") == [(1, b"first"), (2, b"second")]
+    assert await lines(b"first", b"\nsecond") == [(1, b"first"), (2, b"second")]
+
+
+async def test_final_line_without_a_newline():
+    assert await lines(b"first\nlast") == [(1, b"first"), (2, b"last")]
+
+
+async def test_oversized_line_spanning_several_chunks_is_reported_once():
+    assert await lines(b"ok\n012345", b"6789abcdef", b"ghij", b"k\nnext\n") == [
+        (1, b"ok"),
+        (2, None),
+        (3, b"next"),
+    ]
+    # Also when it is the last line of the body
+    assert await lines(b"012345", b"6789abc") == [(1, None)]
+
+
+async def test_line_of_exactly_the_limit_is_kept():
+    assert await lines(b"0123", b"4567\n") == [(1, b"01234567")]
+
+
+async def test_import_reports_failing_lines(client, auth_headers, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "MAX_IMPORT_LINE_BYTES", 64)
+    body = b"\n".join(
+        [
+            orjson.dumps({"title": "Buy milk"}),
+            orjson.dumps({"title": "x" * 100}),
+            b"",
+            b'{"priority": 9}',
+            orjson.dumps({"title": "Call mom", "area": "life"}),
+        ]
+    )
+
+    async def stream():
+        # Chunks splitting the oversized line and the last one
+        for start in range(0, len(body), 40):
+            yield body[start : start + 40]
+
+    response = await client.post(
+        "/api/todos/import", content=stream(), headers=auth_headers
+    )
+
+    result = response.json()
+    assert (result["imported"], result["failed"]) == (2, 2)
+    assert [error["line"] for error in result["errors"]] == [2, 4]
+    assert "longer than 64 bytes" in result["errors"][0]["detail"]
+    todos = (await client.get("/api/todos", headers=auth_headers)).json()
+    assert sorted(todo["title"] for todo in todos) == ["Buy milk", "Call mom"]
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import uuid
+
+import pytest
+
+from passwords import HasherBusy, PasswordHasher
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(rounds=4, max_workers=1, max_queue=1)
+    yield hasher
+    hasher.shutdown()
+
+
+async def test_hash_and_verify(hasher):
+    hashed = await hasher.hash("secret1")
+
+    assert await hasher.verify("secret1", hashed)
+    assert not await hasher.verify("wrong", hashed)
+
+
+async def test_hashes_made_with_other_rounds_still_verify(hasher):
+    stronger = PasswordHasher(rounds=5)
+    hashed = await stronger.hash("secret1")
+    stronger.shutdown()
+
+    assert hashed.startswith("$2b$05$")
+    assert await hasher.verify("secret1", hashed)
+    assert not await hasher.verify("wrong", hashed)
+    # New hashes use the hasher's own rounds
+    assert (await hasher.hash("secret1")).startswith("$2b$04$")
+
+
+async def test_calls_beyond_the_pending_limit_are_rejected(hasher, monkeypatch):
+    release = threading.Event()
+
+    def slow_hash(password):
+        release.wait(5)
+        return "hashed"
+
+    monkeypatch.setattr(hasher.context, "hash", slow_hash)
+    # One call runs and one waits for the only worker
+    held = [asyncio.create_task(hasher.hash("secret1")) for _ in range(2)]
+    await asyncio.sleep(0)
+
+    with pytest.raises(HasherBusy):
+        await hasher.hash("secret1")
+    release.set()
+    assert await asyncio.gather(*held) == ["hashed", "hashed"]
+    stats = hasher.stats()
+    assert (stats["pending"], stats["rejected"]) == (0, 1)
+    assert stats["hash"]["count"] == 2
+
+
+async def test_busy_hasher_answers_503(client, monkeypatch):
+    import main
+
+    username = f"user_{uuid.uuid4().hex[:12]}"
+    await client.post(
+        "/api/register",
+        json={
+            "email": f"{username}@example.com",
+            "username": username,
+            "password": "secret1",
+        },
+    )
+
+    async def busy(*args):
+        raise HasherBusy("Too many password operations in progress")
+
+    monkeypatch.setattr(main.password_hasher, "verify", busy)
+
+    response = await client.post(
+        "/api/token", data={"username": username, "password": "secret1"}
+    )
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
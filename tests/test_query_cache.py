@@ -0,0 +1,155 @@
+import hashlib
+from typing import Dict, Optional
+
+import pytest
+
+from query_cache import CacheBackend, LRUCacheBackend, QueryCache
+
+pytestmark = pytest.mark.anyio
+
+
+class SharedFake(CacheBackend):
+    """Dict standing in for a store shared by every worker, such as Redis"""
+
+    def __init__(self):
+        self.entries: Dict[str, bytes] = {}
+        self.generations: Dict[int, int] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.entries.get(key)
+
+    async def set(self, key: str, value: bytes) -> None:
+        self.entries[key] = value
+
+    async def get_generation(self, user_id: int) -> int:
+        return self.generations.get(user_id, 0)
+
+    async def bump_generation(self, user_id: int) -> int:
+        self.generations[user_id] = self.generations.get(user_id, 0) + 1
+        return self.generations[user_id]
+
+
+class Loader:
+    def __init__(self, value: bytes):
+        self.value = value
+        self.calls = 0
+
+    async def __call__(self) -> bytes:
+        self.calls += 1
+        return self.value
+
+
+async def test_shared_backend_invalidates_across_workers():
+    shared = SharedFake()
+    first, second = QueryCache(shared), QueryCache(shared)
+    load = Loader(b"[1]")
+
+    assert await first.get_or_load(1, "list", {"area": "work"}, load) == b"[1]"
+    assert await second.get_or_load(1, "list", {"area": "work"}, load) == b"[1]"
+    assert load.calls == 1
+
+    # A write handled by the first worker is seen by the second
+    await first.invalidate_user(1)
+    load.value = b"[1,2]"
+    assert await second.get_or_load(1, "list", {"area": "work"}, load) == b"[1,2]"
+    assert load.calls == 2
+    assert second.stats()["hit_ratio"] == 0.5
+
+
+async def test_invalidation_is_per_user():
+    cache = QueryCache(LRUCacheBackend())
+    mine, theirs = Loader(b"[1]"), Loader(b"[2]")
+    await cache.get_or_load(1, "list", {}, mine)
+    await cache.get_or_load(2, "list", {}, theirs)
+
+    await cache.invalidate_user(1)
+    await cache.get_or_load(1, "list", {}, mine)
+    await cache.get_or_load(2, "list", {}, theirs)
+
+    assert (mine.calls, theirs.calls) == (2, 1)
+
+
+async def test_generations_are_bounded_without_reviving_old_entries():
+    backend = LRUCacheBackend(maxsize=2)
+    cache = QueryCache(backend)
+    load = Loader(b"[1]")
+    await cache.get_or_load(1, "list", {}, load)
+    await cache.invalidate_user(1)
+    await cache.get_or_load(1, "list", {}, load)
+
+    # Users 2 and 3 push user 1's generation out
+    await cache.invalidate_user(2)
+    await cache.invalidate_user(3)
+
+    assert list(backend.generations) == [2, 3]
+    await cache.get_or_load(1, "list", {}, load)
+    assert load.calls == 3
+
+
+def test_cache_is_off_by_default():
+    import query_cache
+
+    assert not query_cache.result_cache.enabled
+
+
+async def test_parameters_are_normalized():
+    cache = QueryCache(LRUCacheBackend())
+    load = Loader(b"[]")
+
+    await cache.get_or_load(1, "list", {"a": 1, "b": None, "c": 2}, load)
+    await cache.get_or_load(1, "list", {"c": 2, "a": 1}, load)
+
+    assert load.calls == 1
+
+
+async def test_list_etag_is_the_hash_of_the_body(client, auth_headers):
+    await client.post("/api/todos", json={"title": "Buy milk"}, headers=auth_headers)
+
+    response = await client.get("/api/todos", headers=auth_headers)
+
+    digest = hashlib.sha1(response.content).hexdigest()
+    assert response.headers["etag"] == f'"{digest}"'
+    not_modified = await client.get(
+        "/api/todos",
+        headers={**auth_headers, "If-None-Match": response.headers["etag"]},
+    )
+    assert not_modified.status_code == 304
+
+
+@pytest.mark.parametrize(
+    "header, matches",
+    [
+        ('"abc"', True),
+        ('W/"abc"', True),
+        ('"old", W/"abc"', True),
+        ("*", True),
+        ('"ab"', False),
+        ('"abcd"', False),
+        ('"x", "abc"d', False),
+        ("", False),
+    ],
+)
+def test_if_none_match_is_parsed_as_a_list_of_tags(header, matches):
+    from main import etag_matches
+
+    assert etag_matches(header, '"abc"') is matches
+
+
+async def test_list_etag_changes_with_the_todos(client, auth_headers):
+    response = await client.post(
+        "/api/todos", json={"title": "Buy milk"}, headers=auth_headers
+    )
+    todo_id = response.json()["id"]
+    before = await client.get("/api/todos", headers=auth_headers)
+
+    await client.put(
+        f"/api/todos/{todo_id}", json={"completed": True}, headers=auth_headers
+    )
+    after = await client.get(
+        "/api/todos",
+        headers={**auth_headers, "If-None-Match": before.headers["etag"]},
+    )
+
+    assert after.status_code == 200
+    assert after.json()[0]["completed"] is True
+    assert after.headers["etag"] != before.headers["etag"]
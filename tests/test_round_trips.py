@@ -0,0 +1,99 @@
+"""Commands each todo write sends to MongoDB"""
+
+from datetime import datetime
+
+import pytest
+from pymongo import monitoring
+
+pytestmark = [pytest.mark.anyio, pytest.mark.mongo_server]
+
+USER_ID = 1
+
+
+class CommandLog(monitoring.CommandListener):
+    def __init__(self, database_name: str):
+        self.database_name = database_name
+        self.commands = []
+
+    def started(self, event):
+        if event.database_name == self.database_name:
+            self.commands.append(
+                (event.command_name, event.command.get(event.command_name))
+            )
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+@pytest.fixture
+async def db(mongo_database, monkeypatch):
+    now = datetime.now()
+    todo_ids = await mongo_database.reserve_todo_ids(USER_ID, 3)
+    await mongo_database.create_todos(
+        [
+            {
+                "id": todo_id,
+                "user_id": USER_ID,
+                "title": f"Todo {todo_id}",
+                "created_at": now,
+                "updated_at": now,
+            }
+            for todo_id in todo_ids
+        ]
+    )
+    # Reconnect with the listener; the todos are already in the database
+    log = CommandLog(mongo_database.DB_NAME)
+    client_options = mongo_database.client_options
+
+    def options():
+        options = client_options()
+        options["event_listeners"] = options["event_listeners"] + [log]
+        return options
+
+    monkeypatch.setattr(mongo_database, "client_options", options)
+    mongo_database.close()
+    mongo_database.connect()
+    mongo_database.log = log
+    return mongo_database
+
+
+async def test_update_is_one_find_and_modify_and_one_stats_update(db):
+    await db.update_todo(1, USER_ID, {"completed": True, "updated_at": datetime.now()})
+
+    assert db.log.commands == [("findAndModify", "todos"), ("update", "todo_stats")]
+
+
+async def test_delete_is_find_and_modify_tombstone_and_stats_update(db):
+    await db.delete_todo(1, USER_ID)
+
+    assert db.log.commands == [
+        ("findAndModify", "todos"),
+        ("update", "tombstones"),
+        ("update", "todo_stats"),
+    ]
+
+    db.log.commands.clear()
+    assert await db.delete_todo(1, USER_ID) is None
+    assert db.log.commands == [("findAndModify", "todos")]
+
+
+async def test_batch_writes_do_not_grow_with_the_batch(db):
+    update = {"completed": True, "updated_at": datetime.now()}
+    await db.update_todos(USER_ID, [(1, update), (2, update)])
+    assert db.log.commands == [
+        ("find", "todos"),
+        ("update", "todos"),
+        ("update", "todo_stats"),
+    ]
+
+    db.log.commands.clear()
+    await db.delete_todos(USER_ID, [1, 2, 3])
+    assert db.log.commands == [
+        ("find", "todos"),
+        ("insert", "tombstones"),
+        ("delete", "todos"),
+        ("update", "todo_stats"),
+    ]
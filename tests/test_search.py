@@ -0,0 +1,39 @@
+import pytest
+
+import search
+
+
+def test_index_terms_are_word_prefixes():
+    assert search.index_terms("Buy milk") == ["b", "bu", "buy", "m", "mi", "mil", "milk"]
+
+
+def test_index_terms_fold_case_and_accents():
+    assert search.index_terms("Café") == search.index_terms("cafe")
+
+
+def test_index_terms_are_capped():
+    text = " ".join(f"word{i:06d}" for i in range(10_000))
+
+    terms = search.index_terms(text)
+
+    assert len(terms) == search.MAX_INDEX_TERMS
+    # The first words of the text are the ones kept
+    assert "word000000" in terms
+    assert "word009999" not in terms
+
+
+def test_query_terms_longest_first():
+    assert search.query_terms("buy mi") == ["buy", "mi"]
+
+
+@pytest.mark.anyio
+async def test_search_without_a_query_returns_the_latest_todos(client, auth_headers):
+    for title in ("First", "Second", "Third"):
+        await client.post("/api/todos", json={"title": title}, headers=auth_headers)
+
+    response = await client.get(
+        "/api/todos/search", params={"limit": 2}, headers=auth_headers
+    )
+
+    assert response.status_code == 200
+    assert [todo["title"] for todo in response.json()] == ["Third", "Second"]
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from sequences import SequenceAllocator
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_reserve_returns_consecutive_ids(mongo_db):
+    allocator = SequenceAllocator(mongo_db["counters"])
+
+    assert list(await allocator.reserve("todos:1", 3)) == [1, 2, 3]
+    assert list(await allocator.reserve("todos:1", 2)) == [4, 5]
+    assert await allocator.next_id("todos:1") == 6
+    assert await allocator.next_id("todos:2") == 1
+
+
+async def test_blocks_are_handed_out_from_memory(mongo_db):
+    allocator = SequenceAllocator(mongo_db["counters"], block_size=3)
+
+    assert [await allocator.next_id("users") for _ in range(4)] == [1, 2, 3, 4]
+    # Two blocks were reserved
+    counter = await mongo_db["counters"].find_one({"_id": "users"})
+    assert counter["seq"] == 6
+
+
+async def test_used_up_blocks_and_idle_locks_are_dropped(mongo_db):
+    allocator = SequenceAllocator(mongo_db["counters"], block_size=2)
+
+    await allocator.next_id("todos:1")
+    assert list(allocator._blocks) == ["todos:1"]
+    await allocator.next_id("todos:1")
+
+    assert not allocator._blocks
+    assert not allocator._locks
+
+
+async def test_partly_used_blocks_are_bounded(mongo_db):
+    allocator = SequenceAllocator(mongo_db["counters"], block_size=10, max_blocks=2)
+
+    for user_id in (1, 2, 3):
+        await allocator.next_id(f"todos:{user_id}")
+
+    assert list(allocator._blocks) == ["todos:2", "todos:3"]
+    # The rest of the dropped block is skipped, never handed out twice
+    assert await allocator.next_id("todos:1") == 11
+
+
+@pytest.mark.parametrize("block_size", [1, 4])
+async def test_concurrent_callers_get_unique_ids(mongo_db, block_size):
+    allocator = SequenceAllocator(mongo_db["counters"], block_size=block_size)
+    other = SequenceAllocator(mongo_db["counters"], block_size=block_size)
+
+    ids = await asyncio.gather(
+        *(allocator.next_id("todos:1") for _ in range(25)),
+        *(other.next_id("todos:1") for _ in range(25)),
+    )
+
+    assert len(set(ids)) == 50
+    assert not allocator._locks
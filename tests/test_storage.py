@@ -0,0 +1,122 @@
+from datetime import datetime
+
+import pytest
+
+import search
+import storage
+from serializers import TODO_FIELDS
+
+NOW = datetime(2024, 5, 2, 10, 30)
+
+TODO = {
+    "id": 7,
+    "user_id": 1,
+    "title": "Buy milk",
+    "description": "Two litres",
+    "completed": True,
+    "priority": 2,
+    "area": "life",
+    "deadline": datetime(2024, 5, 3),
+    "created_at": NOW,
+    "updated_at": NOW,
+    search.TITLE_TERMS: ["b", "bu", "buy"],
+    search.DESCRIPTION_TERMS: ["t", "tw", "two"],
+}
+
+
+def test_every_todo_field_has_its_own_key():
+    assert set(TODO_FIELDS) <= set(storage.KEYS)
+    assert len(set(storage.KEYS.values())) == len(storage.KEYS)
+
+
+def test_encode_uses_short_keys_and_area_codes():
+    document = storage.encode(TODO)
+
+    assert document["i"] == 7 and document["u"] == 1
+    assert document["a"] == storage.AREA_CODES["life"]
+    assert document["tt"] == ["b", "bu", "buy"]
+    assert set(document) == set(storage.KEYS.values())
+    assert storage.decode(document) == TODO
+
+
+@pytest.mark.parametrize("value", [None, False, []])
+def test_defaults_are_left_out(value):
+    assert storage._omitted(value)
+    assert storage.encode({"id": 1, "description": value}) == {"i": 1}
+
+
+@pytest.mark.parametrize("value", [0, "", True, [""]])
+def test_values_other_than_the_defaults_are_kept(value):
+    assert not storage._omitted(value)
+    assert storage.encode({"title": value}) == {"t": value}
+
+
+@pytest.mark.parametrize(
+    "field, default",
+    [
+        ("description", None),
+        ("completed", False),
+        ("priority", None),
+        ("area", None),
+        ("deadline", None),
+        (search.TITLE_TERMS, []),
+        (search.DESCRIPTION_TERMS, []),
+    ],
+)
+def test_defaults_read_back_as_missing(field, default):
+    todo = {**TODO, field: default}
+
+    decoded = storage.decode(storage.encode(todo))
+
+    assert field not in decoded
+    assert decoded == {name: value for name, value in todo.items() if name != field}
+    # Clearing a field in an update removes it
+    assert storage.update({field: default}) == {"$unset": {storage.key(field): ""}}
+
+
+def test_priority_enums_are_stored_as_numbers():
+    class Priority(int):
+        pass
+
+    assert type(storage.encode({"priority": Priority(2)})["p"]) is int
+
+
+def test_unknown_names_pass_through():
+    assert storage.key("_id") == "_id"
+    assert storage.encode({"_id": "x", "id": 1}) == {"_id": "x", "i": 1}
+    assert storage.decode({"_id": "x", "i": 1}) == {"_id": "x", "id": 1}
+    assert storage.decode(None) is None
+
+
+def test_update_sets_and_unsets_on_short_keys():
+    assert storage.update(
+        {"title": "Buy oat milk", "area": "work", "deadline": None}
+    ) == {"$set": {"t": "Buy oat milk", "a": 4}, "$unset": {"dl": ""}}
+
+
+def test_queries_are_rewritten_recursively():
+    assert storage.query(
+        {
+            "user_id": 1,
+            "area": {"$in": ["work", "life"]},
+            "$or": [{"completed": {"$ne": True}}, {"area": "sports"}],
+            "$and": [{"deadline": {"$gte": NOW}}],
+        }
+    ) == {
+        "u": 1,
+        "a": {"$in": [4, 3]},
+        "$or": [{"c": {"$ne": True}}, {"a": 1}],
+        "$and": [{"dl": {"$gte": NOW}}],
+    }
+    # Unknown areas are left alone rather than matching a wrong code
+    assert storage.query({"area": "garden"}) == {"a": "garden"}
+
+
+def test_sorts_and_paths_use_short_keys():
+    assert storage.sort([("updated_at", -1), ("id", -1)]) == [("ua", -1), ("i", -1)]
+    assert storage.sort({"deadline": 1}) == {"dl": 1}
+    assert storage.path("deadline") == "$dl"
+    assert storage.PROJECTION == {
+        "_id": 0,
+        **{storage.key(field): 1 for field in TODO_FIELDS},
+    }
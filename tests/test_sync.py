@@ -0,0 +1,52 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from pagination import InvalidCursor, decode_cursor, encode_cursor
+
+
+def test_cursor_round_trips_naive_times():
+    position = {"t": datetime(2024, 5, 1, 12, 30), "id": 7}
+
+    assert decode_cursor(encode_cursor(position)) == position
+
+
+def test_cursor_with_an_aware_time_is_invalid():
+    cursor = encode_cursor({"t": datetime(2024, 5, 1, tzinfo=timezone.utc)})
+
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
+
+
+@pytest.mark.anyio
+async def test_changes_reject_a_token_with_a_timezone(client, auth_headers):
+    since = encode_cursor({"t": datetime.now(timezone.utc)})
+
+    response = await client.get(
+        "/api/todos/changes", params={"since": since}, headers=auth_headers
+    )
+
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Invalid sync token"}
+
+
+@pytest.mark.anyio
+async def test_changes_since_the_last_sync(client, auth_headers):
+    first = (await client.get("/api/todos/changes", headers=auth_headers)).json()
+    assert first["full_resync"]
+    response = await client.post(
+        "/api/todos", json={"title": "Buy milk"}, headers=auth_headers
+    )
+    todo = response.json()
+    await client.delete(f"/api/todos/{todo['id']}", headers=auth_headers)
+
+    response = await client.get(
+        "/api/todos/changes",
+        params={"since": first["next_token"]},
+        headers=auth_headers,
+    )
+
+    assert response.status_code == 200
+    changes = response.json()
+    assert not changes["full_resync"]
+    assert changes["deleted"] == [todo["id"]]
@@ -0,0 +1,150 @@
+from datetime import date, datetime
+
+import pytest
+from pymongo import ASCENDING, DESCENDING
+
+import todo_query
+from main import Priority, SortField, TodoArea, TodoFilter
+
+
+def test_filter_is_scoped_to_the_user():
+    assert todo_query.build_filter(7, TodoFilter()) == {"user_id": 7}
+
+
+def test_completed_true_matches_completed_todos():
+    query = todo_query.build_filter(1, TodoFilter(completed=True))
+
+    assert query["completed"] is True
+
+
+def test_completed_false_also_matches_todos_without_the_field():
+    query = todo_query.build_filter(1, TodoFilter(completed=False))
+
+    assert query["completed"] == {"$ne": True}
+
+
+def test_one_priority_or_area_is_a_plain_value():
+    spec = TodoFilter(priority=[Priority.HIGH], area=[TodoArea.WORK])
+
+    query = todo_query.build_filter(1, spec)
+
+    assert query["priority"] == 1
+    assert query["area"] == "work"
+
+
+def test_several_priorities_or_areas_match_any_of_them():
+    spec = TodoFilter(
+        priority=[Priority.LOW, Priority.HIGH, Priority.LOW],
+        area=[TodoArea.WORK, TodoArea.LIFE],
+    )
+
+    query = todo_query.build_filter(1, spec)
+
+    assert query["priority"] == {"$in": [1, 3]}
+    assert query["area"] == {"$in": ["life", "work"]}
+
+
+def test_deadline_range_includes_both_days():
+    spec = TodoFilter(deadline_from=date(2024, 5, 1), deadline_to=date(2024, 5, 3))
+
+    query = todo_query.build_filter(1, spec)
+
+    assert query["deadline"] == {
+        "$gte": datetime(2024, 5, 1),
+        "$lt": datetime(2024, 5, 4),
+    }
+
+
+def test_deadline_is_one_day():
+    query = todo_query.build_filter(1, TodoFilter(deadline=date(2024, 5, 1)))
+
+    assert query["deadline"] == {
+        "$gte": datetime(2024, 5, 1),
+        "$lt": datetime(2024, 5, 2),
+    }
+
+
+def test_open_ended_deadline_range():
+    query = todo_query.build_filter(1, TodoFilter(deadline_to=date(2024, 5, 1)))
+
+    assert query["deadline"] == {"$lt": datetime(2024, 5, 2)}
+
+
+@pytest.mark.parametrize("descending", [False, True])
+def test_sort_ends_with_id_in_the_same_direction(descending):
+    direction = DESCENDING if descending else ASCENDING
+
+    assert todo_query.build_sort("priority", descending) == [
+        ("priority", direction),
+        ("id", direction),
+    ]
+
+
+def test_no_sort_field_means_no_sort():
+    query = todo_query.build(1, TodoFilter())
+
+    assert (query.sort, query.index) == (None, None)
+
+
+@pytest.mark.parametrize("sort_by", list(SortField))
+@pytest.mark.parametrize("descending", [False, True])
+def test_every_sort_has_an_index(sort_by, descending):
+    query = todo_query.build(1, TodoFilter(sort_by=sort_by, descending=descending))
+
+    assert query.index[0] == ("user_id", ASCENDING)
+    # Same or reversed directions, so the index is walked one way or the other
+    reversed_sort = [(field, -direction) for field, direction in query.sort]
+    assert query.index[1:] in (query.sort, reversed_sort)
+    assert query.index in todo_query.INDEXES
+
+
+def test_updated_at_is_served_by_its_descending_index():
+    sort = todo_query.build_sort("updated_at", descending=False)
+
+    assert todo_query.choose_index(sort) == [
+        ("user_id", ASCENDING),
+        ("updated_at", DESCENDING),
+        ("id", DESCENDING),
+    ]
+
+
+def test_sort_without_an_index():
+    assert todo_query.choose_index([("title", ASCENDING), ("id", ASCENDING)]) is None
+
+
+@pytest.mark.parametrize("field", ["created_at", "updated_at"])
+def test_required_sort_field_is_one_run(field):
+    query = todo_query.build(1, TodoFilter(sort_by=field))
+
+    assert todo_query.split(query, None) == [({}, query.sort)]
+
+
+@pytest.mark.parametrize("field", todo_query.OPTIONAL_SORT_FIELDS)
+@pytest.mark.parametrize("descending", [False, True])
+def test_optional_sort_field_puts_unset_todos_last(field, descending):
+    query = todo_query.build(1, TodoFilter(sort_by=field, descending=descending))
+    direction = DESCENDING if descending else ASCENDING
+
+    assert todo_query.split(query, None) == [
+        ({field: {"$ne": None}}, query.sort),
+        ({field: None}, [("id", direction)]),
+    ]
+
+
+def test_position_in_the_valued_run_keeps_both_runs():
+    query = todo_query.build(1, TodoFilter(sort_by=SortField.PRIORITY))
+
+    runs = todo_query.split(query, {"priority": 2, "id": 5})
+
+    assert [condition for condition, _ in runs] == [
+        {"priority": {"$ne": None}},
+        {"priority": None},
+    ]
+
+
+def test_position_in_the_unset_run_skips_the_valued_run():
+    query = todo_query.build(1, TodoFilter(sort_by=SortField.DEADLINE))
+
+    runs = todo_query.split(query, {"deadline": None, "id": 5})
+
+    assert runs == [({"deadline": None}, [("id", ASCENDING)])]